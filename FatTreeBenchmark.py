@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2016 Vangelis Tasoulas <vangelis@tasoulas.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import json
+import logging
+import platform
+import tempfile
+import time
+import tracemalloc
+
+import FatTreeBuilder
+from FatTreeBuilder import error_and_exit
+
+PROGRAM_NAME = 'FatTreeBenchmark'
+VERSION = FatTreeBuilder.VERSION
+
+LOG = logging.getLogger('default.' + __name__)
+
+# The (k, n, oversub, fully_connected_roots) cases of the benchmark.
+# The small cases come from build-many.sh, the large ones are deliberately
+# bigger than anything build-many.sh builds.
+SMALL_CASES = [
+    (4, 2, 1, False),
+    (4, 3, 2, True),
+    (8, 3, 1, False),
+    (8, 3, 4, True),
+    (16, 2, 2, True),
+]
+LARGE_CASES = [
+    (12, 4, 1, False),
+    (12, 4, 2, True),
+    (12, 4, 4, True),
+]
+
+# The phases of a build, in the order they run. The last one loads the
+# written topology back with parse_ibnetdiscover().
+PHASES = ['init_nodes', 'wire_switches', 'wire_hcas', 'trim', 'output', 'parse']
+
+# The old names of the renamed phases, so that older results can still be
+# used as a baseline
+RENAMED_PHASES = {'prune': 'trim'}
+
+# Differences below these values are considered noise when two runs are compared
+MIN_TIME_DIFFERENCE = 0.005 # seconds
+MIN_MEMORY_DIFFERENCE = 64 * 1024 # bytes
+
+################################################
+############### HELPER FUNCTIONS ###############
+################################################
+
+#----------------------------------------------------------------------
+def case_name(k, n, oversub, fully_connected_roots):
+    """
+    Returns the name of a case, which is the name of its topology file without the extension
+    """
+    return os.path.splitext(FatTreeBuilder.topology_file_name(k, n, oversub, fully_connected_roots))[0]
+
+#----------------------------------------------------------------------
+def run_phases(k, n, oversub, fully_connected_roots, measure):
+    """
+    Builds and writes a topology phase by phase, and parses it back.
+    measure(phase, function) runs function() and records the phase.
+
+    The port limit is lifted, so that the large cases can be built
+    regardless of MAX_SW_PORTS.
+
+    Returns the built topology, the parsed topology and the size of the file.
+    """
+    tree = FatTreeBuilder.KAryNTree(k, n, oversub, fully_connected_roots, max_sw_ports=k + k * oversub)
+    state = {}
+
+    def init_nodes():
+        topology = FatTreeBuilder.Topology(tree.number_of_sw, tree.number_of_hca, tree.ports_per_sw)
+        topology.tree = tree
+        FatTreeBuilder.init_nodes(topology, tree)
+        state['topology'] = topology
+
+    measure('init_nodes', init_nodes)
+    measure('wire_switches', lambda: FatTreeBuilder.wire_switches(state['topology'], k, n, fully_connected_roots))
+    def wire_hcas():
+        state['hcas_per_leaf'] = FatTreeBuilder.wire_hcas(state['topology'], tree)
+
+    measure('wire_hcas', wire_hcas)
+    measure('trim', lambda: FatTreeBuilder.trim_empty_switches(state['topology'], tree, state['hcas_per_leaf']))
+
+    def output():
+        with open(os.devnull, 'w', buffering=FatTreeBuilder.OUTPUT_BUFFER_SIZE) as devnull:
+            FatTreeBuilder.write_ibnetdiscover(state['topology'], devnull, timestamp='')
+
+    measure('output', output)
+
+    # The file to parse is written outside of the measured phases
+    fd, path = tempfile.mkstemp(suffix='.topo')
+    try:
+        with os.fdopen(fd, 'w') as topology_file:
+            FatTreeBuilder.write_ibnetdiscover(state['topology'], topology_file, timestamp='')
+        size = os.path.getsize(path)
+
+        def parse():
+            state['parsed'] = FatTreeBuilder.parse_ibnetdiscover(path)
+
+        measure('parse', parse)
+    finally:
+        os.remove(path)
+
+    return state['topology'], state['parsed'], size
+
+#----------------------------------------------------------------------
+def check_round_trip(built, parsed):
+    """
+    Checks that the topology parsed from the written file is the built
+    topology. Returns the list of the differences.
+    """
+    differences = []
+    for attribute in ('node_type', 'node_guid', 'port_offset', 'port_guid', 'remote_node', 'remote_port'):
+        if getattr(built, attribute) != getattr(parsed, attribute):
+            differences.append(attribute)
+    if [built.node_name(node) for node in range(built.number_of_nodes)] != parsed.names:
+        differences.append('names')
+    if parsed.tree is None:
+        differences.append('tree description')
+
+    return differences
+
+#----------------------------------------------------------------------
+def benchmark_case(k, n, oversub, fully_connected_roots, repeat):
+    """
+    Returns the wall time and the peak memory of every phase of a case,
+    and the parse throughput in MB/s. The parsed topology must be the
+    built one.
+
+    The wall time is the best of "repeat" runs. The peak memory is measured
+    with tracemalloc in a separate run, because tracing the allocations
+    slows down the phases.
+    """
+    times = dict((phase, []) for phase in PHASES)
+
+    def measure_time(phase, function):
+        start = time.perf_counter()
+        function()
+        times[phase].append(time.perf_counter() - start)
+
+    for _ in range(repeat):
+        built, parsed, size = run_phases(k, n, oversub, fully_connected_roots, measure_time)
+
+    differences = check_round_trip(built, parsed)
+    if differences:
+        error_and_exit("The topology parsed back from the output of {} differs in: {}".format(
+            case_name(k, n, oversub, fully_connected_roots), ', '.join(differences)))
+    del built, parsed
+
+    peak_memory = {}
+
+    def measure_memory(phase, function):
+        tracemalloc.reset_peak()
+        function()
+        peak_memory[phase] = tracemalloc.get_traced_memory()[1]
+
+    tracemalloc.start()
+    try:
+        run_phases(k, n, oversub, fully_connected_roots, measure_memory)
+    finally:
+        tracemalloc.stop()
+
+    tree = FatTreeBuilder.KAryNTree(k, n, oversub, fully_connected_roots, max_sw_ports=k + k * oversub)
+    phases = dict((phase, {'time': round(min(times[phase]), 6), 'peak_memory': peak_memory[phase]}) for phase in PHASES)
+    return {'name': case_name(k, n, oversub, fully_connected_roots),
+            'k': k,
+            'n': n,
+            'oversub': oversub,
+            'fully_connected_roots': fully_connected_roots,
+            'nodes': tree.number_of_nodes,
+            'file_size': size,
+            'parse_throughput': round(size / phases['parse']['time'] / 1e6, 3),
+            'phases': phases,
+            'total_time': round(sum(phase['time'] for phase in phases.values()), 6)}
+
+#----------------------------------------------------------------------
+def run_benchmark(cases, repeat):
+    """
+    Runs the benchmark and returns the results, ready to be stored as JSON
+    """
+    results = {'version': VERSION,
+               'python': platform.python_version(),
+               'machine': platform.machine(),
+               'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'repeat': repeat,
+               'cases': []}
+
+    for params in cases:
+        LOG.info("Running {}".format(case_name(*params)))
+        result = benchmark_case(*(params + (repeat,)))
+        for phase in PHASES:
+            LOG.info("    {:<14} {:9.4f}s {:10.1f} MB".format(phase, result['phases'][phase]['time'],
+                                                               result['phases'][phase]['peak_memory'] / (1024.0 * 1024.0)))
+        LOG.info("    parse throughput {:.1f} MB/s".format(result['parse_throughput']))
+        results['cases'].append(result)
+
+    return results
+
+#----------------------------------------------------------------------
+def compare_results(old, new, threshold):
+    """
+    Compares two benchmark results and returns the list of regressions.
+
+    A phase regressed if its time or its peak memory grew by more than
+    "threshold" (a fraction, like 0.1 for 10%) and by more than the
+    noise floor (MIN_TIME_DIFFERENCE / MIN_MEMORY_DIFFERENCE).
+    """
+    regressions = []
+    old_cases = dict((case['name'], case) for case in old['cases'])
+
+    for case in new['cases']:
+        old_case = old_cases.get(case['name'])
+        if old_case is None:
+            continue
+        for phase in PHASES:
+            if phase not in old_case['phases']:
+                continue
+            for metric, noise in (('time', MIN_TIME_DIFFERENCE), ('peak_memory', MIN_MEMORY_DIFFERENCE)):
+                old_value = old_case['phases'][phase][metric]
+                new_value = case['phases'][phase][metric]
+                change = (new_value - old_value) / float(old_value) if old_value else 0.0
+                LOG.debug("{} {} {}: {} -> {} ({:+.1%})".format(case['name'], phase, metric, old_value, new_value, change))
+                if new_value - old_value > noise and change > threshold:
+                    regressions.append((case['name'], phase, metric, old_value, new_value, change))
+
+    return regressions
+
+#----------------------------------------------------------------------
+def load_results(path):
+    """
+    Loads benchmark results, with the old names of the phases replaced by
+    the current ones (see RENAMED_PHASES)
+    """
+    try:
+        with open(path) as results_file:
+            results = json.load(results_file)
+    except (IOError, OSError, ValueError) as e:
+        error_and_exit("Cannot read the benchmark results in {}: {}".format(path, e))
+
+    for case in results.get('cases', []):
+        phases = case.get('phases', {})
+        for old_name, new_name in RENAMED_PHASES.items():
+            if old_name in phases and new_name not in phases:
+                phases[new_name] = phases.pop(old_name)
+
+    return results
+
+#######################################################
+###### Add command line options in this function ######
+#######################################################
+# Add the user defined command line arguments in this function
+
+def _command_Line_Options():
+    """
+    Define the accepted command line arguments in this function
+
+    Read the documentation of argparse for more advanced command line
+    argument parsing examples
+    http://docs.python.org/2/library/argparse.html
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description=PROGRAM_NAME + " measures the wall time and the peak memory of every phase of"
+                                     " FatTreeBuilder (node initialization, switch wiring, HCA wiring, trimming and output) over a set"
+                                     " of k/n/oversubscription cases. The results are stored as JSON, and can be compared with the"
+                                     " results of an earlier run to find regressions.")
+
+    parser.add_argument("-v", "--version",
+                        action="version", default=argparse.SUPPRESS,
+                        version=VERSION,
+                        help="show program's version number and exit")
+
+    FatTreeBuilder._add_logging_options(parser)
+
+    parser.add_argument("-s", "--small",
+                        action="store_true",
+                        default=False,
+                        dest="small",
+                        help="Only run the small cases.")
+    parser.add_argument("-r", "--repeat",
+                        action="store",
+                        type=int,
+                        default=3,
+                        dest="repeat",
+                        help="Run every case this many times and keep the best time. (Default: 3)")
+    parser.add_argument("-O", "--output",
+                        action="store",
+                        default=None,
+                        dest="output",
+                        metavar="FILE",
+                        help="Store the results in FILE.")
+    parser.add_argument("-b", "--baseline",
+                        action="store",
+                        default=None,
+                        dest="baseline",
+                        metavar="FILE",
+                        help="Compare the results with the results stored in FILE by an earlier run.")
+    parser.add_argument("-C", "--compare",
+                        action="store",
+                        nargs=2,
+                        default=None,
+                        dest="compare",
+                        metavar=("OLD", "NEW"),
+                        help="Do not run anything, only compare the results stored in OLD and NEW.")
+    parser.add_argument("-t", "--threshold",
+                        action="store",
+                        type=float,
+                        default=10.0,
+                        dest="threshold",
+                        metavar="PERCENT",
+                        help="A phase regressed if its time or peak memory grew more than PERCENT. (Default: 10)")
+
+    opts = parser.parse_args()
+
+    if(opts.isQuiet):
+        opts.loglevel = "NOTSET"
+
+    return opts
+
+##################################################
+############### WRITE MAIN PROGRAM ###############
+##################################################
+
+if __name__ == '__main__':
+    """
+    Write the main program here
+    """
+    # Parse the command line options
+    options = _command_Line_Options()
+    # Configure logging
+    FatTreeBuilder._configureLogging(options.loglevel)
+
+    LOG.info("{} v{} is running...\n".format(PROGRAM_NAME, VERSION))
+
+    if options.compare:
+        old = load_results(options.compare[0])
+        new = load_results(options.compare[1])
+    else:
+        cases = SMALL_CASES if options.small else SMALL_CASES + LARGE_CASES
+        new = run_benchmark(cases, max(1, options.repeat))
+        old = load_results(options.baseline) if options.baseline else None
+
+        if options.output:
+            with open(options.output, 'w') as output:
+                json.dump(new, output, indent=2, sort_keys=True)
+                output.write('\n')
+            LOG.info("The results were stored in {}".format(options.output))
+        else:
+            json.dump(new, sys.stdout, indent=2, sort_keys=True)
+            sys.stdout.write('\n')
+
+    if old is not None:
+        regressions = compare_results(old, new, options.threshold / 100.0)
+        for name, phase, metric, old_value, new_value, change in regressions:
+            LOG.warning("REGRESSION {} {} {}: {} -> {} ({:+.1%})".format(name, phase, metric, old_value, new_value, change))
+        if regressions:
+            sys.exit(1)
+        LOG.info("No regressions found")
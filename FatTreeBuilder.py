@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 #
 # Copyright (C) 2016 Vangelis Tasoulas <vangelis@tasoulas.net>
 #
@@ -15,16 +15,20 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
-from __future__ import print_function
 import os
 import sys
-import argparse
+import contextlib
 import logging
 import time
-from collections import OrderedDict
+from array import array
 
 __all__ = [
-    'print_', 'LOG'
+    'print_', 'LOG', 'Topology', 'KAryNTree',
+    'build_fat_tree', 'write_ibnetdiscover', 'stream_ibnetdiscover',
+    'TopologyCache', 'write_cached_ibnetdiscover', 'PhaseProfiler',
+    'parse_ibnetdiscover', 'iter_lfts', 'write_lft_dump', 'write_guid2lid',
+    'LinkLoads', 'analyze_traffic', 'validate_topology', 'XGFT', 'build_xgft',
+    'iter_failure_variants', 'write_failure_variants'
 ]
 
 PROGRAM_NAME = 'FatTreeBuilder'
@@ -33,58 +37,3434 @@ AUTHOR = 'Vangelis Tasoulas'
 
 LOG = logging.getLogger('default.' + __name__)
 
+################################################
+############# IBNETDISCOVER FORMAT #############
+################################################
+
+# The output of ibnetdiscover looks like this:
+# vendid=0x0
+# devid=0x0
+# sysimgguid=0x200000
+# switchguid=0x200000(200000)
+# Switch  4 "S-0000000000200000"          # "Switch0" base port 0 lid 1 lmc 0
+# [1]     "S-0000000000200004"[3]         # "Switch4" lid 7 4xSDR
+# [2]     "S-0000000000200005"[3]         # "Switch5" lid 9 4xSDR
+# [3]     "H-0000000000100000"[1](100001)                 # "Hca0" lid 2 4xSDR
+# [4]     "H-0000000000100002"[1](100003)                 # "Hca1" lid 5 4xSDR
+#
+# vendid=0x0
+# devid=0x0
+# sysimgguid=0x10000e
+# caguid=0x10000e
+# Ca      1 "H-000000000010000e"          # "Hca7"
+# [1](10000f)     "S-0000000000200003"[4]         # lid 20 lmc 0 "Switch3" lid 6 4xSDR
+#
+# Based on this output, here I make template lines with placeholders for different purposes:
+# The place holders must be replced with:
+#    node_type_long = Switch or Hca
+#    node_type_short = S or H (for switch or hca respectively)
+#    total_port = total number of ports for this node
+#    node_guid = the GUID of this node
+#    node_name = the name of this node
+NODE_LINE = '{node_type_long}\t{total_ports} "{node_type_short}-{node_guid}"\t\t# "{node_name}"'
+#    local_port = An integer showing which local port is connected to a remote
+#    rem_node_type_short = S or H
+#    rem_node_guid = The guid of the remote node
+#    rem_port = the port of the remote node that we connect with
+#    rem_node_name = the name of the remote node
+#    link_speed = something like 4xSDR, 4xDDR, 4xQDR, 4xFDR, 4xEDR, 4xHDR indicating the link speed
+#    local_port_guid = If the local port is an HCA port, then we need to define the local port guid
+#    rem_port_guid = If the remote port is an HCA port, then we need to define the remote port guid
+PORT_LINES = {}
+PORT_LINES['switch'] = {}
+# line to use if local is a switch, remote is a switch
+PORT_LINES['switch']['switch'] = '[{local_port}]\t"{rem_node_type_short}-{rem_node_guid}"[{rem_port}]\t\t# "{rem_node_name}" lid 0 {link_speed}'
+# line to use if local is a switch, remote is an hca
+PORT_LINES['switch']['hca'] = '[{local_port}]\t"{rem_node_type_short}-{rem_node_guid}"[{rem_port}]({rem_port_guid}) \t\t# "{rem_node_name}" lid 0 {link_speed}'
+PORT_LINES['hca'] = {}
+# line to use if local is an hca, remote is a switch
+PORT_LINES['hca']['switch'] = '[{local_port}]({local_port_guid}) \t"{rem_node_type_short}-{rem_node_guid}"[{rem_port}]\t\t# lid 0 lmc 0 "{rem_node_name}" lid 0 {link_speed}'
+# line to use if local is an hca, remote is an hca
+PORT_LINES['hca']['hca'] = '[{local_port}]({local_port_guid}) \t"{rem_node_type_short}-{rem_node_guid}"[{rem_port}]({rem_port_guid}) \t\t# lid 0 lmc 0 "{rem_node_name}" lid 0 {link_speed}'
+
+HCA_GUID_BASE = 0x1000000 # We want to define a GUID for each HCA and each port. The node GUID of the first Hca will be HCA_GUID_BASE
+PORT_GUID_BASE = HCA_GUID_BASE + 0x1000000
+SW_GUID_BASE = PORT_GUID_BASE + 0x1000000
+DEFAULT_LINK_SPEED = '4xEDR'
+MAX_SW_PORTS = 48 # Max ports per switch in the generated topology. If the user chooses some insanely huge topology
+                  # that requires very many ports per sw, do not build the topology. At the moment, the OmniPath architecture
+                  # offers switches with up to 48 ports, Oracle IB EDR Switches offer up to 38 4x ports and Mellanox switches
+                  # offer up to 36 ports. Use --max-switch-ports to raise the limit (0 removes it).
+
 ################################################
 ############### HELPER FUNCTIONS ###############
 ################################################
 
 #----------------------------------------------------------------------
-def error_and_exit(message):
+def error_and_exit(message):
+    """
+    Prints the "message" and exits with status 1
+    """
+    print("\nFATAL ERROR:\n" + message + "\n", file=sys.stderr)
+    exit(1)
+
+#----------------------------------------------------------------------
+def print_(value_to_be_printed, print_indent=0, spaces_per_indent=4, endl="\n"):
+    """
+    This function, among anything else, it will print dictionaries (even nested ones) in a good looking way
+
+    # value_to_be_printed: The only needed argument and it is the
+                           text/number/dictionary to be printed
+    # print_indent: indentation for the printed text (it is used for
+                    nice looking dictionary prints) (default is 0)
+    # spaces_per_indent: Defines the number of spaces per indent (default is 4)
+    # endl: Defines the end of line character (default is \n)
+
+    More info here:
+    http://stackoverflow.com/questions/19473085/create-a-nested-dictionary-for-a-word-python?answertab=active#tab-top
+    """
+
+    if(isinstance(value_to_be_printed, dict)):
+        for key, value in value_to_be_printed.items():
+            if(isinstance(value, dict)):
+                print_('{0}{1!r}:'.format(print_indent * spaces_per_indent * ' ', key))
+                print_(value, print_indent + 1)
+            else:
+                print_('{0}{1!r}: {2}'.format(print_indent * spaces_per_indent * ' ', key, value))
+    else:
+        string = ('{0}{1}{2}'.format(print_indent * spaces_per_indent * ' ', value_to_be_printed, endl))
+        sys.stdout.write(string)
+
+#----------------------------------------------------------------------
+def int_to_hex_str(number, hex_length = -2, prefix_with_0x = False):
+    """
+    Converts an int to a hex string with the number of hex_length zeros prepended
+    """
+    hex_str = "{0:#0{1}x}".format(number, hex_length + 2)
+
+    if (not prefix_with_0x):
+        hex_str = hex_str[2:len(hex_str)]
+
+    return hex_str
+
+#----------------------------------------------------------------------
+
+################################################
+################ TOPOLOGY MODEL ################
+################################################
+
+class Topology(object):
+    """
+    Compact, array-backed representation of a fabric.
+
+    Every node is identified by an integer id, which is also the order the
+    nodes are written in. In the generated trees the switches come first
+    (ids 0 .. number_of_sw - 1) and the HCAs follow. The per-port
+    information lives in flat arrays indexed by port_index(node, port), so
+    no python object is created per node or per port. Node names and GUID
+    strings are only produced when the topology is written out.
+
+    # node_type:   Topology.SWITCH or Topology.HCA for every node
+    # node_guid:   the GUID of every node
+    # port_offset: port_offset[node] is the index of port 1 of the node in
+                   the per-port tables, port_offset[node + 1] is one past its
+                   last port
+    # port_guid:   the GUID of every port (0 for switch ports)
+    # remote_node: the node connected to every port (-1 if not connected)
+    # remote_port: the port of the remote node (0 if not connected)
+    # active:      nonzero for every node that is part of the fabric.
+                   prune_unconnected_nodes() clears the nodes without links
+    # names:       the name of every node, for topologies that were not
+                   generated (see parse_ibnetdiscover()). If None, the names
+                   are Switch<id> and Hca<id - number_of_sw>
+    # tree:        the KAryNTree the topology was built from, if any
+    """
+
+    SWITCH = 0
+    HCA = 1
+
+    def __init__(self, number_of_sw, number_of_hca, ports_per_sw):
+        """
+        Creates a topology without links, with number_of_sw switches of
+        ports_per_sw ports followed by number_of_hca single port HCAs.
+        """
+        sw_ports = number_of_sw * ports_per_sw
+        self._allocate(array('B', [Topology.SWITCH]) * number_of_sw + array('B', [Topology.HCA]) * number_of_hca,
+                       array('Q', range(0, sw_ports, ports_per_sw)) + array('Q', range(sw_ports, sw_ports + number_of_hca + 1)))
+        self.ports_per_sw = ports_per_sw
+
+    #----------------------------------------------------------------------
+    @classmethod
+    def from_port_counts(cls, node_type, total_ports):
+        """
+        Creates a topology without links, with nodes of any type and port
+        count in any order. node_type and total_ports have one entry per node.
+        """
+        port_offset = array('Q', [0]) * (len(total_ports) + 1)
+        offset = 0
+        for node, ports in enumerate(total_ports):
+            port_offset[node] = offset
+            offset += ports
+        port_offset[len(total_ports)] = offset
+
+        topology = cls.__new__(cls)
+        topology._allocate(array('B', node_type), port_offset)
+        topology.ports_per_sw = max([ports for node, ports in enumerate(total_ports) if node_type[node] == Topology.SWITCH] or [0])
+        return topology
+
+    #----------------------------------------------------------------------
+    def _allocate(self, node_type, port_offset):
+        self.node_type = node_type
+        self.number_of_nodes = len(node_type)
+        self.number_of_sw = node_type.count(Topology.SWITCH)
+        self.number_of_hca = self.number_of_nodes - self.number_of_sw
+
+        self.node_guid = array('Q', [0]) * self.number_of_nodes
+        self.active = array('B', [1]) * self.number_of_nodes
+
+        self.port_offset = port_offset
+        self.number_of_ports = port_offset[-1]
+
+        self.port_guid = array('Q', [0]) * self.number_of_ports
+        self.remote_node = array('l', [-1]) * self.number_of_ports
+        self.remote_port = array('H', [0]) * self.number_of_ports
+
+        self.names = None
+        self.tree = None
+
+    #----------------------------------------------------------------------
+    def total_ports(self, node):
+        """
+        Returns the number of ports of the node
+        """
+        return self.port_offset[node + 1] - self.port_offset[node]
+
+    #----------------------------------------------------------------------
+    def port_index(self, node, port):
+        """
+        Returns the index of the (node, port) pair in the per-port tables
+        """
+        return self.port_offset[node] + port - 1
+
+    #----------------------------------------------------------------------
+    def is_switch(self, node):
+        return self.node_type[node] == Topology.SWITCH
+
+    #----------------------------------------------------------------------
+    def node_name(self, node):
+        """
+        Returns the name of the node as it appears in the output
+        """
+        if self.names is not None:
+            return self.names[node]
+        if self.node_type[node] == Topology.SWITCH:
+            return "Switch{}".format(node)
+        return "Hca{}".format(node - self.number_of_sw)
+
+    #----------------------------------------------------------------------
+    def connect(self, node_a, port_a, node_b, port_b):
+        """
+        Connects port_a of node_a with port_b of node_b
+        """
+        index_a = self.port_offset[node_a] + port_a - 1
+        index_b = self.port_offset[node_b] + port_b - 1
+        self.remote_node[index_a] = node_b
+        self.remote_port[index_a] = port_b
+        self.remote_node[index_b] = node_a
+        self.remote_port[index_b] = port_a
+
+    #----------------------------------------------------------------------
+    def counts(self):
+        """
+        Returns the number of active nodes and the number of links
+        """
+        return {'nodes': self.active.count(1),
+                'links': (self.number_of_ports - self.remote_node.count(-1)) // 2}
+
+    #----------------------------------------------------------------------
+    def prune_unconnected_nodes(self, nodes=None):
+        """
+        Marks the nodes that are not connected at all as inactive, so that
+        they are not part of the output. Returns the list of pruned nodes.
+        # nodes: the nodes to check, if only the links of some nodes were
+                 removed since the last pruning. By default all the nodes.
+        """
+        pruned = []
+        remote_node = self.remote_node
+        port_offset = self.port_offset
+        for node in (range(self.number_of_nodes) if nodes is None else nodes):
+            if not self.active[node]:
+                continue
+            if remote_node[port_offset[node]:port_offset[node + 1]].count(-1) == port_offset[node + 1] - port_offset[node]:
+                self.active[node] = 0
+                pruned.append(node)
+
+        return pruned
+
+    #----------------------------------------------------------------------
+    def disconnect(self, node, port):
+        """
+        Removes the link of port "port" of the node, if any. Returns the
+        (remote node, remote port) pair it was connected to, or None.
+        """
+        index = self.port_offset[node] + port - 1
+        rem_node = self.remote_node[index]
+        if rem_node < 0:
+            return None
+        rem_port = self.remote_port[index]
+        rem_index = self.port_offset[rem_node] + rem_port - 1
+        self.remote_node[index] = self.remote_node[rem_index] = -1
+        self.remote_port[index] = self.remote_port[rem_index] = 0
+        return rem_node, rem_port
+
+
+################################################
+############### FAT TREE WIRING ################
+################################################
+
+#----------------------------------------------------------------------
+def fat_tree_row(n, row):
+    """
+    Returns the (level, second_subtree) pair of a row of switches.
+
+    Rows 0 .. n-1 are the levels of the first subtree, with the root
+    switches in row n-1. When the roots are fully connected, the rows
+    n .. 2n-2 are the levels 0 .. n-2 of the second subtree.
+    """
+    if row >= n:
+        return row - n, True
+    return row, False
+
+#----------------------------------------------------------------------
+def uplink_upper_row(n, row):
+    """
+    Returns the row of the switches that the uplinks of a non-root row connect to
+    """
+    level, second_subtree = fat_tree_row(n, row)
+    if second_subtree and level == n - 2:
+        return n - 1
+    return row + 1
+
+#----------------------------------------------------------------------
+def uplink_remote_switch(k, n, sw_no, port):
+    """
+    Returns the switch that the uplink "port" (1 .. k) of a non-root switch connects to.
+
+    Written in base k, the index of the remote switch in the upper row is the
+    index of the local switch with the digit of the local level replaced by
+    port - 1.
+    """
+    sw_per_row = k**(n - 1)
+    row = sw_no // sw_per_row
+    level, _ = fat_tree_row(n, row)
+    sw_index_this_row = sw_no - row * sw_per_row
+    step = k**level
+
+    remote_sw_index = sw_index_this_row + (port - 1 - (sw_index_this_row // step) % k) * step
+    return uplink_upper_row(n, row) * sw_per_row + remote_sw_index
+
+#----------------------------------------------------------------------
+def uplink_remote_port(k, n, level, sw_index_this_row, second_subtree):
+    """
+    Returns the port of the upper switch that an uplink of a non-root switch lands on.
+
+    Every upper switch is reached by one uplink of each of the k switches below
+    it, and these k switches only differ in the base-k digit of their level.
+    Since the switches are wired in ascending order, the switch with digit d
+    gets the (d + 1)th down port of the upper switch, that is port k + 1 + d.
+    The second subtree lands on the root ports 1 .. k, which are left free by
+    the first subtree.
+    """
+    remote_port_offset = 0 if (second_subtree and level == n - 2) else k
+    return remote_port_offset + 1 + (sw_index_this_row // k**level) % k
+
+#----------------------------------------------------------------------
+def wire_switches(topology, k, n, fully_connected_roots):
+    """
+    Connects the switches between them to form the fat tree.
+
+    The links are built one row at a time. For every uplink port, the
+    remote switches and ports of the whole row are computed in one batch
+    with the closed forms of uplink_remote_switch() and uplink_remote_port(),
+    and written in the per-port tables with a strided slice assignment.
+    The same is done for the matching down ports of the upper row.
+    """
+    sw_per_row = k**(n - 1)
+    ports_per_sw = topology.ports_per_sw
+    rows = (n * 2) - 1 if fully_connected_roots else n
+
+    for row in range(rows):
+        level, second_subtree = fat_tree_row(n, row)
+        # The connectivity of the root switches is established by the rows below them.
+        if (level == (n - 1)):
+            continue
+
+        upper_row = uplink_upper_row(n, row)
+        remote_port_offset = 0 if (second_subtree and level == n - 2) else k
+        step = k**level
+
+        # The digit of this level for every switch of the row, and the index of every
+        # switch with this digit cleared. Upper and lower rows share the same indexing.
+        digit = [(sw_index // step) % k for sw_index in range(sw_per_row)]
+        digit_cleared = [sw_index - d * step for sw_index, d in enumerate(digit)]
+        lower_ports = array('H', [remote_port_offset + 1 + d for d in digit])
+        upper_ports = array('H', [d + 1 for d in digit])
+
+        lower_first_sw = row * sw_per_row
+        upper_first_sw = upper_row * sw_per_row
+        lower_first_port = topology.port_offset[lower_first_sw]
+        upper_first_port = topology.port_offset[upper_first_sw]
+        row_ports = sw_per_row * ports_per_sw
+
+        for uplink in range(k):
+            # Port "uplink + 1" of every switch of this row
+            ports = slice(lower_first_port + uplink, lower_first_port + row_ports, ports_per_sw)
+            topology.remote_node[ports] = array('l', [upper_first_sw + sw_index + uplink * step for sw_index in digit_cleared])
+            topology.remote_port[ports] = lower_ports
+
+            # Port "remote_port_offset + uplink + 1" of every switch of the upper row
+            ports = slice(upper_first_port + remote_port_offset + uplink, upper_first_port + row_ports, ports_per_sw)
+            topology.remote_node[ports] = array('l', [lower_first_sw + sw_index + uplink * step for sw_index in digit_cleared])
+            topology.remote_port[ports] = upper_ports
+
+################################################
+############# STREAMING GENERATION #############
+################################################
+
+HCA_PLACEMENTS = ['packed', 'spread']
+
+class KAryNTree(object):
+    """
+    The arithmetic of a k-ary-n-tree, without any per-node or per-port state.
+
+    The nodes are numbered like in Topology: the switches row by row (see
+    fat_tree_row()) and then the HCAs. remote() works out the neighbour of
+    any (node, port) pair on demand, which allows to generate the fabric
+    one node at a time.
+
+    A tree can be partially populated with fewer HCAs than it has room for
+    (see hca_leaf()). The switches that are left with no HCA below them are
+    not part of the fabric (see switch_in_use()), but keep their node ids.
+    """
+
+    def __init__(self, k, n, oversub=1, fully_connected_roots=False, max_sw_ports=MAX_SW_PORTS, hcas=None, placement='packed'):
+        if k < 1 or n < 1 or oversub < 1:
+            raise ValueError("k, n and the oversubscription rate must be positive integers")
+
+        # Find how many ports per switch are needed in the leaf level:
+        #     k ports goes up, and k * oversub ports go down to the hosts.
+        # If more than max_sw_ports, the tree cannot be built (None means no limit).
+        ports_per_sw = k + (k * oversub)
+        if max_sw_ports is not None and ports_per_sw > max_sw_ports:
+            raise ValueError("{} ports are needed per switch, but the"
+                             " max allowed ports per switch are {}".format(
+                                 ports_per_sw, max_sw_ports))
+
+        if fully_connected_roots and n < 2:
+            raise ValueError("The root switches can only be fully connected in trees with at least 2 levels")
+
+        self.k = k
+        self.n = n
+        self.oversub = oversub
+        self.fully_connected_roots = fully_connected_roots
+
+        self.ports_per_sw = ports_per_sw
+        self.hca_per_leaf = k * oversub
+        self.sw_per_row = k**(n-1)
+
+        if fully_connected_roots:
+            self.number_of_sw  = self.sw_per_row * ((n * 2) - 1)
+            self.number_of_leaves = self.sw_per_row * 2
+        else:
+            self.number_of_sw  = self.sw_per_row * n
+            self.number_of_leaves = self.sw_per_row
+        self.hca_capacity = self.number_of_leaves * self.hca_per_leaf
+
+        if hcas is None:
+            hcas = self.hca_capacity
+        if not 0 < hcas <= self.hca_capacity:
+            raise ValueError("The tree has room for 1 to {} HCAs, not {}".format(self.hca_capacity, hcas))
+        if placement not in HCA_PLACEMENTS:
+            raise ValueError("Unknown HCA placement '{}'. Choose one of: {}".format(placement, ', '.join(HCA_PLACEMENTS)))
+
+        self.number_of_hca = hcas
+        self.placement = placement
+        self.partially_populated = hcas < self.hca_capacity
+        self.number_of_nodes = self.number_of_sw + self.number_of_hca
+
+    #----------------------------------------------------------------------
+    def description(self):
+        """
+        Returns the description of the tree in the header of the output
+        """
+        return "k = {}, n = {}, oversubscription = {}{}{}".format(
+            self.k, self.n, self.oversub, ', Fully populated' if self.fully_connected_roots else '',
+            ', {} HCAs ({})'.format(self.number_of_hca, self.placement) if self.partially_populated or self.placement != 'packed' else '')
+
+    #----------------------------------------------------------------------
+    def metrics(self):
+        """
+        Returns the closed forms of the diameter, the bisection width and the up-path diversity of the tree:
+        - the farthest HCAs go up to the roots and back, 2n links apart.
+        - the tree has full bisection bandwidth above the leaves, so the
+          bisection is cut either at the HCA links or at the leaf uplinks.
+        - there are k**l shortest paths between two HCAs whose nearest common
+          ancestors are at level l, one through each of them.
+        The diameter and the bisection width are left out for partially populated trees.
+        """
+        if self.partially_populated:
+            return {'diameter': None,
+                    'bisection_width': None,
+                    'bisection_ratio': None,
+                    'up_path_diversity': [self.k**level for level in range(self.n)]}
+        if self.n == 1:
+            bisection_width = self.number_of_hca // 2
+        else:
+            bisection_width = min(self.number_of_hca, (self.number_of_hca // self.hca_per_leaf) * self.k) // 2
+        return {'diameter': 2 * self.n,
+                'bisection_width': bisection_width,
+                'bisection_ratio': round(float(bisection_width) / (self.number_of_hca // 2), 3) if self.number_of_hca > 1 else None,
+                'up_path_diversity': [self.k**level for level in range(self.n)]}
+
+    #----------------------------------------------------------------------
+    def is_switch(self, node):
+        return node < self.number_of_sw
+
+    #----------------------------------------------------------------------
+    def total_ports(self, node):
+        return self.ports_per_sw if node < self.number_of_sw else 1
+
+    #----------------------------------------------------------------------
+    def node_name(self, node):
+        if node < self.number_of_sw:
+            return "Switch{}".format(node)
+        return "Hca{}".format(node - self.number_of_sw)
+
+    #----------------------------------------------------------------------
+    def node_guid(self, node):
+        if node < self.number_of_sw:
+            return SW_GUID_BASE + node
+        return HCA_GUID_BASE + node - self.number_of_sw
+
+    #----------------------------------------------------------------------
+    def hca_port_guid(self, node):
+        """
+        Returns the GUID of port 1 of an HCA node
+        """
+        return PORT_GUID_BASE + node - self.number_of_sw
+
+    #----------------------------------------------------------------------
+    def counts(self):
+        """
+        Returns the number of nodes and the number of links
+        """
+        # Every HCA has one link, and every non-root switch has k uplinks.
+        non_root_sw = self.number_of_sw - self.sw_per_row
+        return {'nodes': self.number_of_nodes,
+                'links': self.number_of_hca + non_root_sw * self.k}
+
+    #----------------------------------------------------------------------
+    def hca_leaf(self, hca_no):
+        """
+        Returns the (leaf number, down port number) pair of the HCA number
+        "hca_no", where the leaves are numbered from 0 across the first and
+        the second subtree, and the down ports of every leaf from 0.
+
+        With the "packed" placement the leaves are filled one after the
+        other. With the "spread" placement the HCAs are dealt to the leaves
+        one at a time, so that the leaves get the same number of HCAs (give
+        or take one). Both placements are the same for the trees that are
+        not partially populated, apart from the order of the HCAs.
+        """
+        if self.placement == 'spread':
+            return hca_no % self.number_of_leaves, hca_no // self.number_of_leaves
+        return hca_no // self.hca_per_leaf, hca_no % self.hca_per_leaf
+
+    #----------------------------------------------------------------------
+    def leaf_switch(self, leaf_no):
+        """
+        Returns the switch of a leaf number. The leaves of the second
+        subtree come after the leaves of the first subtree.
+        """
+        if leaf_no >= self.sw_per_row:
+            return leaf_no + (self.n - 1) * self.sw_per_row
+        return leaf_no
+
+    #----------------------------------------------------------------------
+    def hca_leaf_switch(self, hca_no):
+        """
+        Returns the (leaf switch, port) pair that the HCA number "hca_no" connects to.
+
+        The HCAs of the second subtree come after the HCAs of the first
+        subtree, and are connected to the leaf switches of the second subtree.
+        """
+        leaf_no, down_port = self.hca_leaf(hca_no)
+        return self.leaf_switch(leaf_no), down_port + (self.k + 1)
+
+    #----------------------------------------------------------------------
+    def occupied_leaves(self):
+        """
+        Returns the number of leaves with HCAs. With both placements, these
+        are the first leaves in the order of leaf_switch().
+        """
+        if self.placement == 'spread':
+            return min(self.number_of_hca, self.number_of_leaves)
+        return -(-self.number_of_hca // self.hca_per_leaf)
+
+    #----------------------------------------------------------------------
+    def switch_in_use(self, sw_no):
+        """
+        Returns True if the switch has HCAs below it.
+
+        A switch of level l reaches the block of k**l leaves of its subtree
+        that share its base-k digits l .. n-2 (the roots reach all the
+        leaves). Since the occupied leaves come first, the switch is in use
+        if its block starts before the last occupied leaf.
+        """
+        occupied = self.occupied_leaves()
+        row = sw_no // self.sw_per_row
+        level, second_subtree = fat_tree_row(self.n, row)
+        if level == self.n - 1:
+            return occupied > 0
+        block = self.k**level
+        first_leaf = ((sw_no - row * self.sw_per_row) // block) * block + (self.sw_per_row if second_subtree else 0)
+        return first_leaf < occupied
+
+    #----------------------------------------------------------------------
+    def switches_in_use(self):
+        """
+        Returns the number of switches with HCAs below them (see switch_in_use())
+        """
+        if not self.partially_populated:
+            return self.number_of_sw
+        occupied = self.occupied_leaves()
+        in_use = 0
+        for row in range(self.number_of_sw // self.sw_per_row):
+            level, second_subtree = fat_tree_row(self.n, row)
+            if level == self.n - 1:
+                in_use += self.sw_per_row
+                continue
+            block = self.k**level
+            row_occupied = min(max(occupied - (self.sw_per_row if second_subtree else 0), 0), self.sw_per_row)
+            in_use += min(-(-row_occupied // block) * block, self.sw_per_row)
+        return in_use
+
+    #----------------------------------------------------------------------
+    def remote(self, node, port):
+        """
+        Returns the (remote node, remote port) pair connected to "port" of
+        "node", or None if the port is not connected.
+        """
+        k = self.k
+        n = self.n
+        sw_per_row = self.sw_per_row
+
+        if node >= self.number_of_sw:
+            sw_no, sw_port = self.hca_leaf_switch(node - self.number_of_sw)
+            return sw_no, sw_port
+
+        row = node // sw_per_row
+        level, second_subtree = fat_tree_row(n, row)
+        sw_index_this_row = node - row * sw_per_row
+
+        if port <= k:
+            if level < n - 1:
+                return (uplink_remote_switch(k, n, node, port),
+                        uplink_remote_port(k, n, level, sw_index_this_row, second_subtree))
+            if not self.fully_connected_roots:
+                return None
+            # The root ports 1 .. k are the down ports of the second subtree.
+            lower_row = (n * 2) - 2
+            step = k**(n - 2)
+        elif level == 0:
+            # Leaf switches: the down ports go to the HCAs.
+            hca_index = port - k - 1
+            if hca_index >= self.hca_per_leaf:
+                return None
+            leaf_no = sw_index_this_row + (sw_per_row if second_subtree else 0)
+            if self.placement == 'spread':
+                hca_no = hca_index * self.number_of_leaves + leaf_no
+            else:
+                hca_no = leaf_no * self.hca_per_leaf + hca_index
+            if hca_no >= self.number_of_hca:
+                return None
+            return self.number_of_sw + hca_no, 1
+        elif port <= 2 * k:
+            lower_row = row - 1
+            step = k**(level - 1)
+        else:
+            return None
+
+        # The inverse of uplink_remote_switch(): the lower switch is this switch
+        # with the digit of the lower level replaced by the down port number.
+        down_port = (port - 1) % k
+        digit = (sw_index_this_row // step) % k
+        lower_sw_index = sw_index_this_row + (down_port - digit) * step
+        return lower_row * sw_per_row + lower_sw_index, digit + 1
+
+#----------------------------------------------------------------------
+def ibnetdiscover_header(tree, timestamp=None, notes=(), counts=None):
+    """
+    Returns the comment lines that describe the topology (a KAryNTree or an
+    XGFT), at the top of the output.
+
+    timestamp defaults to the current time. If it is an empty string, the
+    time is left out so that the output is reproducible. Every line of
+    "notes" is added at the end of the description. counts is the
+    (switches, HCAs) pair of the nodes in the output, if they are not the
+    nodes of the tree (e.g. in a failure variant).
+    """
+    if timestamp is None:
+        timestamp = time.ctime()
+    if counts is not None:
+        switches, hcas = counts
+    else:
+        # The switches of a partially populated tree that have no HCAs below them are left out
+        switches = tree.switches_in_use() if isinstance(tree, KAryNTree) else tree.number_of_sw
+        hcas = tree.number_of_hca
+
+    return ('#\n'
+            '# Topology file: generated with FatTreeBuilder.py{timestamp}\n'
+            '# https://github.com/cyberang3l/InfiniBand-Topology-Builder/\n'
+            '#\n'
+            '# Topology description\n'
+            '# -------------------------------\n'
+            '# {description}\n'
+            '# Total number of nodes: {nodes}\n'
+            '# Total number of Switches: {switches}\n'
+            '# Total number of HCAs: {hcas}\n'
+            '{notes}'
+            '#\n'
+            '\n').format(timestamp=' on ' + timestamp if timestamp else '', description=tree.description(),
+                         nodes=switches + hcas, switches=switches, hcas=hcas,
+                         notes=''.join('# {}\n'.format(note) for note in notes))
+
+#----------------------------------------------------------------------
+def iter_ibnetdiscover_blocks(tree, link_speed=DEFAULT_LINK_SPEED):
+    """
+    Yields the ibnetdiscover block of every node of a KAryNTree, in the
+    order the nodes are printed.
+
+    The neighbours of each node are worked out with KAryNTree.remote() while
+    the block is formatted, so the memory use does not grow with the size of
+    the fabric. Every node of a k-ary-n-tree is connected, so there is
+    nothing to prune.
+    """
+    for node in range(tree.number_of_nodes):
+        node_type = 'switch' if tree.is_switch(node) else 'hca'
+        node_guid = tree.node_guid(node)
+        total_ports = tree.total_ports(node)
+
+        lines = ['vendid=0x0',
+                 'devid=0x0',
+                 'sysimgguid={}'.format(int_to_hex_str(node_guid, prefix_with_0x=True))]
+        if node_type == 'switch':
+            lines.append('switchguid={}({})'.format(int_to_hex_str(node_guid, prefix_with_0x=True), int_to_hex_str(node_guid)))
+            node_port_guid = None
+        else:
+            lines.append('caguid={}'.format(int_to_hex_str(node_guid, prefix_with_0x=True)))
+            node_port_guid = int_to_hex_str(tree.hca_port_guid(node))
+
+        lines.append(NODE_LINE.format(node_type_long = "Switch" if node_type == 'switch' else "Ca",
+                                      total_ports = total_ports,
+                                      node_type_short = "S" if node_type == 'switch' else "H",
+                                      node_guid = int_to_hex_str(node_guid, 16),
+                                      node_name = tree.node_name(node)))
+
+        for port in range(1, total_ports + 1):
+            remote = tree.remote(node, port)
+            if remote is None:
+                continue
+            rem_node, rem_node_port = remote
+            rem_node_type = 'switch' if tree.is_switch(rem_node) else 'hca'
+            lines.append(PORT_LINES[node_type][rem_node_type].format(
+                local_port = port,
+                rem_node_type_short = "S" if rem_node_type == 'switch' else "H",
+                rem_node_guid = int_to_hex_str(tree.node_guid(rem_node), 16),
+                rem_port = rem_node_port,
+                rem_node_name = tree.node_name(rem_node),
+                link_speed = link_speed,
+                rem_port_guid = int_to_hex_str(tree.hca_port_guid(rem_node)) if rem_node_type == 'hca' else None,
+                local_port_guid = node_port_guid))
+
+        lines.append('')
+        yield '\n'.join(lines) + '\n'
+
+################################################
+#################### OUTPUT ####################
+################################################
+
+OUTPUT_BUFFER_SIZE = 1 << 20 # The generated text is collected in chunks of this size before it is written out
+
+class BlockFormatter(object):
+    """
+    Formats the ibnetdiscover block of any node of a Topology.
+
+    The strings that describe a node when it is the remote end of a link
+    (its quoted GUID, its name and the port GUIDs of the HCAs) are
+    formatted only once per node, when the formatter is created. Every block
+    is then put together from these strings with a single join. The strings
+    do not depend on the links, so the same formatter can format the blocks
+    of a topology again after some of its links were changed.
+
+    The produced lines are the same as the ones of the NODE_LINE and
+    PORT_LINES templates.
+    """
+    # The first lines of a block, up to the node line
+    HCA_HEAD = 'vendid=0x0\ndevid=0x0\nsysimgguid={0:#x}\ncaguid={0:#x}\nCa\t{1} {2}\t\t# "{3}"'
+    SWITCH_HEAD = 'vendid=0x0\ndevid=0x0\nsysimgguid={0:#x}\nswitchguid={0:#x}({0:x})\nSwitch\t{1} {2}\t\t# "{3}"'
+    # The text after the remote node of a port line, before the name of the remote node
+    HCA_REMOTE_PREFIX = '\t\t# lid 0 lmc 0 '
+    SWITCH_REMOTE_PREFIX = '\t\t# '
+
+    #----------------------------------------------------------------------
+    def __init__(self, topology, link_speed=DEFAULT_LINK_SPEED):
+        self.topology = topology
+        self.link_speed = link_speed
+        number_of_nodes = topology.number_of_nodes
+        node_type = topology.node_type
+        node_guid = topology.node_guid
+        port_offset = topology.port_offset
+        hca = Topology.HCA
+
+        self.guid_token = ['"{}-{:016x}"'.format('H' if node_type[node] == hca else 'S', node_guid[node]) for node in range(number_of_nodes)]
+        self.name_tail = ['"{}" lid 0 {}'.format(topology.node_name(node), link_speed) for node in range(number_of_nodes)]
+        self.port_guid_text = [''] * topology.number_of_ports
+        for node in range(number_of_nodes):
+            if node_type[node] != hca:
+                continue
+            for index in range(port_offset[node], port_offset[node + 1]):
+                self.port_guid_text[index] = '({:x}) '.format(topology.port_guid[index])
+
+        # Everything block() needs, unpacked at once on every call
+        self._tables = (topology, port_offset, topology.remote_node, topology.remote_port,
+                        self.guid_token, self.name_tail, self.port_guid_text)
+        # The tables of blocks_size(), built on its first call
+        self._sizes = None
+
+    #----------------------------------------------------------------------
+    def block(self, node):
+        """
+        Returns the block of the node, with a line for every connected port
+        """
+        topology, port_offset, remote_node, remote_port, guid_token, name_tail, port_guid_text = self._tables
+
+        first_index = port_offset[node]
+        total_ports = port_offset[node + 1] - first_index
+        if topology.node_type[node] == Topology.HCA:
+            lines = [self.HCA_HEAD.format(topology.node_guid[node], total_ports, guid_token[node], topology.node_name(node))]
+            remote_prefix = self.HCA_REMOTE_PREFIX
+        else:
+            lines = [self.SWITCH_HEAD.format(topology.node_guid[node], total_ports, guid_token[node], topology.node_name(node))]
+            remote_prefix = self.SWITCH_REMOTE_PREFIX
+
+        for index in range(first_index, first_index + total_ports):
+            rem_node = remote_node[index]
+            if rem_node < 0:
+                continue
+            rem_port = remote_port[index]
+            lines.append('[{}]{}\t{}[{}]{}{}{}'.format(index - first_index + 1, port_guid_text[index],
+                                                      guid_token[rem_node], rem_port,
+                                                      port_guid_text[port_offset[rem_node] + rem_port - 1],
+                                                      remote_prefix, name_tail[rem_node]))
+
+        lines.append('\n')
+        return '\n'.join(lines)
+
+    #----------------------------------------------------------------------
+    def _size_tables(self):
+        """
+        Returns the tables of blocks_size(), and builds them on the first call:
+        - the size of every node line, and of the newlines that end the block.
+          GUIDs and port counts are hex and decimal numbers, so only the
+          size of their digits changes from node to node.
+        - the size of the GUID token and of the name of every node, which
+          are both in its node line and in the port lines of its neighbours.
+        - the size of the port GUID of the remote port of every port. Only
+          the HCA ports have port GUIDs, so only their links are visited.
+        - the size of the port numbers.
+        A port that is not connected (remote node -1, remote port 0) is looked
+        up in the sentinels at the ends of the tables.
+        """
+        if self._sizes is None:
+            topology, port_offset, remote_node, remote_port, guid_token, name_tail, port_guid_text = self._tables
+            number_of_nodes = topology.number_of_nodes
+            node_type = topology.node_type
+            hca = Topology.HCA
+
+            empty_tail = len('"" lid 0 {}'.format(self.link_speed))
+            node_size = [len(guid_token[node]) + len(name_tail[node].encode('utf-8')) - empty_tail for node in range(number_of_nodes)]
+            # The number of times the GUID is in the node line, and the size of the line without
+            # the GUIDs, the port count, the GUID token and the name.
+            guids_in_head = {hca: 2, Topology.SWITCH: 3}
+            head_base = {hca: len(self.HCA_HEAD.format(0, 0, '', '')) - 3,
+                         Topology.SWITCH: len(self.SWITCH_HEAD.format(0, 0, '', '')) - 4}
+            head_size = [head_base[node_type[node]] + 2 +
+                         guids_in_head[node_type[node]] * len('{:x}'.format(topology.node_guid[node])) +
+                         len(str(port_offset[node + 1] - port_offset[node])) + node_size[node] for node in range(number_of_nodes)]
+
+            remote_port_guid_size = array('q', [0]) * topology.number_of_ports
+            for index, text in enumerate(port_guid_text):
+                if text and remote_node[index] >= 0:
+                    remote_port_guid_size[port_offset[remote_node[index]] + remote_port[index] - 1] = len(text)
+
+            self._sizes = (head_size,
+                           node_size + [0],
+                           remote_port_guid_size,
+                           [0] + [len(str(port)) for port in range(1, max(remote_port) + 1)])
+        return self._sizes
+
+    #----------------------------------------------------------------------
+    def blocks_size(self, first_node, end_node):
+        """
+        Returns the size in bytes (UTF-8) of the blocks of the active nodes
+        first_node .. end_node - 1, without formatting them.
+
+        Apart from the names, every field of a block has a fixed width (the
+        GUIDs are fixed-width hex) or is a port number, so the size of a
+        port line is the sum of a local part (the port number and GUID) and
+        a remote part (the remote node, port and port GUID). Both are summed
+        over all the ports of the range at once with table lookups.
+        """
+        from itertools import chain, compress
+        from operator import add
+
+        topology, port_offset, remote_node, remote_port, _, _, port_guid_text = self._tables
+        node_type = topology.node_type
+        hca = Topology.HCA
+        head_size, node_size, remote_port_guid_size, port_digits = self._size_tables()
+
+        # The local part of the port lines of a node: "[" port "]" port_guid "\t", the "[",
+        # "]" around the remote port, the text before the remote name, the text after it
+        # and the newline before the line
+        parts_by_kind = {}
+        def local_part(node):
+            key = (node_type[node], port_offset[node + 1] - port_offset[node])
+            part = parts_by_kind.get(key)
+            if part is None:
+                fixed = 6 + len(self.HCA_REMOTE_PREFIX if key[0] == hca else self.SWITCH_REMOTE_PREFIX)
+                fixed += len('"" lid 0 {}'.format(self.link_speed))
+                part = parts_by_kind[key] = [fixed + len(str(port)) for port in range(1, key[1] + 1)]
+            return part
+
+        size = sum(compress(head_size[first_node:end_node], topology.active[first_node:end_node]))
+
+        # The inactive nodes have no links, so all the ports of the range can be summed at once
+        first_index = port_offset[first_node]
+        end_index = port_offset[end_node]
+        rem_nodes = remote_node[first_index:end_index]
+        rem_ports = remote_port[first_index:end_index]
+        local_parts = map(add, chain.from_iterable(map(local_part, range(first_node, end_node))),
+                          map(len, port_guid_text[first_index:end_index]))
+        size += sum(compress(local_parts, map((-1).__ne__, rem_nodes)))
+        size += sum(map(node_size.__getitem__, rem_nodes))
+        size += sum(map(port_digits.__getitem__, rem_ports))
+        size += sum(remote_port_guid_size[first_index:end_index])
+
+        return size
+
+#----------------------------------------------------------------------
+def iter_topology_blocks(topology, link_speed=DEFAULT_LINK_SPEED):
+    """
+    Yields the ibnetdiscover block of every active node of a Topology (see BlockFormatter)
+    """
+    block = BlockFormatter(topology, link_speed).block
+    active = topology.active
+    for node in range(topology.number_of_nodes):
+        if active[node]:
+            yield block(node)
+
+#----------------------------------------------------------------------
+def write_blocks(fileobj, blocks, chunk_size=OUTPUT_BUFFER_SIZE):
+    """
+    Writes the text blocks in fileobj, joining them in chunks of about
+    chunk_size characters so that there is one write call per chunk.
+    """
+    chunk = []
+    chunk_length = 0
+    for block in blocks:
+        chunk.append(block)
+        chunk_length += len(block)
+        if chunk_length >= chunk_size:
+            fileobj.write(''.join(chunk))
+            chunk = []
+            chunk_length = 0
+
+    if chunk:
+        fileobj.write(''.join(chunk))
+
+#----------------------------------------------------------------------
+PARALLEL_RANGES_PER_JOB = 8 # The nodes are split in this many ranges per process, so that the processes finish together
+
+# The BlockFormatter and the output path of the processes of write_ibnetdiscover_parallel()
+_parallel_output = None
+
+def _init_parallel_output(formatter, path):
+    global _parallel_output
+    _parallel_output = (formatter, path)
+
+#----------------------------------------------------------------------
+def _parallel_blocks_size(node_range):
+    return _parallel_output[0].blocks_size(*node_range)
+
+#----------------------------------------------------------------------
+def _parallel_write_blocks(job):
+    """
+    Formats the blocks of a range of nodes and writes them at their offset
+    in the memory-mapped output file
+    """
+    import mmap
+
+    (first_node, end_node), offset, size = job
+    formatter, path = _parallel_output
+    block = formatter.block
+    active = formatter.topology.active
+    data = ''.join([block(node) for node in range(first_node, end_node) if active[node]]).encode('utf-8')
+    if len(data) != size:
+        raise ValueError("The blocks of nodes {} to {} take {} bytes instead of {}".format(first_node, end_node - 1, len(data), size))
+
+    with open(path, 'r+b') as output:
+        mapped = mmap.mmap(output.fileno(), 0)
+        try:
+            mapped[offset:offset + size] = data
+        finally:
+            mapped.close()
+
+#----------------------------------------------------------------------
+def write_ibnetdiscover_parallel(topology, path, jobs=None, timestamp=None, link_speed=DEFAULT_LINK_SPEED):
+    """
+    Writes the topology in the file "path" like write_ibnetdiscover(), with
+    a pool of "jobs" processes (by default one per available core).
+
+    The nodes are split in ranges with about the same number of ports. The
+    processes first work out the size of the blocks of every range (see
+    BlockFormatter.blocks_size()), which gives the offset of every range in
+    the file. The file is then allocated at its full size, and every
+    process formats its ranges and writes them straight at their offsets
+    in the memory-mapped file. The output is byte for byte the same as the
+    one of write_ibnetdiscover().
+
+    The processes are started with fork, so that they inherit the formatter
+    and the topology instead of receiving a pickled copy (the arrays of a
+    topology loaded with load_topology_binary() are memoryviews of the
+    mapped file, which cannot be pickled). Where fork is not available
+    (e.g. on Windows), the blocks are written by the calling process.
+    """
+    from bisect import bisect_left
+    import multiprocessing
+
+    header = (ibnetdiscover_header(topology.tree, timestamp) if topology.tree is not None else '').encode('utf-8')
+    formatter = BlockFormatter(topology, link_speed)
+    # Build the tables of blocks_size() before the processes are started, so that they share them
+    formatter.blocks_size(0, 0)
+
+    if jobs is None:
+        jobs = available_cores()
+    jobs = max(1, jobs)
+    if jobs > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+        LOG.warning("The output processes need the fork start method, which is not available. The topology is written by a single process.")
+        jobs = 1
+    number_of_ranges = jobs * PARALLEL_RANGES_PER_JOB
+    port_offset = topology.port_offset
+    bounds = sorted(set([0, topology.number_of_nodes] +
+                        [bisect_left(port_offset, topology.number_of_ports * part // number_of_ranges, 0, topology.number_of_nodes)
+                         for part in range(1, number_of_ranges)]))
+    node_ranges = list(zip(bounds[:-1], bounds[1:]))
+
+    if jobs == 1:
+        _init_parallel_output(formatter, path)
+        pool = None
+        run = lambda function, items: list(map(function, items))
+    else:
+        pool = multiprocessing.get_context('fork').Pool(processes=jobs, initializer=_init_parallel_output, initargs=(formatter, path))
+        run = lambda function, items: pool.map(function, items, chunksize=1)
+
+    try:
+        sizes = run(_parallel_blocks_size, node_ranges)
+        offsets = [len(header)]
+        for size in sizes:
+            offsets.append(offsets[-1] + size)
+
+        with open(path, 'wb') as output:
+            output.write(header)
+            output.truncate(offsets[-1])
+        run(_parallel_write_blocks, [(node_range, offset, size) for node_range, offset, size in zip(node_ranges, offsets, sizes) if size])
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        else:
+            _init_parallel_output(None, None)
+
+#----------------------------------------------------------------------
+def open_output(path):
+    """
+    Opens the output file with a large buffer. If path is None, the output goes to STDOUT.
+    """
+    if path is None:
+        return sys.stdout
+    try:
+        return open(path, 'w', buffering=OUTPUT_BUFFER_SIZE)
+    except (IOError, OSError) as e:
+        error_and_exit("Cannot open the output file {}: {}".format(path, e.strerror))
+
+################################################
+################## PROFILING ###################
+################################################
+
+class PhaseProfiler(object):
+    """
+    Records the elapsed time, the peak memory and the node/link counts of
+    every phase of a run.
+
+    The peak memory of a phase is the most memory that was in use during
+    the phase (including what the earlier phases left allocated), traced
+    with tracemalloc, which is started with the profiler. The peak of the
+    tracer is reset at the start of every phase, so a phase that peaks
+    below an earlier one still shows its own peak. Tracing the allocations slows the phases down, which is why it
+    is only done when profiling. The high-water mark of the resident set
+    size of the process at the end of the phase is recorded as well.
+    """
+
+    def __init__(self):
+        import tracemalloc
+
+        self.phases = []
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    #----------------------------------------------------------------------
+    @contextlib.contextmanager
+    def phase(self, name, counts=None):
+        """
+        Context manager that records the phase "name" when it exits.
+        counts() is called at the end of the phase, and returns a dictionary
+        with the node and link counts at that point.
+        """
+        import tracemalloc
+
+        tracemalloc.reset_peak()
+        start = time.time()
+        yield
+        elapsed = time.time() - start
+
+        record = {'phase': name, 'time': round(elapsed, 6), 'peak_memory': tracemalloc.get_traced_memory()[1], 'peak_rss': peak_rss()}
+        if counts is not None:
+            record.update(counts())
+        self.phases.append(record)
+
+        LOG.info("Phase {:<15} {:9.4f}s  peak memory {:8.1f} MB{}".format(
+            name, elapsed, record['peak_memory'] / (1024.0 * 1024.0),
+            "  {} nodes, {} links".format(record['nodes'], record['links']) if 'nodes' in record else ''))
+
+    #----------------------------------------------------------------------
+    def report(self, **description):
+        """
+        Returns the recorded phases as a dictionary, ready to be stored as JSON
+        """
+        return {'version': VERSION,
+                'parameters': description,
+                'phases': self.phases,
+                'total_time': round(sum(record['time'] for record in self.phases), 6)}
+
+class _NullProfiler(object):
+    """
+    Stands in for a PhaseProfiler when profiling is off. The phases are not timed or counted.
+    """
+
+    def phase(self, name, counts=None):
+        return _NULL_PHASE
+
+_NULL_PHASE = contextlib.nullcontext()
+NULL_PROFILER = _NullProfiler()
+
+#----------------------------------------------------------------------
+def peak_rss():
+    """
+    Returns the peak resident set size of the process in bytes, or 0 if it is not available
+    """
+    try:
+        import resource
+    except ImportError:
+        return 0
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+################################################
+################# LIBRARY API ##################
+################################################
+
+#----------------------------------------------------------------------
+def init_nodes(topology, tree):
+    """
+    Sets the node GUIDs of all the nodes and the port GUIDs of the HCAs
+    """
+    number_of_sw = tree.number_of_sw
+
+    # Initialize all switches
+    topology.node_guid[0:number_of_sw] = array('Q', range(SW_GUID_BASE, SW_GUID_BASE + number_of_sw))
+
+    # Initialize all Hca's
+    topology.node_guid[number_of_sw:] = array('Q', range(HCA_GUID_BASE, HCA_GUID_BASE + tree.number_of_hca))
+    first_hca_port = topology.port_offset[number_of_sw]
+    topology.port_guid[first_hca_port:] = array('Q', range(PORT_GUID_BASE, PORT_GUID_BASE + tree.number_of_hca))
+
+#----------------------------------------------------------------------
+def wire_hcas(topology, tree):
+    """
+    Connects the HCAs to the leaf switches, in the placement of the tree,
+    and returns the number of HCAs of every leaf (see KAryNTree.hca_leaf()).
+
+    Every HCA takes the next free down port of its leaf, from the free-port
+    index of the leaves, so the HCAs of every leaf are on its first ports.
+    """
+    number_of_sw = tree.number_of_sw
+    leaf_switch = tree.leaf_switch
+    connect = topology.connect
+    free_port = array('H', [tree.k + 1]) * tree.number_of_leaves
+    if tree.placement == 'spread':
+        leaves = [hca_no % tree.number_of_leaves for hca_no in range(tree.number_of_hca)]
+    else:
+        leaves = [hca_no // tree.hca_per_leaf for hca_no in range(tree.number_of_hca)]
+
+    for hca_no, leaf_no in enumerate(leaves):
+        connect(number_of_sw + hca_no, 1, leaf_switch(leaf_no), free_port[leaf_no])
+        free_port[leaf_no] += 1
+
+    return array('H', [port - tree.k - 1 for port in free_port])
+
+#----------------------------------------------------------------------
+def trim_empty_switches(topology, tree, hcas_per_leaf):
+    """
+    Removes the switches that have no HCAs below them, and returns the list
+    of the removed switches. A fully populated tree is left as it is.
+
+    Every switch counts its connected down links, starting from the HCAs of
+    the leaves (see wire_hcas()). The rows are visited bottom-up, and the up
+    links of a switch with no down links are removed, which decrements the
+    counters of its parents, so every link is visited at most once.
+    """
+    k, n, sw_per_row = tree.k, tree.n, tree.sw_per_row
+    rows = tree.number_of_sw // sw_per_row
+    if 0 not in hcas_per_leaf:
+        return []
+
+    # The down links of the switches before the HCAs are connected: k for
+    # every switch, and 2k for the fully connected roots.
+    down_links = array('l', [k]) * tree.number_of_sw
+    if tree.fully_connected_roots:
+        down_links[(n - 1) * sw_per_row:n * sw_per_row] = array('l', [k * 2]) * sw_per_row
+    down_links[0:sw_per_row] = array('l', hcas_per_leaf[:sw_per_row])
+    if tree.fully_connected_roots:
+        down_links[n * sw_per_row:(n + 1) * sw_per_row] = array('l', hcas_per_leaf[sw_per_row:])
+
+    trimmed = []
+    for row in range(rows):
+        # The root switches reach every leaf, so they are never empty.
+        if fat_tree_row(n, row)[0] == n - 1:
+            continue
+        first_sw = row * sw_per_row
+        if 0 not in down_links[first_sw:first_sw + sw_per_row]:
+            continue
+        for sw_no in range(first_sw, first_sw + sw_per_row):
+            if down_links[sw_no]:
+                continue
+            for port in range(1, k + 1):
+                remote = topology.disconnect(sw_no, port)
+                if remote is not None:
+                    down_links[remote[0]] -= 1
+            topology.active[sw_no] = 0
+            trimmed.append(sw_no)
+
+    return trimmed
+
+#----------------------------------------------------------------------
+def build_fat_tree(k, n, oversub=1, fully_connected_roots=False, max_sw_ports=MAX_SW_PORTS, profiler=NULL_PROFILER,
+                   hcas=None, placement='packed'):
+    """
+    Builds a k-ary-n-tree and returns it as a Topology.
+
+    # k: half the number of ports for each switch
+    # n: the number of levels in the tree
+    # oversub: the oversubscription rate. k * oversub HCAs are
+               connected to every leaf switch
+    # fully_connected_roots: connect another k-ary-(n-1)-tree to the empty
+                             ports of the root switches, effectively
+                             doubling the number of nodes in the network
+    # max_sw_ports: the max allowed ports per switch
+    # profiler: a PhaseProfiler that records every phase of the build
+    # hcas: the number of HCAs, if the tree is partially populated
+    # placement: the placement of the HCAs of a partially populated tree
+                 on the leaves, one of HCA_PLACEMENTS (see KAryNTree.hca_leaf())
+
+    Raises ValueError if the tree cannot be built with these parameters.
+    """
+    tree = KAryNTree(k, n, oversub, fully_connected_roots, max_sw_ports, hcas, placement)
+
+    counts = lambda: topology.counts()
+
+    with profiler.phase('init_nodes', counts):
+        topology = Topology(tree.number_of_sw, tree.number_of_hca, tree.ports_per_sw)
+        topology.tree = tree
+        init_nodes(topology, tree)
+
+    # First connect the switches between them, to form the fat tree.
+    with profiler.phase('wire_switches', counts):
+        wire_switches(topology, k, n, fully_connected_roots)
+    # Then connect the HCAs to the leaf switches.
+    with profiler.phase('wire_hcas', counts):
+        hcas_per_leaf = wire_hcas(topology, tree)
+
+    # Delete the switches that have no HCAs below them.
+    # (This will never really delete anything in a complete tree. The failure
+    # variants of iter_failure_variants() prune the nodes they isolate.)
+    with profiler.phase('trim', counts):
+        trim_empty_switches(topology, tree, hcas_per_leaf)
+
+    return topology
+
+#----------------------------------------------------------------------
+def write_ibnetdiscover(topology, fileobj, timestamp=None, link_speed=DEFAULT_LINK_SPEED):
+    """
+    Writes the topology in fileobj in the ibnetdiscover format.
+
+    The description of the tree is written at the top if the topology was
+    built by build_fat_tree(). timestamp replaces the current time in the
+    description (see ibnetdiscover_header()).
+    """
+    if topology.tree is not None:
+        fileobj.write(ibnetdiscover_header(topology.tree, timestamp))
+    write_blocks(fileobj, iter_topology_blocks(topology, link_speed))
+
+#----------------------------------------------------------------------
+def stream_ibnetdiscover(tree, fileobj, timestamp=None, link_speed=DEFAULT_LINK_SPEED):
+    """
+    Writes the KAryNTree in fileobj in the ibnetdiscover format, one node at
+    a time, without building a Topology.
+
+    Raises ValueError if the tree is partially populated.
+    """
+    if tree.partially_populated:
+        raise ValueError("A partially populated tree cannot be streamed, build it instead")
+    fileobj.write(ibnetdiscover_header(tree, timestamp))
+    write_blocks(fileobj, iter_ibnetdiscover_blocks(tree, link_speed))
+
+################################################
+##################### XGFT #####################
+################################################
+
+#----------------------------------------------------------------------
+def _product(values):
+    result = 1
+    for value in values:
+        result *= value
+    return result
+
+#----------------------------------------------------------------------
+def parse_level_list(text):
+    """
+    Parses a list of integers like "16,16,8", one per level, keeping their order
+    """
+    return [int(item) for item in text.split(',')]
+
+class XGFT(object):
+    """
+    The arithmetic of an extended generalized fat tree XGFT(h; m1..mh; w1..wh).
+
+    Level 0 holds the HCAs and the levels 1 .. h the switches. Every node of
+    level i has m_i children in level i - 1 and w_(i+1) parents in level
+    i + 1. A node of level i is labelled with the digits
+    (a_h, .., a_(i+1), b_i, .., b_1), where a_j < m_j and b_j < w_j, and it
+    is connected to the nodes of level i + 1 with the same label, except
+    that a_(i+1) is replaced by any b_(i+1) < w_(i+1).
+
+    The index of a node in its level is its label as a mixed radix integer,
+    with b_1 as the least significant digit. The nodes are numbered like in
+    KAryNTree: the switches level by level starting from the leaves, and
+    then the HCAs. The up ports of a node come first (1 .. w_(i+1)) and its
+    down ports follow, so XGFT(n; k * oversub, k, .., k; 1, k, .., k) is
+    wired like the k-ary-n-tree, except that its root switches have no
+    empty up ports.
+
+    # m: the number of children of the nodes of every level (m1 .. mh)
+    # w: the number of parents of the nodes of every level (w1 .. wh)
+    # max_sw_ports: the max allowed ports per switch, or None for no limit
+    """
+
+    def __init__(self, m, w, max_sw_ports=MAX_SW_PORTS):
+        if not m or len(m) != len(w):
+            raise ValueError("An XGFT needs the same number (the height of the tree) of m and w values")
+        if min(m) < 1 or min(w) < 1:
+            raise ValueError("The m and w values of an XGFT must be positive integers")
+
+        self.h = h = len(m)
+        self.m = tuple(m)
+        self.w = tuple(w)
+
+        # nodes_per_level[i] = m_(i+1) * .. * m_h * w_1 * .. * w_i
+        self.nodes_per_level = [_product(m[level:]) * _product(w[:level]) for level in range(h + 1)]
+        # The up ports (w_(i+1)) and the down ports (m_i) of every level
+        self.up_ports = [w[level] if level < h else 0 for level in range(h + 1)]
+        self.down_ports = [0] + list(m)
+        self.ports_per_level = [up + down for up, down in zip(self.up_ports, self.down_ports)]
+
+        for level in range(1, h + 1):
+            if max_sw_ports is not None and self.ports_per_level[level] > max_sw_ports:
+                raise ValueError("{} ports are needed per switch in level {}, but the"
+                                 " max allowed ports per switch are {}".format(
+                                     self.ports_per_level[level], level, max_sw_ports))
+
+        self.ports_per_sw = max(self.ports_per_level[1:])
+        self.number_of_sw = sum(self.nodes_per_level[1:])
+        self.number_of_hca = self.nodes_per_level[0]
+        self.number_of_nodes = self.number_of_sw + self.number_of_hca
+
+        # The id of the first node of every level
+        self.first_node = [self.number_of_sw] + [sum(self.nodes_per_level[1:level]) for level in range(1, h + 1)]
+
+    #----------------------------------------------------------------------
+    def description(self):
+        """
+        Returns the description of the tree in the header of the output
+        """
+        return "XGFT({}; {}; {})".format(self.h, ','.join(str(value) for value in self.m), ','.join(str(value) for value in self.w))
+
+    #----------------------------------------------------------------------
+    def metrics(self):
+        """
+        Returns the closed forms of the diameter and the up-path diversity of the tree:
+        - the farthest HCAs differ in the highest digit a_j with m_j > 1, so
+          they go up to level j and back.
+        - there are w_1 * .. * w_l shortest paths between two HCAs whose
+          nearest common ancestors are at level l, one through each of them.
+        The bisection width of an XGFT has no simple closed form, and is left out.
+        """
+        levels = [level for level in range(1, self.h + 1) if self.m[level - 1] > 1]
+        return {'diameter': 2 * levels[-1] if levels else 0,
+                'bisection_width': None,
+                'bisection_ratio': None,
+                'up_path_diversity': [_product(self.w[:level]) for level in range(1, self.h + 1)]}
+
+    #----------------------------------------------------------------------
+    def node_level(self, node):
+        """
+        Returns the (level, index in the level) pair of a node
+        """
+        if node >= self.number_of_sw:
+            return 0, node - self.number_of_sw
+        level = self.h
+        while self.first_node[level] > node:
+            level -= 1
+        return level, node - self.first_node[level]
+
+    #----------------------------------------------------------------------
+    def parent(self, level, index, up_port):
+        """
+        Returns the (index, down port) of the node of level + 1 that the up
+        port "up_port" (1 .. w_(level+1)) of a node of "level" connects to.
+        """
+        low_radix = _product(self.w[:level])
+        m = self.m[level]
+        w = self.w[level]
+        high, low = index // (low_radix * m), index % low_radix
+        digit = (index // low_radix) % m
+        return high * low_radix * w + (up_port - 1) * low_radix + low, self.up_ports[level + 1] + 1 + digit
+
+#----------------------------------------------------------------------
+def wire_xgft_level(topology, tree, level):
+    """
+    Connects the nodes of "level" to their parents in level + 1.
+
+    Like in wire_switches(), the parents of the whole level are computed in
+    one batch for every up port, with the closed form of XGFT.parent(), and
+    written in the per-port tables with strided slice assignments. The
+    matching down ports of the upper level are filled the same way, one
+    down port at a time.
+    """
+    low_radix = _product(tree.w[:level])
+    m = tree.m[level]
+    w = tree.w[level]
+    lower_nodes = tree.nodes_per_level[level]
+    upper_nodes = tree.nodes_per_level[level + 1]
+    lower_ports_per_node = tree.ports_per_level[level]
+    upper_ports_per_node = tree.ports_per_level[level + 1]
+    upper_up_ports = tree.up_ports[level + 1]
+
+    lower_first_node = tree.first_node[level]
+    upper_first_node = tree.first_node[level + 1]
+    lower_first_port = topology.port_offset[lower_first_node]
+    upper_first_port = topology.port_offset[upper_first_node]
+
+    # The index of the parent through up port 1 of every node of the level, and the
+    # index of the child through down port 1 of every node of the upper level.
+    # The other ports add a multiple of low_radix to them.
+    first_parent = [(index // (low_radix * m)) * low_radix * w + index % low_radix for index in range(lower_nodes)]
+    first_child = [(index // (low_radix * w)) * low_radix * m + index % low_radix for index in range(upper_nodes)]
+    # The port of the parent: the digit a_(level+1) of every node of the level
+    lower_remote_ports = array('H', [upper_up_ports + 1 + (index // low_radix) % m for index in range(lower_nodes)])
+    # The port of the child: the digit b_(level+1) of every node of the upper level
+    upper_remote_ports = array('H', [1 + (index // low_radix) % w for index in range(upper_nodes)])
+
+    for up_port in range(w):
+        ports = slice(lower_first_port + up_port, lower_first_port + lower_nodes * lower_ports_per_node, lower_ports_per_node)
+        topology.remote_node[ports] = array('l', [upper_first_node + index + up_port * low_radix for index in first_parent])
+        topology.remote_port[ports] = lower_remote_ports
+
+    for down_port in range(m):
+        ports = slice(upper_first_port + upper_up_ports + down_port, upper_first_port + upper_nodes * upper_ports_per_node, upper_ports_per_node)
+        topology.remote_node[ports] = array('l', [lower_first_node + index + down_port * low_radix for index in first_child])
+        topology.remote_port[ports] = upper_remote_ports
+
+#----------------------------------------------------------------------
+def build_xgft(m, w, max_sw_ports=MAX_SW_PORTS, profiler=NULL_PROFILER):
+    """
+    Builds an XGFT(h; m1..mh; w1..wh) and returns it as a Topology, with
+    the same node names and GUIDs as build_fat_tree(). An HCA with more than
+    one port (w1 > 1) gets a port GUID per port.
+
+    # m: the number of children of the nodes of every level (m1 .. mh)
+    # w: the number of parents of the nodes of every level (w1 .. wh)
+    # max_sw_ports: the max allowed ports per switch, or None for no limit
+    # profiler: a PhaseProfiler that records every phase of the build
+
+    Raises ValueError if the tree cannot be built with these parameters.
+    """
+    tree = XGFT(m, w, max_sw_ports)
+
+    counts = lambda: topology.counts()
+
+    with profiler.phase('init_nodes', counts):
+        node_type = array('B', [Topology.SWITCH]) * tree.number_of_sw + array('B', [Topology.HCA]) * tree.number_of_hca
+        total_ports = array('H')
+        for level in list(range(1, tree.h + 1)) + [0]:
+            total_ports += array('H', [tree.ports_per_level[level]]) * tree.nodes_per_level[level]
+        topology = Topology.from_port_counts(node_type, total_ports)
+        topology.tree = tree
+
+        number_of_sw = tree.number_of_sw
+        topology.node_guid[0:number_of_sw] = array('Q', range(SW_GUID_BASE, SW_GUID_BASE + number_of_sw))
+        topology.node_guid[number_of_sw:] = array('Q', range(HCA_GUID_BASE, HCA_GUID_BASE + tree.number_of_hca))
+        first_hca_port = topology.port_offset[number_of_sw]
+        topology.port_guid[first_hca_port:] = array('Q', range(PORT_GUID_BASE, PORT_GUID_BASE + topology.number_of_ports - first_hca_port))
+
+    with profiler.phase('wire_switches', counts):
+        for level in range(1, tree.h):
+            wire_xgft_level(topology, tree, level)
+    with profiler.phase('wire_hcas', counts):
+        wire_xgft_level(topology, tree, 0)
+
+    with profiler.phase('prune', counts):
+        topology.prune_unconnected_nodes()
+
+    return topology
+
+################################################
+################### PARSING ####################
+################################################
+
+# One match per node line or port line of an ibnetdiscover file:
+#    Switch	6 "S-0000000003000000"		# "Switch0" ...
+#    Ca	1 "H-0000000001000000"		# "Hca0"
+#    [1]	"S-0000000003000009"[4]		# "Switch9" lid 0 4xEDR
+#    [1](2000000) 	"S-0000000003000000"[4]		# lid 0 lmc 0 "Switch0" lid 0 4xEDR
+# The vendid/devid/sysimgguid/switchguid/caguid lines are not needed, the
+# node GUID is also in the node line. Matching the newline before the line
+# (instead of ^ in multiline mode) is much faster, and a node line is always
+# preceded by the vendid/devid lines anyway.
+_IBNETDISCOVER_LINE = (
+    br'\n(?:(Switch|Ca|Rt)\s+(\d+)\s+"[SHR]-([0-9a-fA-F]+)"[^#\n]*#\s*"([^"\n]*)"'
+    br'|\[(\d+)\](?:\(([0-9a-fA-F]+)\))?\s*"[SHR]-([0-9a-fA-F]+)"\[(\d+)\])')
+
+# The description of the tree that FatTreeBuilder writes at the top of the file
+_TREE_DESCRIPTION = br'^# k = (\d+), n = (\d+), oversubscription = (\d+)(, Fully populated)?(?:, (\d+) HCAs \((\w+)\))?$'
+_XGFT_DESCRIPTION = br'^# XGFT\((\d+); ([\d,]+); ([\d,]+)\)$'
+
+#----------------------------------------------------------------------
+def parse_ibnetdiscover(path):
+    """
+    Loads an ibnetdiscover file in a Topology.
+
+    The file is memory-mapped and read in a single pass. The node lines and
+    the port lines are collected in flat arrays, and the remote GUIDs are
+    resolved to node ids once all the nodes are known. Besides the files
+    written by FatTreeBuilder, real ibnetdiscover dumps can be loaded:
+    everything after the "#" of a node line but the node name is ignored,
+    and the ports of routers are skipped.
+
+    If the file starts with the description written by FatTreeBuilder, the
+    matching KAryNTree or XGFT is set as the tree of the topology.
+
+    Raises ValueError if the file does not contain any node.
+    """
+    import mmap
+    import re
+
+    node_type = array('B')
+    node_guid = array('Q')
+    total_ports = array('H')
+    names = []
+
+    line_node = array('l')
+    line_port = array('H')
+    line_port_guid = array('Q')
+    line_remote_guid = array('Q')
+    line_remote_port = array('H')
+
+    with open(path, 'rb') as topology_file:
+        try:
+            data = mmap.mmap(topology_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise ValueError("{} is empty".format(path))
+
+        add_line_node = line_node.append
+        add_line_port = line_port.append
+        add_line_port_guid = line_port_guid.append
+        add_line_remote_guid = line_remote_guid.append
+        add_line_remote_port = line_remote_port.append
+
+        try:
+            node = -1
+            for match in re.finditer(_IBNETDISCOVER_LINE, data):
+                kind, ports, guid, name, port, port_guid, remote_guid, remote_port = match.groups()
+                if kind is None:
+                    if node >= 0:
+                        add_line_node(node)
+                        add_line_port(int(port))
+                        add_line_port_guid(int(port_guid, 16) if port_guid else 0)
+                        add_line_remote_guid(int(remote_guid, 16))
+                        add_line_remote_port(int(remote_port))
+                elif kind == b'Rt':
+                    node = -1
+                else:
+                    node = len(node_type)
+                    node_type.append(Topology.SWITCH if kind == b'Switch' else Topology.HCA)
+                    node_guid.append(int(guid, 16))
+                    total_ports.append(int(ports))
+                    names.append(name.decode('utf-8', 'replace'))
+
+            header = data[:4096]
+        finally:
+            data.close()
+
+    if not node_type:
+        raise ValueError("No nodes were found in {}".format(path))
+
+    topology = Topology.from_port_counts(node_type, total_ports)
+    topology.node_guid = node_guid
+    topology.names = names
+
+    guid_to_node = dict(zip(node_guid, range(len(node_guid))))
+    port_offset = topology.port_offset
+    remote_node = topology.remote_node
+    unresolved = 0
+    for line, node in enumerate(line_node):
+        index = port_offset[node] + line_port[line] - 1
+        topology.port_guid[index] = line_port_guid[line]
+        rem_node = guid_to_node.get(line_remote_guid[line], -1)
+        if rem_node < 0:
+            unresolved += 1
+            continue
+        remote_node[index] = rem_node
+        topology.remote_port[index] = line_remote_port[line]
+
+    if unresolved:
+        LOG.warning("{} ports of {} are connected to nodes that are not in the file".format(unresolved, path))
+
+    tree = tree_from_header(header, topology, path)
+    if tree is not None and topology.number_of_sw != tree.number_of_sw:
+        # The file of a partially populated tree leaves out the trimmed switches
+        restored = restore_trimmed_switches(topology, tree)
+        if restored is None:
+            LOG.warning("The switches of {} are not named after the switches in use of \"{}\". The description is ignored, "
+                        "so the structure of the tree cannot be validated".format(path, tree.description()))
+            tree = None
+        else:
+            topology = restored
+    topology.tree = tree
+
+    return topology
+
+#----------------------------------------------------------------------
+def tree_from_header(header, topology, source):
+    """
+    Returns the KAryNTree or XGFT of the description that FatTreeBuilder
+    writes at the top of its files (see ibnetdiscover_header()), if header
+    (bytes) contains one with the switch and HCA counts of the topology.
+    The switches of a partially populated tree may be all the switches of
+    the tree, or only the switches in use (see restore_trimmed_switches()).
+    Otherwise returns None, and if there is a description, logs a warning
+    that the structure of the tree of "source" (the file name) cannot be
+    validated.
+    """
+    import re
+
+    description = re.search(_TREE_DESCRIPTION, header, re.M)
+    xgft_description = re.search(_XGFT_DESCRIPTION, header, re.M)
+    tree = None
+    try:
+        if description is not None:
+            k, n, oversub = [int(value) for value in description.group(1, 2, 3)]
+            hcas, placement = description.group(5, 6)
+            tree = KAryNTree(k, n, oversub, description.group(4) is not None, max_sw_ports=None,
+                             hcas=int(hcas) if hcas else None, placement=placement.decode() if placement else 'packed')
+        elif xgft_description is not None:
+            tree = XGFT([int(value) for value in xgft_description.group(2).split(b',')],
+                        [int(value) for value in xgft_description.group(3).split(b',')], max_sw_ports=None)
+    except ValueError as e:
+        LOG.warning("The description at the top of {} is not valid ({}). It is ignored, "
+                    "so the structure of the tree cannot be validated".format(source, e))
+        return None
+    if tree is None:
+        return None
+    if tree.number_of_hca == topology.number_of_hca:
+        if topology.number_of_sw == tree.number_of_sw:
+            return tree
+        if isinstance(tree, KAryNTree) and topology.number_of_sw == tree.switches_in_use():
+            return tree
+
+    LOG.warning("{} has {} switches and {} HCAs, which do not match its description \"{}\". The description is ignored, "
+                "so the structure of the tree cannot be validated".format(
+                    source, topology.number_of_sw, topology.number_of_hca, tree.description()))
+    return None
+
+#----------------------------------------------------------------------
+def restore_trimmed_switches(topology, tree):
+    """
+    Returns the topology parsed from the file of a partially populated
+    KAryNTree, which only has the switches in use, with the node ids of the
+    tree: every switch gets back the id of its Switch<id> name, and the
+    trimmed switches are put back inactive and without links, like in
+    build_fat_tree(). The HCAs follow in the order of the file.
+
+    Returns None if the switches are not named after the switches in use of
+    the tree.
+    """
+    import re
+
+    switch_name = re.compile(r'Switch(\d+)$')
+    number_of_sw = tree.number_of_sw
+    new_node = array('l', [-1]) * topology.number_of_nodes
+    old_node = array('l', [-1]) * tree.number_of_nodes
+    hca_no = 0
+    for node in range(topology.number_of_nodes):
+        if topology.is_switch(node):
+            match = switch_name.match(topology.node_name(node))
+            if match is None:
+                return None
+            sw = int(match.group(1))
+            if sw >= number_of_sw or old_node[sw] >= 0 or not tree.switch_in_use(sw):
+                return None
+            new_node[node] = sw
+        else:
+            new_node[node] = number_of_sw + hca_no
+            hca_no += 1
+        old_node[new_node[node]] = node
+
+    total_ports = array('H', [tree.ports_per_sw]) * number_of_sw + array('H', [1]) * tree.number_of_hca
+    for node in range(topology.number_of_nodes):
+        total_ports[new_node[node]] = topology.total_ports(node)
+    restored = Topology.from_port_counts(array('B', [Topology.SWITCH]) * number_of_sw + array('B', [Topology.HCA]) * tree.number_of_hca,
+                                         total_ports)
+    restored.names = [tree.node_name(node) for node in range(tree.number_of_nodes)]
+
+    for node in range(tree.number_of_nodes):
+        old = old_node[node]
+        if old < 0:
+            restored.node_guid[node] = tree.node_guid(node)
+            restored.active[node] = 0
+            continue
+        restored.node_guid[node] = topology.node_guid[old]
+        restored.names[node] = topology.names[old]
+        ports = slice(topology.port_offset[old], topology.port_offset[old + 1])
+        restored_ports = slice(restored.port_offset[node], restored.port_offset[node + 1])
+        restored.port_guid[restored_ports] = topology.port_guid[ports]
+        restored.remote_node[restored_ports] = array('l', [new_node[rem_node] if rem_node >= 0 else -1
+                                                           for rem_node in topology.remote_node[ports]])
+        restored.remote_port[restored_ports] = topology.remote_port[ports]
+
+    return restored
+
+################################################
+################ BINARY FORMAT #################
+################################################
+
+BINARY_MAGIC = b'FTBTOPO\0'
+BINARY_VERSION = 1
+
+# The arrays of a binary topology file, in the order they are stored, with
+# the struct format of their items. They are stored little endian, every
+# array at an offset that is a multiple of 8.
+BINARY_ARRAYS = [('node_type', 'B'),
+                 ('node_guid', 'Q'),
+                 ('active', 'B'),
+                 ('port_offset', 'Q'),
+                 ('port_guid', 'Q'),
+                 ('remote_node', 'q'),
+                 ('remote_port', 'H')]
+
+# magic, version, unused, offset and size of the JSON metadata
+_BINARY_HEADER = '<8sIIQQ'
+
+#----------------------------------------------------------------------
+def _binary_array(values, code):
+    """
+    Returns the values as a buffer of little endian items of format "code",
+    without a copy if they already are.
+    """
+    if sys.byteorder == 'little' and getattr(values, 'typecode', getattr(values, 'format', None)) == code:
+        return values
+    values = array(code, values)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+#----------------------------------------------------------------------
+def write_topology_binary(topology, fileobj):
+    """
+    Writes the topology in fileobj (opened in binary mode) in the binary
+    format of load_topology_binary(): a fixed header, the arrays of
+    BINARY_ARRAYS and the JSON metadata, with the node counts, the names of
+    the nodes (if they are not generated), the description of the tree (if
+    any) and the format, offset and number of items of every array.
+    """
+    import json
+    import struct
+
+    offset = struct.calcsize(_BINARY_HEADER)
+    arrays = {}
+    buffers = []
+    for name, code in BINARY_ARRAYS:
+        values = _binary_array(getattr(topology, name), code)
+        offset += -offset % 8
+        arrays[name] = {'format': code, 'offset': offset, 'count': len(values)}
+        buffers.append((offset, values))
+        offset += len(values) * struct.calcsize(code)
+
+    metadata = json.dumps({'generator': '{} v{}'.format(PROGRAM_NAME, VERSION),
+                           'number_of_sw': topology.number_of_sw,
+                           'ports_per_sw': topology.ports_per_sw,
+                           'description': '# ' + topology.tree.description() if topology.tree is not None else None,
+                           'names': topology.names,
+                           'arrays': arrays}, sort_keys=True).encode('utf-8')
+
+    fileobj.write(struct.pack(_BINARY_HEADER, BINARY_MAGIC, BINARY_VERSION, 0, offset, len(metadata)))
+    position = struct.calcsize(_BINARY_HEADER)
+    for array_offset, values in buffers:
+        fileobj.write(b'\0' * (array_offset - position))
+        fileobj.write(values)
+        position = array_offset + len(values) * values.itemsize
+    fileobj.write(metadata)
+
+#----------------------------------------------------------------------
+def is_topology_binary(path):
+    """
+    Returns True if the file starts like a binary topology file
+    """
+    with open(path, 'rb') as topology_file:
+        return topology_file.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+#----------------------------------------------------------------------
+def load_topology_binary(path, copy=False):
+    """
+    Loads a topology written by write_topology_binary().
+
+    The file is memory-mapped, and the arrays of the topology are read-only
+    memoryviews of the file, so nothing is copied or parsed, whatever the
+    size of the fabric (on big endian machines the arrays are copied and
+    byte swapped). The topology can be written out, for example with
+    write_ibnetdiscover(), but not changed. If copy is True, every array is
+    copied in a writable array instead, with a single memory copy, so that
+    the topology can also be changed or validated.
+
+    Raises ValueError if the file is not a binary topology file, or was
+    written by a newer version of the format.
+    """
+    import json
+    import mmap
+    import struct
+
+    with open(path, 'rb') as topology_file:
+        try:
+            data = mmap.mmap(topology_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise ValueError("{} is empty".format(path))
+
+    header_size = struct.calcsize(_BINARY_HEADER)
+    if len(data) < header_size:
+        raise ValueError("{} is not a binary topology file".format(path))
+    magic, version, _, metadata_offset, metadata_size = struct.unpack(_BINARY_HEADER, data[:header_size])
+    if magic != BINARY_MAGIC:
+        raise ValueError("{} is not a binary topology file".format(path))
+    if version > BINARY_VERSION:
+        raise ValueError("{} is in version {} of the binary format, this version of {} reads up to version {}".format(
+            path, version, PROGRAM_NAME, BINARY_VERSION))
+    metadata = json.loads(data[metadata_offset:metadata_offset + metadata_size].decode('utf-8'))
+
+    view = memoryview(data)
+    topology = Topology.__new__(Topology)
+    for name, code in BINARY_ARRAYS:
+        entry = metadata['arrays'][name]
+        if entry['format'] != code:
+            raise ValueError("The {} array of {} has items of format {} instead of {}".format(name, path, entry['format'], code))
+        values = view[entry['offset']:entry['offset'] + entry['count'] * struct.calcsize(code)]
+        if sys.byteorder == 'little' and not copy:
+            values = values.cast(code)
+        else:
+            copied = array(code)
+            copied.frombytes(values)
+            if sys.byteorder != 'little':
+                copied.byteswap()
+            values = copied
+        setattr(topology, name, values)
+
+    topology.number_of_nodes = len(topology.node_type)
+    topology.number_of_sw = metadata['number_of_sw']
+    topology.number_of_hca = topology.number_of_nodes - topology.number_of_sw
+    topology.number_of_ports = len(topology.port_guid)
+    topology.ports_per_sw = metadata['ports_per_sw']
+    topology.names = metadata['names']
+    topology.tree = tree_from_header(metadata['description'].encode('utf-8'), topology, path) if metadata['description'] else None
+
+    return topology
+
+#----------------------------------------------------------------------
+def write_binary_output(topology, path):
+    """
+    Writes the topology in the binary file "path", or exits with an error
+    """
+    try:
+        with open(path, 'wb') as binary_file:
+            write_topology_binary(topology, binary_file)
+    except (IOError, OSError) as e:
+        error_and_exit("Cannot write the binary topology in {}: {}".format(path, e.strerror))
+    LOG.info("The binary topology was written in {}\n".format(path))
+
+################################################
+################## DOT EXPORT ##################
+################################################
+
+DOT_DETAILS = ['full', 'hcas', 'subtrees']
+
+#----------------------------------------------------------------------
+def parse_dot_detail(text):
+    """
+    Parses a level of detail like "subtrees:2" in a (detail, depth) tuple.
+
+    The depth of "subtrees" is the number of switch levels of every
+    collapsed sub-tree. "full" and "hcas" take no argument.
+    """
+    detail, _, depth = text.partition(':')
+    if detail not in DOT_DETAILS:
+        raise ValueError("Unknown level of detail '{}'. Choose one of: {}".format(detail, ', '.join(DOT_DETAILS)))
+    if detail != 'subtrees':
+        if depth:
+            raise ValueError("The level of detail '{}' takes no argument".format(detail))
+        return detail, None
+    try:
+        return detail, int(depth)
+    except ValueError:
+        raise ValueError("The level of detail 'subtrees' needs the number of levels of the sub-trees, like subtrees:2")
+
+#----------------------------------------------------------------------
+def dot_ranks(topology):
+    """
+    Returns the Graphviz rank of every node, or None if the topology was not
+    built from a KAryNTree or an XGFT.
+
+    The ranks of a k-ary-n-tree are taken from its rows of sw_per_row
+    switches: the HCAs of the first subtree are at rank 0 and its switches
+    of level l at rank l + 1, up to the roots at rank n. The second subtree
+    of the fully connected roots is mirrored above the roots, with its HCAs
+    at rank 2n. The ranks of an XGFT are the levels of its nodes.
+    """
+    tree = topology.tree
+    if isinstance(tree, XGFT):
+        return array('l', [tree.node_level(node)[0] for node in range(topology.number_of_nodes)])
+    if not isinstance(tree, KAryNTree):
+        return None
+
+    n = tree.n
+    sw_per_row = tree.sw_per_row
+    ranks = array('l', [0]) * topology.number_of_nodes
+    for row in range(tree.number_of_sw // sw_per_row):
+        level, second_subtree = fat_tree_row(n, row)
+        rank = 2 * n - 1 - level if second_subtree else level + 1
+        ranks[row * sw_per_row:(row + 1) * sw_per_row] = array('l', [rank]) * sw_per_row
+    # Every HCA goes next to the leaves of its subtree
+    for hca in range(tree.number_of_sw, topology.number_of_nodes):
+        leaf = topology.remote_node[topology.port_offset[hca]]
+        if leaf >= 0 and fat_tree_row(n, leaf // sw_per_row)[1]:
+            ranks[hca] = 2 * n
+    return ranks
+
+#----------------------------------------------------------------------
+def _dot_node_line(dot_id, label, is_switch):
+    return '    {} [label="{}"{}];\n'.format(dot_id, label, '' if is_switch else ', shape=ellipse')
+
+#----------------------------------------------------------------------
+def _iter_dot_full(topology, ranks):
+    """
+    Yields the nodes and the links of every active node of the topology
+    """
+    active = topology.active
+    port_offset = topology.port_offset
+    remote_node = topology.remote_node
+    remote_port = topology.remote_port
+
+    if ranks is None:
+        rows = [[node for node in range(topology.number_of_nodes) if active[node]]]
+    else:
+        by_rank = {}
+        for node in range(topology.number_of_nodes):
+            if active[node]:
+                by_rank.setdefault(ranks[node], []).append(node)
+        rows = [by_rank[rank] for rank in sorted(by_rank)]
+    for row in rows:
+        yield '  {\n' if ranks is None else '  { rank=same;\n'
+        for node in row:
+            yield _dot_node_line('n{}'.format(node), topology.node_name(node), topology.is_switch(node))
+        yield '  }\n'
+
+    # Every link once, from its end with the lower rank
+    for node in range(topology.number_of_nodes):
+        if not active[node]:
+            continue
+        first_index = port_offset[node]
+        for index in range(first_index, port_offset[node + 1]):
+            rem_node = remote_node[index]
+            if rem_node < node or (rem_node == node and remote_port[index] < index - first_index + 1):
+                continue
+            if ranks is not None and ranks[rem_node] < ranks[node]:
+                yield '  n{} -- n{};\n'.format(rem_node, node)
+            else:
+                yield '  n{} -- n{};\n'.format(node, rem_node)
+
+#----------------------------------------------------------------------
+def _iter_dot_collapsed(topology, ranks, detail, depth):
+    """
+    Yields the aggregate nodes of a KAryNTree topology and the number of
+    links between them.
+
+    With "hcas", the HCAs of every leaf switch are one node. With
+    "subtrees", the switches of the levels below "depth" that share the
+    base-k digits depth .. n-2 of their index form a sub-tree, which is one
+    node with its HCAs. The rows above are collapsed along the same digits,
+    so every row has sw_per_row / k**depth aggregate nodes, and the links
+    inside an aggregate node are left out.
+    """
+    tree = topology.tree
+    n = tree.n
+    sw_per_row = tree.sw_per_row
+    number_of_sw = tree.number_of_sw
+    group_size = tree.k**depth if detail == 'subtrees' else 1
+    active = topology.active
+    port_offset = topology.port_offset
+    remote_node = topology.remote_node
+
+    # The aggregate node of every node: a key, and for every key the number
+    # of switches and HCAs, the first and the last switch and the rank
+    group_of = [None] * topology.number_of_nodes
+    groups = {}
+    for node in range(topology.number_of_nodes):
+        if not active[node]:
+            continue
+        if node < number_of_sw:
+            row = node // sw_per_row
+            level, second_subtree = fat_tree_row(n, row)
+            index = (node - row * sw_per_row) // group_size
+            if detail == 'hcas':
+                key = ('switch', node)
+            elif level < depth:
+                key = ('subtree', second_subtree, index)
+            else:
+                key = ('row', row, index)
+        else:
+            leaf = remote_node[port_offset[node]]
+            if leaf < 0:
+                continue
+            row = leaf // sw_per_row
+            level, second_subtree = fat_tree_row(n, row)
+            if detail == 'hcas':
+                key = ('hcas', leaf)
+            else:
+                key = ('subtree', second_subtree, (leaf - row * sw_per_row) // group_size)
+        group_of[node] = key
+
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = {'id': 'g{}'.format(len(groups)), 'switches': 0, 'hcas': 0, 'first': node, 'last': node,
+                                   'rank': ranks[node]}
+        if node < number_of_sw:
+            group['switches'] += 1
+            group['last'] = node
+            if key[0] == 'subtree':
+                # A sub-tree goes at the rank of its leaves
+                group['rank'] = max(group['rank'], ranks[node]) if key[1] else min(group['rank'], ranks[node])
+        else:
+            group['hcas'] += 1
+
+    links = {}
+    for node in range(number_of_sw):
+        if group_of[node] is None:
+            continue
+        for index in range(port_offset[node], port_offset[node + 1]):
+            rem_node = remote_node[index]
+            if rem_node < 0 or group_of[rem_node] is None or group_of[rem_node] == group_of[node]:
+                continue
+            # The links between switches are seen from both ends, the links to the HCAs from the leaf only
+            if rem_node < number_of_sw and rem_node < node:
+                continue
+            ends = (groups[group_of[node]], groups[group_of[rem_node]])
+            if ends[1]['rank'] < ends[0]['rank']:
+                ends = ends[::-1]
+            pair = (ends[0]['id'], ends[1]['id'])
+            links[pair] = links.get(pair, 0) + 1
+
+    name = topology.node_name
+    by_rank = {}
+    for key, group in groups.items():
+        if key[0] == 'switch':
+            label = name(key[1])
+        elif key[0] == 'hcas':
+            label = '{} HCAs'.format(group['hcas'])
+        elif key[0] == 'row':
+            label = '{} - {}\\n{} switches'.format(name(group['first']), name(group['last']), group['switches'])
+        else:
+            label = 'Sub-tree {}{}\\n{} switches, {} HCAs'.format(key[2], ' (second)' if key[1] else '', group['switches'], group['hcas'])
+        by_rank.setdefault(group['rank'], []).append((group['id'], label, group['switches'] > 0))
+
+    for rank in sorted(by_rank):
+        yield '  { rank=same;\n'
+        for dot_id, label, is_switch in sorted(by_rank[rank], key=lambda entry: int(entry[0][1:])):
+            yield _dot_node_line(dot_id, label, is_switch)
+        yield '  }\n'
+    for (tail, head), count in sorted(links.items(), key=lambda item: (int(item[0][0][1:]), int(item[0][1][1:]))):
+        yield '  {} -- {} [label="{}", penwidth={:.1f}];\n'.format(tail, head, count, 1 + min(count, 10000)**0.25)
+
+#----------------------------------------------------------------------
+def iter_dot_lines(topology, detail='full', depth=None):
+    """
+    Yields the text of a Graphviz DOT graph of the topology, a few lines at
+    a time, with the nodes of every level of the fat-tree at the same rank
+    (see dot_ranks()).
+
+    # detail: "full" writes every node and every link. "hcas" collapses
+              the HCAs of every leaf switch in one node, and "subtrees"
+              collapses the sub-trees of "depth" levels of switches (see
+              _iter_dot_collapsed()), with the number of links on every
+              edge, so that even the largest trees can be laid out.
+
+    Raises ValueError if the topology cannot be collapsed: only the
+    k-ary-n-trees can be, and depth must be 1 .. n-1.
+    """
+    tree = topology.tree
+    if detail != 'full':
+        if not isinstance(tree, KAryNTree):
+            raise ValueError("Only the k-ary-n-trees can be collapsed, use the full level of detail")
+        if detail == 'subtrees' and not 1 <= depth <= tree.n - 1:
+            raise ValueError("The sub-trees of a {}-ary-{}-tree have 1 to {} levels, not {}".format(tree.k, tree.n, tree.n - 1, depth))
+
+    ranks = dot_ranks(topology)
+    yield 'graph "{}" {{\n'.format(tree.description() if tree is not None else 'fabric')
+    yield '  graph [rankdir=BT, ranksep=1.5, splines=false, outputorder=edgesfirst];\n'
+    yield '  node [shape=box, fontsize=10];\n'
+    if detail == 'full':
+        for line in _iter_dot_full(topology, ranks):
+            yield line
+    else:
+        for line in _iter_dot_collapsed(topology, ranks, detail, depth):
+            yield line
+    yield '}\n'
+
+#----------------------------------------------------------------------
+def write_dot(topology, fileobj, detail='full', depth=None):
+    """
+    Writes the DOT graph of iter_dot_lines() in fileobj
+    """
+    write_blocks(fileobj, iter_dot_lines(topology, detail, depth))
+
+################################################
+################### ROUTING ####################
+################################################
+
+OSM_NO_PATH = 255 # The LFT entry of a destination that cannot be reached (like in OpenSM)
+MAX_UNICAST_LID = 0xBFFF
+MAX_LFT_PORT = OSM_NO_PATH - 1
+
+#----------------------------------------------------------------------
+def node_lid(node):
+    """
+    Returns the LID of a node. The LIDs are assigned in node order, starting from 1.
+    Use write_guid2lid() to make OpenSM assign the same LIDs.
+    """
+    return node + 1
+
+#----------------------------------------------------------------------
+def _repeat_runs(values, run_length, total_length):
+    """
+    Returns a bytes object of total_length, made of "values" repeated, with every value repeated run_length times
+    """
+    period = b''.join(bytes([value]) * run_length for value in values)
+    return (period * (total_length // len(period) + 1))[:total_length]
+
+#----------------------------------------------------------------------
+def iter_lfts(tree):
+    """
+    Yields the (switch, lft) pairs of every switch of a KAryNTree, where
+    lft[lid] is the output port towards "lid" (0 for the switch itself,
+    OSM_NO_PATH for the unreachable LIDs and for LID 0).
+
+    The routing is up*/down* with D-mod-K selection of the up ports:
+    - towards an HCA h, a switch of level l that is not an ancestor of h goes
+      up through port ((h // k**l) % k) + 1. All the routes towards h meet at
+      the same switches, and go down the same path.
+    - towards a switch D, the up ports follow the base-k digits of the index
+      of D. A switch is only reachable if it can be reached by going up and
+      then down, like in OpenSM's ftree. For example, the root switches
+      cannot reach each other.
+
+    The LFTs are not computed per destination. In every row of switches and
+    in the HCAs, the ports only depend on a few base-k digits of the index of
+    the destination, so every LFT is put together from a few precomputed
+    byte patterns with (strided) slice assignments.
+    """
+    check_fully_populated(tree)
+    check_port_space(tree)
+
+    k = tree.k
+    n = tree.n
+    sw_per_row = tree.sw_per_row
+    hca_per_leaf = tree.hca_per_leaf
+    number_of_sw = tree.number_of_sw
+    number_of_hca = tree.number_of_hca
+    rows = number_of_sw // sw_per_row
+    root_level = n - 1
+
+    # Patterns over the switches of a row, with the port of every switch index j:
+    #   up_sw[l]:   the up port of a switch of level l, the digit l of j
+    #   down_sw[l]: the down port of a switch of level l, the digit l - 1 of j
+    #   down_sw_second_subtree: the down port of a root switch into the second subtree
+    up_sw = [_repeat_runs(range(1, k + 1), k**level, sw_per_row) for level in range(root_level)]
+    down_sw = [None] + [_repeat_runs(range(k + 1, 2 * k + 1), k**(level - 1), sw_per_row) for level in range(1, n)]
+    down_sw_second_subtree = _repeat_runs(range(1, k + 1), k**(n - 2), sw_per_row) if n > 1 else None
+
+    # The same patterns over the HCAs. down_hca[l] covers the HCAs below one switch of level l.
+    up_hca = [_repeat_runs(range(1, k + 1), k**level, number_of_hca) for level in range(root_level)]
+    down_hca = [bytes(range(k + 1, k + 1 + hca_per_leaf))]
+    down_hca += [_repeat_runs(range(k + 1, 2 * k + 1), k**(level - 1) * hca_per_leaf, k**level * hca_per_leaf) for level in range(1, n)]
+    if tree.fully_connected_roots:
+        down_hca_second_subtree = _repeat_runs(range(1, k + 1), k**(n - 2) * hca_per_leaf, sw_per_row * hca_per_leaf)
+
+    unreachable_row = bytes([OSM_NO_PATH]) * sw_per_row
+
+    for sw in range(number_of_sw):
+        row = sw // sw_per_row
+        level, second_subtree = fat_tree_row(n, row)
+        sw_index = sw - row * sw_per_row
+
+        lft = bytearray([OSM_NO_PATH]) * (1 + tree.number_of_nodes)
+
+        # Switch destinations, one row at a time
+        for dest_row in range(rows):
+            dest_level, dest_second_subtree = fat_tree_row(n, dest_row)
+            row_lft = bytearray(unreachable_row)
+
+            # Only the switches with the same low digits as this switch can be
+            # reached, because going up does not change the low digits.
+            step = k**min(level, dest_level)
+            first = sw_index % step
+            if level < root_level:
+                row_lft[first::step] = up_sw[level][first::step]
+
+            # The destinations below this switch are reached by going down
+            if level >= dest_level and (level == root_level or second_subtree == dest_second_subtree):
+                block = k**level
+                block_start = (sw_index // block) * block
+                step = k**dest_level
+                first = block_start + sw_index % step
+                if level == dest_level:
+                    row_lft[sw_index] = 0
+                else:
+                    down = down_sw_second_subtree if (level == root_level and dest_second_subtree) else down_sw[level]
+                    row_lft[first:block_start + block:step] = down[first:block_start + block:step]
+
+            lft[1 + dest_row * sw_per_row:1 + (dest_row + 1) * sw_per_row] = row_lft
+
+        # HCA destinations
+        first_hca_lid = 1 + number_of_sw
+        if level < root_level:
+            lft[first_hca_lid:] = up_hca[level]
+            block = k**level * hca_per_leaf
+            first_hca = ((second_subtree * sw_per_row + sw_index) // k**level) * block
+            lft[first_hca_lid + first_hca:first_hca_lid + first_hca + block] = down_hca[level]
+        else:
+            lft[first_hca_lid:first_hca_lid + sw_per_row * hca_per_leaf] = down_hca[level]
+            if tree.fully_connected_roots:
+                lft[first_hca_lid + sw_per_row * hca_per_leaf:] = down_hca_second_subtree
+
+        yield sw, lft
+
+#----------------------------------------------------------------------
+def check_fully_populated(tree):
+    """
+    Raises ValueError if the tree is partially populated, or its HCAs are
+    not packed. The routing and the traffic analysis rely on the HCAs
+    filling every leaf in order.
+    """
+    if tree.partially_populated or tree.placement != 'packed':
+        raise ValueError("The routing tables and the traffic analysis need a fully populated tree with packed HCAs")
+
+#----------------------------------------------------------------------
+def check_lid_space(tree):
+    """
+    Raises ValueError if the nodes of the tree do not fit in the unicast LID space
+    """
+    if node_lid(tree.number_of_nodes - 1) > MAX_UNICAST_LID:
+        raise ValueError("{} nodes do not fit in the {} unicast LIDs".format(tree.number_of_nodes, MAX_UNICAST_LID))
+
+#----------------------------------------------------------------------
+def check_port_space(tree):
+    """
+    Raises ValueError if the switches of the tree have more ports than an
+    LFT entry can address (port 255 is OSM_NO_PATH)
+    """
+    if tree.ports_per_sw > MAX_LFT_PORT:
+        raise ValueError("Switches with {} ports do not fit in the LFTs (at most {} ports)".format(tree.ports_per_sw, MAX_LFT_PORT))
+
+#----------------------------------------------------------------------
+def write_lft_dump(tree, fileobj):
+    """
+    Writes the LFTs of all the switches of a KAryNTree in fileobj (opened
+    in binary mode) in the format of OpenSM's opensm-lfts.dump, which can be
+    loaded by the "file" routing engine of OpenSM (routing_engine file,
+    lfts_file <file>):
+
+        Unicast lids [0x0-0x14] of switch Lid 1 guid 0x0000000003000000 ('Switch0'):
+        0x0001 000 # Switch portguid 0x0000000003000000: 'Switch0'
+        0x0002 002 # Switch portguid 0x0000000003000001: 'Switch1'
+        ...
+        15 lids dumped
+
+    The unreachable LIDs are left out, and the count at the end of every
+    switch is the number of LIDs that were written for it. Every line is
+    put together from strings that are formatted once per destination, and
+    the lines of a switch are joined in a single pass.
+    """
+    from itertools import chain, compress
+
+    check_fully_populated(tree)
+    check_lid_space(tree)
+
+    number_of_nodes = tree.number_of_nodes
+    max_lid = node_lid(number_of_nodes - 1)
+    names = [tree.node_name(node).encode('utf-8') for node in range(number_of_nodes)]
+    port_guids = [tree.node_guid(node) if tree.is_switch(node) else tree.hca_port_guid(node) for node in range(number_of_nodes)]
+
+    heads = [b'0x%04x ' % node_lid(node) for node in range(number_of_nodes)]
+    tails = [b" # %s portguid 0x%016x: '%s'\n" % (b'Switch' if tree.is_switch(node) else b'Channel Adapter', port_guids[node], names[node])
+             for node in range(number_of_nodes)]
+    port_text = [b'%03d' % port for port in range(256)]
+    # Maps an LFT entry to 1 if it is dumped, 0 if it is not
+    reachable = bytes(0 if port == OSM_NO_PATH else 1 for port in range(256))
+
+    for sw, lft in iter_lfts(tree):
+        entries = bytes(lft[1:])
+        selectors = entries.translate(reachable)
+        lines = chain.from_iterable(zip(compress(heads, selectors),
+                                        map(port_text.__getitem__, compress(entries, selectors)),
+                                        compress(tails, selectors)))
+        fileobj.write(b"Unicast lids [0x0-0x%x] of switch Lid %d guid 0x%016x ('%s'):\n" % (max_lid, node_lid(sw), port_guids[sw], names[sw]))
+        fileobj.write(b''.join(lines))
+        fileobj.write(b'%d lids dumped\n' % selectors.count(1))
+
+#----------------------------------------------------------------------
+def write_guid2lid(tree, fileobj):
+    """
+    Writes the LIDs of node_lid() in fileobj in the format of OpenSM's
+    guid2lid file, so that OpenSM assigns the same LIDs (with reassign_lids
+    disabled) and the LFTs of write_lft_dump() match the fabric.
+    """
+    check_fully_populated(tree)
+    check_lid_space(tree)
+
+    for node in range(tree.number_of_nodes):
+        port_guid = tree.node_guid(node) if tree.is_switch(node) else tree.hca_port_guid(node)
+        lid = node_lid(node)
+        fileobj.write("0x{:016x} {} {}\n".format(port_guid, lid, lid))
+
+################################################
+############### TRAFFIC ANALYSIS ###############
+################################################
+
+TRAFFIC_PATTERNS = ['all-to-all', 'shift', 'random', 'bisection']
+TRAFFIC_CHUNK_SIZE = 1 << 16
+
+#----------------------------------------------------------------------
+def parse_traffic_pattern(text):
+    """
+    Parses a traffic pattern like "shift:4" in a (pattern, argument) tuple.
+
+    The argument is the shift distance of "shift" (default: half of the HCAs),
+    and the random seed of "random" and "bisection" (default: 0).
+    "all-to-all" takes no argument.
+    """
+    pattern, _, argument = text.partition(':')
+    if pattern not in TRAFFIC_PATTERNS:
+        raise ValueError("Unknown traffic pattern '{}'. Choose one of: {}".format(pattern, ', '.join(TRAFFIC_PATTERNS)))
+    if not argument:
+        return pattern, None
+    if pattern == 'all-to-all':
+        raise ValueError("The all-to-all traffic pattern takes no argument")
+    try:
+        return pattern, int(argument)
+    except ValueError:
+        raise ValueError("The argument of the traffic pattern '{}' must be an integer".format(text))
+
+#----------------------------------------------------------------------
+def traffic_destinations(tree, pattern, argument=None):
+    """
+    Returns the destination HCA of every source HCA of a permutation traffic
+    pattern, as an array indexed by the HCA number (0 is the first HCA).
+    An HCA that is its own destination sends nothing.
+    # pattern: "shift", "random" or "bisection"
+    # argument: the shift distance or the random seed
+    """
+    import random
+
+    number_of_hca = tree.number_of_hca
+    if pattern == 'shift':
+        shift = (number_of_hca // 2 if argument is None else argument) % number_of_hca
+        return array('l', range(shift, number_of_hca)) + array('l', range(shift))
+
+    rng = random.Random(argument or 0)
+    order = list(range(number_of_hca))
+    rng.shuffle(order)
+    if pattern == 'random':
+        return array('l', order)
+    if pattern == 'bisection':
+        # Split the HCAs in two random halves, and pair every HCA with one in the other half
+        destinations = array('l', range(number_of_hca))
+        half = number_of_hca // 2
+        for a, b in zip(order[:half], order[half:2 * half]):
+            destinations[a] = b
+            destinations[b] = a
+        return destinations
+    raise ValueError("{} is not a permutation traffic pattern".format(pattern))
+
+#----------------------------------------------------------------------
+class LinkLoads(object):
+    """
+    The number of flows that cross every link of a KAryNTree, per direction.
+
+    The switch links are grouped by link level: the links of level j connect
+    switch level j with level j + 1. With the D-mod-K routing of iter_lfts(),
+    a flow from HCA s to HCA d crosses the links of level j when s and d are
+    below different switches of level j, i.e. when s // B != d // B, where B
+    is the number of HCAs below a switch of level j. It goes up through the
+    link
+
+        (s // B) * k**(j + 1) + d % k**(j + 1)
+
+    and down through the link
+
+        (d // B) * k**(j + 1) + d % k**(j + 1)
+
+    so the loads are plain arrays with one counter per link, and no route
+    needs to be walked hop by hop.
+    """
+    #----------------------------------------------------------------------
+    def __init__(self, tree):
+        check_fully_populated(tree)
+        self.tree = tree
+        self.flows = 0
+        number_of_links = (tree.number_of_hca // tree.hca_per_leaf) * tree.k
+        self.hca_up = array('q', [0]) * tree.number_of_hca
+        self.hca_down = array('q', [0]) * tree.number_of_hca
+        self.up = [array('q', [0]) * number_of_links for _ in range(tree.n - 1)]
+        self.down = [array('q', [0]) * number_of_links for _ in range(tree.n - 1)]
+
+    #----------------------------------------------------------------------
+    def add_flows(self, sources, destinations):
+        """
+        Adds the load of the flows sources[i] -> destinations[i]. The flows
+        are processed one level at a time, and the link of every flow is
+        counted with a Counter, so that the Python work per flow is a single
+        expression per level.
+        """
+        from collections import Counter
+
+        flows = [(s, d) for s, d in zip(sources, destinations) if s != d]
+        self.flows += len(flows)
+        for s, d in flows:
+            self.hca_up[s] += 1
+            self.hca_down[d] += 1
+
+        k = self.tree.k
+        hcas_below = self.tree.hca_per_leaf
+        for level in range(self.tree.n - 1):
+            modulus = k**(level + 1)
+            crossing = [(s // hcas_below, d // hcas_below, d % modulus) for s, d in flows if s // hcas_below != d // hcas_below]
+            for loads, links in ((self.up[level], Counter(block_s * modulus + rest for block_s, block_d, rest in crossing)),
+                                 (self.down[level], Counter(block_d * modulus + rest for block_s, block_d, rest in crossing))):
+                for link, count in links.items():
+                    loads[link] += count
+            hcas_below *= k
+
+    #----------------------------------------------------------------------
+    def add_all_to_all(self):
+        """
+        Adds the load of all the HCAs sending to all the other HCAs. This
+        is counted per link instead of per flow: the up link
+        (block, d % k**(j + 1)) is crossed by the B HCAs of the block, towards
+        every HCA with the same remainder outside of the block, and the down
+        links are symmetric. With D-mod-K every link of a level gets the same
+        load, and the quadratic number of flows is never enumerated.
+        """
+        number_of_hca = self.tree.number_of_hca
+        self.flows += number_of_hca * (number_of_hca - 1)
+        for loads in (self.hca_up, self.hca_down):
+            for hca in range(number_of_hca):
+                loads[hca] += number_of_hca - 1
+
+        hcas_below = self.tree.hca_per_leaf
+        for level in range(self.tree.n - 1):
+            modulus = self.tree.k**(level + 1)
+            load = hcas_below * (number_of_hca // modulus - hcas_below // modulus)
+            for loads in (self.up[level], self.down[level]):
+                for link in range(len(loads)):
+                    loads[link] += load
+            hcas_below *= self.tree.k
+
+    #----------------------------------------------------------------------
+    def summary(self):
+        """
+        Returns the load distribution of every link level and direction as a
+        list of dictionaries, starting from the HCA links
+        """
+        from collections import Counter
+
+        summary = []
+        levels = [('hca', self.hca_up, self.hca_down)]
+        levels += [(level, self.up[level], self.down[level]) for level in range(self.tree.n - 1)]
+        for level, up, down in levels:
+            for direction, loads in (('up', up), ('down', down)):
+                histogram = Counter(loads)
+                summary.append({'level': level,
+                                'direction': direction,
+                                'links': len(loads),
+                                'max': max(loads) if loads else 0,
+                                'mean': round(float(sum(loads)) / len(loads), 3) if loads else 0.0,
+                                'histogram': dict((str(load), histogram[load]) for load in sorted(histogram))})
+        return summary
+
+#----------------------------------------------------------------------
+def analyze_traffic(tree, pattern, argument=None, chunk_size=TRAFFIC_CHUNK_SIZE):
+    """
+    Routes a synthetic traffic pattern over a KAryNTree with the D-mod-K
+    routing of iter_lfts() and returns its LinkLoads. The flows of the
+    permutation patterns are added chunk_size at a time.
+    # pattern: one of TRAFFIC_PATTERNS
+    # argument: see parse_traffic_pattern()
+    """
+    loads = LinkLoads(tree)
+    if pattern == 'all-to-all':
+        loads.add_all_to_all()
+        return loads
+
+    destinations = traffic_destinations(tree, pattern, argument)
+    for start in range(0, tree.number_of_hca, chunk_size):
+        stop = min(start + chunk_size, tree.number_of_hca)
+        loads.add_flows(range(start, stop), destinations[start:stop])
+    return loads
+
+#----------------------------------------------------------------------
+def log_traffic_summary(name, loads):
+    """
+    Logs the max and mean load of every link level and direction
+    """
+    LOG.info("Traffic pattern {}: {} flows".format(name, loads.flows))
+    LOG.info("  {:>10} {:>9} {:>8} {:>10} {:>12}".format('link level', 'direction', 'links', 'max load', 'mean load'))
+    for record in loads.summary():
+        LOG.info("  {:>10} {:>9} {:>8} {:>10} {:>12.3f}".format(record['level'], record['direction'], record['links'], record['max'], record['mean']))
+
+################################################
+################## VALIDATION ##################
+################################################
+
+MAX_REPORTED_ERRORS = 20
+
+class ValidationReport(object):
+    """
+    The errors and the metrics that validate_topology() found in a topology.
+
+    # errors:   the number of errors of every kind
+    # messages: the messages of the first MAX_REPORTED_ERRORS errors
+    # levels:   the link counts of every row of switches of a k-ary-n-tree
+    # metrics:  the diameter, bisection width and up-path diversity, and
+                the connectivity found by a breadth first search
+    # tree:     the description of the tree the structure was checked
+                against, or None if only the links were checked
+    """
+    #----------------------------------------------------------------------
+    def __init__(self):
+        self.errors = {}
+        self.messages = []
+        self.levels = []
+        self.metrics = {}
+        self.tree = None
+
+    #----------------------------------------------------------------------
+    def error(self, kind, message):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+        if len(self.messages) < MAX_REPORTED_ERRORS:
+            self.messages.append(message)
+
+    #----------------------------------------------------------------------
+    @property
+    def valid(self):
+        return not self.errors
+
+    #----------------------------------------------------------------------
+    def as_dict(self):
+        """
+        Returns the report as a dictionary, ready to be stored as JSON
+        """
+        return {'valid': self.valid,
+                'errors': dict(self.errors),
+                'messages': list(self.messages),
+                'levels': list(self.levels),
+                'metrics': dict(self.metrics),
+                'tree': self.tree}
+
+#----------------------------------------------------------------------
+def _check_links(topology, report):
+    """
+    Checks that every link is connected at both ends: no port is connected
+    to a port that does not exist, to its own node, or to a port that is not
+    connected back to it (a dangling link, or a port used by two links).
+    Every active node must have a link, and no link may lead to an inactive
+    node.
+    """
+    number_of_nodes = topology.number_of_nodes
+    port_offset = topology.port_offset
+    remote_node = topology.remote_node
+    remote_port = topology.remote_port
+    active = topology.active
+    name = topology.node_name
+
+    for node in range(number_of_nodes):
+        first = port_offset[node]
+        links = 0
+        for port in range(1, port_offset[node + 1] - first + 1):
+            rem_node = remote_node[first + port - 1]
+            if rem_node < 0:
+                continue
+            links += 1
+            rem_port = remote_port[first + port - 1]
+            if rem_node >= number_of_nodes or not 1 <= rem_port <= topology.total_ports(rem_node):
+                report.error('dangling', "Port {} of {} is connected to a port that does not exist".format(port, name(node)))
+                continue
+            if rem_node == node:
+                report.error('self_link', "Port {} of {} is connected to its own port {}".format(port, name(node), rem_port))
+                continue
+
+            back = port_offset[rem_node] + rem_port - 1
+            if remote_node[back] < 0:
+                report.error('asymmetric', "Port {} of {} is connected to port {} of {}, which is not connected".format(
+                    port, name(node), rem_port, name(rem_node)))
+            elif remote_node[back] != node or remote_port[back] != port:
+                report.error('double_used', "Port {} of {} is connected to port {} of {}, which is connected to port {} of {}".format(
+                    port, name(node), rem_port, name(rem_node), remote_port[back], name(remote_node[back])))
+            elif active[node] and not active[rem_node]:
+                report.error('inactive', "{} is connected to {}, which is not part of the fabric".format(name(node), name(rem_node)))
+
+        if active[node] and not links:
+            report.error('isolated', "{} is not connected to anything".format(name(node)))
+
+#----------------------------------------------------------------------
+def _check_tree_structure(topology, tree, report):
+    """
+    Checks that the topology is the k-ary-n-tree "tree", straight from the
+    definition rather than from the arithmetic of the builder: a switch of
+    level l is connected to the switches of level l + 1 whose index has the
+    same base-k digits except digit l, uplink port p goes to the switch
+    with digit l equal to p - 1, every row has the expected up/down degree,
+    and the HCAs are attached in order to the down ports of the leaves.
+
+    In a partially populated tree, exactly the switches with HCAs below them
+    must be active, and only their up links are checked for the degree.
+    """
+    if (topology.number_of_sw, topology.number_of_hca) != (tree.number_of_sw, tree.number_of_hca):
+        report.error('size', "The topology has {} switches and {} HCAs, but the k-ary-n-tree has {} switches and {} HCAs".format(
+            topology.number_of_sw, topology.number_of_hca, tree.number_of_sw, tree.number_of_hca))
+        return
+
+    k = tree.k
+    n = tree.n
+    root_level = n - 1
+    sw_per_row = tree.sw_per_row
+    number_of_sw = tree.number_of_sw
+    number_of_nodes = topology.number_of_nodes
+    port_offset = topology.port_offset
+    remote_node = topology.remote_node
+    name = topology.node_name
+
+    partially_populated = tree.partially_populated
+    up_degree = array('H', [0]) * number_of_sw
+    down_degree = array('H', [0]) * number_of_sw
+
+    for sw in range(number_of_sw):
+        if partially_populated and bool(topology.active[sw]) != tree.switch_in_use(sw):
+            report.error('trim', "{} should {}".format(
+                name(sw), "not have been removed" if tree.switch_in_use(sw) else "have been removed, it has no HCAs below it"))
+        if not topology.active[sw]:
+            continue
+        if not topology.is_switch(sw) or topology.total_ports(sw) != tree.ports_per_sw:
+            report.error('node', "{} should be a switch with {} ports".format(name(sw), tree.ports_per_sw))
+            continue
+
+        row = sw // sw_per_row
+        level, second_subtree = fat_tree_row(n, row)
+        sw_index = sw - row * sw_per_row
+        first = port_offset[sw]
+        for port in range(1, tree.ports_per_sw + 1):
+            rem_node = remote_node[first + port - 1]
+            if rem_node < 0 or rem_node >= number_of_nodes:
+                continue
+
+            if rem_node >= number_of_sw:
+                if level != 0 or port <= k:
+                    report.error('structure', "{} is connected to port {} of {}, which is not a down port of a leaf switch".format(
+                        name(rem_node), port, name(sw)))
+                else:
+                    down_degree[sw] += 1
+                continue
+
+            rem_row = rem_node // sw_per_row
+            rem_level, rem_second_subtree = fat_tree_row(n, rem_row)
+            rem_index = rem_node - rem_row * sw_per_row
+            if rem_level == level + 1 and (rem_level == root_level or rem_second_subtree == second_subtree):
+                upper_index, lower_index, lower_level = rem_index, sw_index, level
+                valid_port = port <= k and (rem_index // k**level) % k == port - 1
+                up_degree[sw] += 1
+            elif rem_level == level - 1 and (level == root_level or rem_second_subtree == second_subtree):
+                upper_index, lower_index, lower_level = sw_index, rem_index, rem_level
+                first_down_port = 1 if (level == root_level and rem_second_subtree) else k + 1
+                valid_port = first_down_port <= port < first_down_port + k and (rem_index // k**rem_level) % k == port - first_down_port
+                down_degree[sw] += 1
+            else:
+                report.error('structure', "Port {} of {} (level {}) is connected to {} (level {})".format(
+                    port, name(sw), level, name(rem_node), rem_level))
+                continue
+
+            same_digits = (upper_index // k**(lower_level + 1) == lower_index // k**(lower_level + 1) and
+                           upper_index % k**lower_level == lower_index % k**lower_level)
+            if not same_digits or not valid_port:
+                report.error('structure', "Port {} of {} is connected to {}, which is not its neighbour in the k-ary-n-tree".format(
+                    port, name(sw), name(rem_node)))
+
+    for row in range(number_of_sw // sw_per_row):
+        level, second_subtree = fat_tree_row(n, row)
+        expected_up = k if level < root_level else 0
+        if level == 0:
+            expected_down = tree.hca_per_leaf
+        elif level == root_level and tree.fully_connected_roots:
+            expected_down = 2 * k
+        else:
+            expected_down = k
+
+        row_switches = [sw for sw in range(row * sw_per_row, (row + 1) * sw_per_row) if topology.active[sw]]
+        row_up = [up_degree[sw] for sw in row_switches] or [0]
+        row_down = [down_degree[sw] for sw in row_switches] or [0]
+        if partially_populated:
+            # The switches of a partially populated tree have a varying number of down links
+            expected_down = None
+        report.levels.append({'row': row,
+                              'level': level,
+                              'second_subtree': second_subtree,
+                              'switches': len(row_switches),
+                              'up_links': [min(row_up), max(row_up)],
+                              'down_links': [min(row_down), max(row_down)],
+                              'expected_up_links': expected_up,
+                              'expected_down_links': expected_down})
+        for sw in row_switches:
+            if up_degree[sw] != expected_up or (expected_down is not None and down_degree[sw] != expected_down):
+                report.error('degree', "{} has {} up and {} down links instead of {} and {}".format(
+                    name(sw), up_degree[sw], down_degree[sw], expected_up, expected_down))
+
+    # The HCAs are placed on the leaves in the placement of the tree, first the first subtree and then the second one
+    for hca_no in range(tree.number_of_hca):
+        hca = number_of_sw + hca_no
+        if topology.is_switch(hca) or topology.total_ports(hca) != 1:
+            report.error('node', "{} should be an HCA with a single port".format(name(hca)))
+            continue
+        expected_leaf = tree.leaf_switch(tree.hca_leaf(hca_no)[0])
+        if remote_node[port_offset[hca]] != expected_leaf:
+            report.error('placement', "{} should be connected to {}".format(name(hca), name(expected_leaf)))
+
+#----------------------------------------------------------------------
+def _check_xgft_structure(topology, tree, report):
+    """
+    Checks that the topology is the XGFT "tree", from the definition of its
+    labels: every node of level i has all its w_(i+1) up ports and m_i down
+    ports connected, and its up port p leads to the node of level i + 1 with
+    the same label, except that digit a_(i+1) is replaced by p - 1.
+    """
+    if (topology.number_of_sw, topology.number_of_hca) != (tree.number_of_sw, tree.number_of_hca):
+        report.error('size', "The topology has {} switches and {} HCAs, but the XGFT has {} switches and {} HCAs".format(
+            topology.number_of_sw, topology.number_of_hca, tree.number_of_sw, tree.number_of_hca))
+        return
+
+    port_offset = topology.port_offset
+    remote_node = topology.remote_node
+    remote_port = topology.remote_port
+    name = topology.node_name
+
+    for level in range(tree.h + 1):
+        first_node = tree.first_node[level]
+        up_ports = tree.up_ports[level]
+        total_ports = tree.ports_per_level[level]
+        up_degree = []
+        down_degree = []
+        for node in range(first_node, first_node + tree.nodes_per_level[level]):
+            if topology.is_switch(node) != (level > 0) or topology.total_ports(node) != total_ports:
+                report.error('node', "{} should have {} ports".format(name(node), total_ports))
+                continue
+
+            first = port_offset[node]
+            up_degree.append(up_ports - remote_node[first:first + up_ports].count(-1))
+            down_degree.append(total_ports - up_ports - remote_node[first + up_ports:first + total_ports].count(-1))
+            if up_degree[-1] != up_ports or down_degree[-1] != tree.down_ports[level]:
+                report.error('degree', "{} has {} up and {} down links instead of {} and {}".format(
+                    name(node), up_degree[-1], down_degree[-1], up_ports, tree.down_ports[level]))
+
+            for port in range(1, up_ports + 1):
+                parent, parent_port = tree.parent(level, node - first_node, port)
+                parent += tree.first_node[level + 1]
+                if remote_node[first + port - 1] >= 0 and (remote_node[first + port - 1], remote_port[first + port - 1]) != (parent, parent_port):
+                    report.error('structure', "Port {} of {} should be connected to port {} of {}".format(
+                        port, name(node), parent_port, name(parent)))
+
+        if level > 0:
+            report.levels.append({'row': level - 1,
+                                  'level': level - 1,
+                                  'second_subtree': False,
+                                  'switches': tree.nodes_per_level[level],
+                                  'up_links': [min(up_degree or [0]), max(up_degree or [0])],
+                                  'down_links': [min(down_degree or [0]), max(down_degree or [0])],
+                                  'expected_up_links': up_ports,
+                                  'expected_down_links': tree.down_ports[level]})
+
+#----------------------------------------------------------------------
+def _measure(topology, report):
+    """
+    Computes the metrics of the report. A breadth first search, one whole
+    frontier at a time, from the first HCA finds out if the fabric is
+    connected, and the distance of the farthest HCA. The diameter, the
+    bisection width and the up-path diversity of the tree come from the
+    closed forms of its metrics(), so no search between all the pairs of
+    HCAs is needed. The distance of the farthest HCA must match the diameter.
+    """
+    number_of_nodes = topology.number_of_nodes
+    port_offset = topology.port_offset
+    remote_node = topology.remote_node
+    active = topology.active
+
+    hcas = [node for node in range(number_of_nodes) if active[node] and not topology.is_switch(node)]
+    eccentricity = None
+    connected = False
+    if hcas:
+        distance = array('l', [-1]) * number_of_nodes
+        distance[hcas[0]] = 0
+        frontier = [hcas[0]]
+        reached = 1
+        hops = 0
+        eccentricity = 0
+        while frontier:
+            hops += 1
+            next_frontier = []
+            for node in frontier:
+                for index in range(port_offset[node], port_offset[node + 1]):
+                    rem_node = remote_node[index]
+                    if 0 <= rem_node < number_of_nodes and distance[rem_node] < 0 and active[rem_node]:
+                        distance[rem_node] = hops
+                        next_frontier.append(rem_node)
+                        if not topology.is_switch(rem_node):
+                            eccentricity = hops
+            reached += len(next_frontier)
+            frontier = next_frontier
+        connected = reached == active.count(1)
+
+    report.metrics['connected'] = connected
+    report.metrics['hca_eccentricity'] = eccentricity
+
+    tree = topology.tree
+    if tree is None:
+        report.metrics.update({'diameter': None, 'bisection_width': None, 'bisection_ratio': None, 'up_path_diversity': None})
+        return
+    report.metrics.update(tree.metrics())
+
+    diameter = report.metrics['diameter']
+    if not connected:
+        report.error('connectivity', "The fabric is not connected")
+    elif report.valid and diameter is not None and tree.number_of_hca > 1 and eccentricity != diameter:
+        report.error('diameter', "The farthest HCA is {} links away, instead of {}".format(eccentricity, diameter))
+
+#----------------------------------------------------------------------
+def validate_topology(topology):
+    """
+    Validates the links of a topology, and if it was built from (or matches)
+    a KAryNTree or an XGFT, its structure. Returns a ValidationReport.
+    All the checks take time linear in the number of ports.
+    """
+    report = ValidationReport()
+    _check_links(topology, report)
+    if topology.tree is not None:
+        report.tree = topology.tree.description()
+    if isinstance(topology.tree, XGFT):
+        _check_xgft_structure(topology, topology.tree, report)
+    elif topology.tree is not None:
+        _check_tree_structure(topology, topology.tree, report)
+    _measure(topology, report)
+    return report
+
+#----------------------------------------------------------------------
+def log_validation_report(name, report):
+    """
+    Logs the errors, the link counts of every level and the metrics of a ValidationReport
+    """
+    if report.valid and report.tree is None:
+        LOG.info("Validation of {}: OK (only the links, there is no tree to check the structure against)".format(name))
+    elif report.valid:
+        LOG.info("Validation of {}: OK".format(name))
+    else:
+        LOG.error("Validation of {}: {} errors ({})".format(
+            name, sum(report.errors.values()), ', '.join("{} {}".format(count, kind) for kind, count in sorted(report.errors.items()))))
+        for message in report.messages:
+            LOG.error("  {}".format(message))
+
+    if report.levels:
+        LOG.info("  {:>4} {:>6} {:>8} {:>10} {:>10}".format('row', 'level', 'switches', 'up links', 'down links'))
+        for record in report.levels:
+            LOG.info("  {:>4} {:>6} {:>8} {:>10} {:>10}".format(
+                record['row'], record['level'], record['switches'],
+                "{}-{}".format(*record['up_links']), "{}-{}".format(*record['down_links'])))
+
+    for metric in ('connected', 'hca_eccentricity', 'diameter', 'bisection_width', 'bisection_ratio', 'up_path_diversity'):
+        if report.metrics.get(metric) is not None:
+            LOG.info("  {:<18} {}".format(metric, report.metrics[metric]))
+
+################################################
+############## FAILURE INJECTION ###############
+################################################
+
+FAILURE_KINDS = ['links', 'switches']
+
+#----------------------------------------------------------------------
+def parse_failure_spec(text):
+    """
+    Parses a failure spec like "links:10", "links:5%" or "switches:2" in a
+    (kind, amount) tuple. The amount is an int count, or a float fraction
+    of the links or switches of the fabric if the spec ends with %.
+    """
+    kind, _, amount = text.partition(':')
+    try:
+        if kind not in FAILURE_KINDS:
+            raise ValueError()
+        if amount.endswith('%'):
+            value = float(amount[:-1]) / 100
+            if not 0 <= value <= 1:
+                raise ValueError()
+        else:
+            value = int(amount)
+            if value < 0:
+                raise ValueError()
+    except ValueError:
+        raise ValueError("Invalid failure spec '{}'. Use links:COUNT, links:PERCENT%, switches:COUNT or switches:PERCENT%".format(text))
+    return kind, value
+
+#----------------------------------------------------------------------
+def iter_failure_variants(topology, kind, amount, variants, seed=0):
+    """
+    Applies the failures of every variant to the topology in place, one
+    variant at a time, and yields (variant, changed_nodes, summary) tuples.
+
+    Every variant fails a random sample of the links or of the switches of
+    the topology, drawn with its own random generator, so a variant only
+    depends on the seed and its number. The failed switches and the nodes
+    that are left without any link (like the HCAs of a failed leaf) are
+    pruned. changed_nodes is the sorted list of the nodes that lost links:
+    the rest of the fabric is the same as in the topology without failures.
+    The failures are undone when the next variant is requested.
+
+    # kind: "links" or "switches"
+    # amount: a count, or a fraction (float) of the links or switches
+    # variants: the number of variants
+    # seed: the random seed of the variants
+    """
+    import random
+
+    number_of_nodes = topology.number_of_nodes
+    port_offset = topology.port_offset
+    remote_node = topology.remote_node
+    active = topology.active
+
+    if kind == 'links':
+        # Every link once, from the end with the smallest node id
+        link_node = array('l')
+        link_port = array('H')
+        for node in range(number_of_nodes):
+            for index in range(port_offset[node], port_offset[node + 1]):
+                if remote_node[index] > node:
+                    link_node.append(node)
+                    link_port.append(index - port_offset[node] + 1)
+        population = len(link_node)
+    elif kind == 'switches':
+        switches = [node for node in range(number_of_nodes) if active[node] and topology.is_switch(node)]
+        population = len(switches)
+    else:
+        raise ValueError("Unknown failure kind '{}'".format(kind))
+
+    count = int(round(amount * population)) if isinstance(amount, float) else min(amount, population)
+
+    for variant in range(variants):
+        rng = random.Random("{}-{}".format(seed, variant))
+        removed = []
+        failed_switches = []
+        if kind == 'links':
+            for link in sorted(rng.sample(range(population), count)):
+                node, port = link_node[link], link_port[link]
+                removed.append((node, port) + topology.disconnect(node, port))
+        else:
+            failed_switches = sorted(rng.sample(switches, count))
+            for sw in failed_switches:
+                for port in range(1, topology.total_ports(sw) + 1):
+                    remote = topology.disconnect(sw, port)
+                    if remote is not None:
+                        removed.append((sw, port) + remote)
+                active[sw] = 0
+
+        changed_nodes = sorted(set([link[0] for link in removed] + [link[2] for link in removed]))
+        pruned = topology.prune_unconnected_nodes(changed_nodes)
+
+        yield variant, changed_nodes, {'variant': variant,
+                                       'failed_links': len(removed),
+                                       'failed_switches': len(failed_switches),
+                                       'pruned_nodes': len(pruned)}
+
+        for node, port, rem_node, rem_port in removed:
+            topology.connect(node, port, rem_node, rem_port)
+        for node in failed_switches + pruned:
+            active[node] = 1
+
+#----------------------------------------------------------------------
+def failure_variant_path(path, variant):
+    """
+    Returns the file name of a variant: the variant number is added before the extension of path
+    """
+    root, extension = os.path.splitext(path)
+    return "{}-failures-{:04d}{}".format(root, variant, extension)
+
+#----------------------------------------------------------------------
+def write_failure_variants(topology, kind, amount, variants, open_variant, seed=0, timestamp=None, link_speed=DEFAULT_LINK_SPEED):
+    """
+    Writes the failure variants of iter_failure_variants() in the
+    ibnetdiscover format, and returns their summaries.
+
+    The blocks of all the nodes are formatted once, for the topology
+    without failures. For every variant, only the blocks of the nodes that
+    lost links are formatted again, and the unchanged runs of blocks in
+    between are written as they are.
+
+    # open_variant: called with the number of a variant, returns the file
+                    object to write the variant in. The file is closed
+                    after the variant is written, unless it is STDOUT.
+    """
+    from itertools import compress
+
+    formatter = BlockFormatter(topology, link_speed)
+    active = topology.active
+    base_blocks = [formatter.block(node) if active[node] else '' for node in range(topology.number_of_nodes)]
+    is_switch = [1 if node_type == Topology.SWITCH else 0 for node_type in topology.node_type]
+
+    summaries = []
+    for variant, changed_nodes, summary in iter_failure_variants(topology, kind, amount, variants, seed):
+        fileobj = open_variant(variant)
+        try:
+            if topology.tree is not None:
+                # The failed and pruned nodes are not counted in the header
+                switches = sum(compress(is_switch, active))
+                fileobj.write(ibnetdiscover_header(topology.tree, timestamp, notes=[
+                    "Failure variant {} of {} (seed {}): {} failed switches, {} failed links, {} pruned nodes".format(
+                        variant, kind, seed, summary['failed_switches'], summary['failed_links'], summary['pruned_nodes'])],
+                    counts=(switches, active.count(1) - switches)))
+
+            unchanged_from = 0
+            for node in changed_nodes:
+                fileobj.writelines(base_blocks[unchanged_from:node])
+                if active[node]:
+                    fileobj.write(formatter.block(node))
+                unchanged_from = node + 1
+            fileobj.writelines(base_blocks[unchanged_from:])
+        finally:
+            if fileobj is not sys.stdout:
+                fileobj.close()
+        summaries.append(summary)
+
+    return summaries
+
+################################################
+#################### CACHE #####################
+################################################
+
+DEFAULT_CACHE_SIZE = 1024 # Max size of the topology cache, in MB
+
+#----------------------------------------------------------------------
+def default_cache_dir():
+    """
+    Returns the default directory of the topology cache: $XDG_CACHE_HOME/FatTreeBuilder or ~/.cache/FatTreeBuilder
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, PROGRAM_NAME)
+
+class TopologyCache(object):
+    """
+    On-disk cache of generated topologies.
+
+    A topology is stored without its header (the only part that changes
+    between two runs is the time in the header), in a file named after a
+    hash of the generator parameters and VERSION. The cache is trimmed to
+    max_size MB by evicting the least recently used files: the modification
+    time of a file is updated every time it is served.
+
+    The hit/miss/eviction counters are kept in stats.json in the cache
+    directory.
+    """
+
+    STATS_FILE = 'stats.json'
+
+    def __init__(self, directory=None, max_size=DEFAULT_CACHE_SIZE):
+        import json
+
+        self.directory = directory if directory is not None else default_cache_dir()
+        self.max_size = max_size * 1024 * 1024
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        try:
+            with open(os.path.join(self.directory, TopologyCache.STATS_FILE)) as stats_file:
+                self.stats.update(json.load(stats_file))
+        except (IOError, OSError, ValueError):
+            pass
+
+    #----------------------------------------------------------------------
+    @staticmethod
+    def key(**params):
+        """
+        Returns the cache key of the topology generated with the given parameters
+        """
+        import hashlib
+        import json
+
+        params['version'] = VERSION
+        description = json.dumps(params, sort_keys=True)
+        return hashlib.sha256(description.encode('utf-8')).hexdigest()
+
+    #----------------------------------------------------------------------
+    def path(self, key):
+        return os.path.join(self.directory, key + '.topo')
+
+    #----------------------------------------------------------------------
+    def fetch(self, key, write_body):
+        """
+        Returns the path of the cached file with the given key.
+
+        On a miss, write_body(fileobj) is called to generate the file, and
+        the least recently used files are evicted if the cache grows over
+        its max size.
+        """
+        path = self.path(key)
+        if os.path.exists(path):
+            os.utime(path, None)
+            self.stats['hits'] += 1
+            LOG.info("Topology cache hit: {}".format(key))
+        else:
+            self.stats['misses'] += 1
+            LOG.info("Topology cache miss: {}".format(key))
+            tmp_path = "{}.{}.tmp".format(path, os.getpid())
+            try:
+                with open(tmp_path, 'w', buffering=OUTPUT_BUFFER_SIZE) as body:
+                    write_body(body)
+                os.rename(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            self.evict(keep=path)
+
+        self._save_stats()
+        LOG.info(self.summary())
+        return path
+
+    #----------------------------------------------------------------------
+    def entries(self):
+        """
+        Returns the (mtime, size, path) tuples of the cached files, least recently used first
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.topo'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+
+        entries.sort()
+        return entries
+
+    #----------------------------------------------------------------------
+    def evict(self, keep=None):
+        """
+        Removes the least recently used files until the cache fits in its max size.
+        The file "keep" is never removed.
+        """
+        entries = self.entries()
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size -= size
+            self.stats['evictions'] += 1
+            LOG.debug("Evicted {} from the topology cache".format(os.path.basename(path)))
+
+    #----------------------------------------------------------------------
+    def summary(self):
+        entries = self.entries()
+        return "Topology cache {}: {} hits, {} misses, {} evictions, {} files, {:.1f} MB".format(
+            self.directory, self.stats['hits'], self.stats['misses'], self.stats['evictions'],
+            len(entries), sum(size for _, size, _ in entries) / (1024.0 * 1024.0))
+
+    #----------------------------------------------------------------------
+    def _save_stats(self):
+        import json
+
+        try:
+            with open(os.path.join(self.directory, TopologyCache.STATS_FILE), 'w') as stats_file:
+                json.dump(self.stats, stats_file)
+        except (IOError, OSError):
+            pass
+
+#----------------------------------------------------------------------
+def write_cached_ibnetdiscover(cache, tree, fileobj, timestamp=None, stream=False, link_speed=DEFAULT_LINK_SPEED, profiler=NULL_PROFILER):
+    """
+    Writes the KAryNTree in fileobj in the ibnetdiscover format, like
+    write_ibnetdiscover(), and serves the body of the output from the cache.
+    The topology is only built (or streamed if stream is True) on a miss.
+    """
+    import shutil
+
+    def write_body(body):
+        if stream:
+            write_blocks(body, iter_ibnetdiscover_blocks(tree, link_speed))
+        else:
+            topology = build_fat_tree(tree.k, tree.n, tree.oversub, tree.fully_connected_roots, tree.ports_per_sw, profiler)
+            with profiler.phase('output', topology.counts):
+                write_blocks(body, iter_topology_blocks(topology, link_speed))
+
+    key = cache.key(k=tree.k, n=tree.n, oversub=tree.oversub,
+                    fully_connected_roots=tree.fully_connected_roots, link_speed=link_speed)
+    path = cache.fetch(key, write_body)
+
+    with profiler.phase('cache_copy'):
+        fileobj.write(ibnetdiscover_header(tree, timestamp))
+        with open(path) as body:
+            shutil.copyfileobj(body, fileobj, OUTPUT_BUFFER_SIZE)
+
+################################################
+#################### SWEEP #####################
+################################################
+
+#----------------------------------------------------------------------
+def parse_int_list(text):
     """
-    Prints the "message" and exits with status 1
+    Parses a list of integers like "1,2,4" or "2-19" or "2-5,8" into a sorted list
     """
-    print("\nFATAL ERROR:\n" + message + "\n", file=sys.stderr)
-    exit(1)
+    values = set()
+    for item in text.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if '-' in item:
+            first, last = item.split('-', 1)
+            values.update(range(int(first), int(last) + 1))
+        else:
+            values.add(int(item))
+
+    return sorted(values)
 
 #----------------------------------------------------------------------
-def print_(value_to_be_printed, print_indent=0, spaces_per_indent=4, endl="\n"):
+def topology_file_name(k, n, oversub, fully_connected_roots):
     """
-    This function, among anything else, it will print dictionaries (even nested ones) in a good looking way
+    Returns the name of the file of a topology in a sweep: k-XX-n-YY-o-ZZ[-Full].topo
+    """
+    return "k-{:02d}-n-{:02d}-o-{:02d}{}.topo".format(k, n, oversub, '-Full' if fully_connected_roots else '')
 
-    # value_to_be_printed: The only needed argument and it is the
-                           text/number/dictionary to be printed
-    # print_indent: indentation for the printed text (it is used for
-                    nice looking dictionary prints) (default is 0)
-    # spaces_per_indent: Defines the number of spaces per indent (default is 4)
-    # endl: Defines the end of line character (default is \n)
+#----------------------------------------------------------------------
+def available_cores():
+    """
+    Returns the number of cores this process is allowed to run on
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        import multiprocessing
+        return multiprocessing.cpu_count()
 
-    More info here:
-    http://stackoverflow.com/questions/19473085/create-a-nested-dictionary-for-a-word-python?answertab=active#tab-top
+#----------------------------------------------------------------------
+def plan_sweep(ks, ns, oversubs, max_sw_ports=MAX_SW_PORTS):
     """
+    Returns the (buildable, skipped) lists of the (k, n, oversub, fully_connected_roots)
+    combinations of a sweep.
 
-    if(isinstance(value_to_be_printed, dict)):
-        for key, value in value_to_be_printed.iteritems():
-            if(isinstance(value, dict)):
-                print_('{0}{1!r}:'.format(print_indent * spaces_per_indent * ' ', key))
-                print_(value, print_indent + 1)
-            else:
-                print_('{0}{1!r}: {2}'.format(print_indent * spaces_per_indent * ' ', key, value))
-    else:
-        string = ('{0}{1}{2}'.format(print_indent * spaces_per_indent * ' ', value_to_be_printed, endl))
-        sys.stdout.write(string)
+    Every (k, n, oversub) combination is built as a normal tree and as a
+    tree with fully connected roots. The combinations that need more than
+    max_sw_ports ports per switch are skipped. Nothing is built here, only
+    the parameters are checked.
+    """
+    buildable = []
+    skipped = []
+    for oversub in oversubs:
+        for n in ns:
+            for k in ks:
+                for fully_connected_roots in (False, True):
+                    try:
+                        KAryNTree(k, n, oversub, fully_connected_roots, max_sw_ports)
+                    except ValueError as e:
+                        skipped.append(((k, n, oversub, fully_connected_roots), str(e)))
+                    else:
+                        buildable.append((k, n, oversub, fully_connected_roots))
+
+    return buildable, skipped
 
 #----------------------------------------------------------------------
-def int_to_hex_str(number, hex_length = -2, prefix_with_0x = False):
+def _sweep_build(job):
     """
-    Converts an int to a hex string with the number of hex_length zeros prepended
+    Builds one topology of a sweep and writes it in its file.
+    Returns the manifest entry of the file.
     """
-    hex_str = "{0:#0{1}x}".format(number, hex_length + 2)
+    (k, n, oversub, fully_connected_roots), dest_dir, max_sw_ports, validate = job
+    file_name = topology_file_name(k, n, oversub, fully_connected_roots)
 
-    if (not prefix_with_0x):
-        hex_str = hex_str[2:len(hex_str)]
+    start = time.time()
+    topology = build_fat_tree(k, n, oversub, fully_connected_roots, max_sw_ports)
+    build_time = time.time() - start
 
-    return hex_str
+    start = time.time()
+    with open(os.path.join(dest_dir, file_name), 'w', buffering=OUTPUT_BUFFER_SIZE) as output:
+        write_ibnetdiscover(topology, output)
+    write_time = time.time() - start
+
+    entry = {'file': file_name,
+             'k': k,
+             'n': n,
+             'oversub': oversub,
+             'fully_connected_roots': fully_connected_roots,
+             'nodes': topology.tree.number_of_nodes,
+             'switches': topology.tree.number_of_sw,
+             'hcas': topology.tree.number_of_hca,
+             'build_time': round(build_time, 6),
+             'write_time': round(write_time, 6)}
+    if validate:
+        report = validate_topology(topology)
+        entry['valid'] = report.valid
+        entry['validation_errors'] = report.errors
+        entry['metrics'] = report.metrics
+    return entry
 
 #----------------------------------------------------------------------
+def sweep(ks, ns, oversubs, dest_dir, jobs=None, max_sw_ports=MAX_SW_PORTS, manifest_name='manifest.json', validate=False):
+    """
+    Builds all the buildable topologies of a sweep (see plan_sweep()) in
+    dest_dir, spread over a pool of "jobs" processes (by default one per
+    available core).
+
+    A JSON manifest with the node/switch/HCA counts and the build and write
+    time of every file is written in dest_dir/manifest_name. The entries of
+    the files that were built by earlier sweeps in dest_dir are kept.
+    If validate is True, every topology is also checked with
+    validate_topology(), and its errors and metrics go in the manifest.
+    Returns the list of the manifest entries of this sweep.
+    """
+    import json
+    import multiprocessing
+
+    buildable, skipped = plan_sweep(ks, ns, oversubs, max_sw_ports)
+    for (k, n, oversub, fully_connected_roots), reason in skipped:
+        if not fully_connected_roots:
+            LOG.info("Cannot build the k-ary-n tree with k={}, n={}, oversubscription={}: {}".format(k, n, oversub, reason))
+
+    if not os.path.isdir(dest_dir):
+        os.makedirs(dest_dir)
+
+    # Start the biggest topologies first, so that the small ones fill the gaps at the end.
+    buildable.sort(key=lambda params: KAryNTree(*params, max_sw_ports=None).number_of_nodes, reverse=True)
+    job_list = [(params, dest_dir, max_sw_ports, validate) for params in buildable]
+
+    if jobs is None:
+        jobs = available_cores()
+    jobs = max(1, min(jobs, len(job_list)))
+
+    built = []
+    if jobs == 1:
+        results = map(_sweep_build, job_list)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes=jobs)
+        results = pool.imap_unordered(_sweep_build, job_list)
+
+    try:
+        for entry in results:
+            LOG.info("Built {} ({} nodes) in {:.3f}s".format(entry['file'], entry['nodes'], entry['build_time'] + entry['write_time']))
+            if not entry.get('valid', True):
+                LOG.error("{} is not a valid k-ary-n-tree: {}".format(entry['file'], entry['validation_errors']))
+            built.append(entry)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    # Keep the entries of the files that were built in earlier sweeps in the same directory.
+    manifest_path = os.path.join(dest_dir, manifest_name)
+    manifest = list(built)
+    built_files = set(entry['file'] for entry in built)
+    skipped_files = set(topology_file_name(*params) for params, _ in skipped)
+    try:
+        with open(manifest_path) as manifest_file:
+            previous = json.load(manifest_file)
+        manifest.extend(entry for entry in previous.get('topologies', []) if entry['file'] not in built_files)
+        skipped_files.update(name for name in previous.get('skipped', []) if name not in built_files)
+    except (IOError, OSError, ValueError):
+        pass
+
+    manifest.sort(key=lambda entry: entry['file'])
+    with open(manifest_path, 'w') as manifest_file:
+        json.dump({'version': VERSION,
+                   'topologies': manifest,
+                   'skipped': sorted(skipped_files - set(entry['file'] for entry in manifest))},
+                  manifest_file, indent=2, sort_keys=True)
+        manifest_file.write('\n')
+
+    return built
 
 ########################################
 ###### Configure logging behavior ######
@@ -132,6 +3512,110 @@ def _configureLogging(loglevel):
 #######################################################
 # Add the user defined command line arguments in this function
 
+def _add_logging_options(parser):
+    """
+    Adds the logging options that are shared by all the commands
+    """
+    loggingGroupOpts = parser.add_argument_group('Logging Options', 'List of optional logging options')
+    loggingGroupOpts.add_argument("-q", "--quiet",
+                                  action="store_true",
+                                  default=False,
+                                  dest="isQuiet",
+                                  help="Disable logging in the console.")
+    loggingGroupOpts.add_argument("-l", "--loglevel",
+                                  action="store",
+                                  default="INFO",
+                                  dest="loglevel",
+                                  metavar="LOG_LEVEL",
+                                  help="LOG_LEVEL might be set to: CRITICAL, ERROR, WARNING, INFO, DEBUG. (Default: INFO)")
+
+#----------------------------------------------------------------------
+COMMANDS = ['sweep', 'xgft', 'validate', 'convert']
+
+def _split_command(argv):
+    """
+    Returns the (command, arguments) pair of the command line arguments
+    argv: the command of COMMANDS, or None for the k-ary-n-tree builder,
+    and the arguments of the command. The logging options, which are
+    shared by all the commands, may also come before the command.
+    """
+    import re
+
+    index = 0
+    while index < len(argv):
+        if argv[index] in ('-q', '--quiet') or argv[index].startswith('--loglevel=') or re.match(r'-l.', argv[index]):
+            index += 1
+        elif argv[index] in ('-l', '--loglevel'):
+            index += 2
+        else:
+            break
+    if index < len(argv) and argv[index] in COMMANDS:
+        return argv[index], argv[:index] + argv[index + 1:]
+    return None, argv
+
+#----------------------------------------------------------------------
+def _add_max_switch_ports_option(parser):
+    """
+    Adds the option that sets the max allowed ports per switch
+    """
+    parser.add_argument("--max-switch-ports",
+                        action="store",
+                        type=int,
+                        default=MAX_SW_PORTS,
+                        dest="max_sw_ports",
+                        metavar="PORTS",
+                        help="Refuse to build trees that need more than PORTS ports per switch. 0 means no limit. (Default: {})".format(MAX_SW_PORTS))
+
+#----------------------------------------------------------------------
+def _add_binary_option(parser):
+    """
+    Adds the option that also writes the topology in the binary format
+    """
+    parser.add_argument("-B", "--binary",
+                        action="store",
+                        default=None,
+                        dest="binary",
+                        metavar="FILE",
+                        help="Also write the topology in FILE in the binary format, which loads without parsing. Use '" + PROGRAM_NAME +
+                        " convert FILE' to expand it to ibnetdiscover text.")
+
+#----------------------------------------------------------------------
+def _add_dot_options(parser):
+    """
+    Adds the options that write the topology as a Graphviz DOT graph
+    """
+    dotGroupOpts = parser.add_argument_group('Graphviz Options', 'Write the fabric as a Graphviz DOT graph, with every level of the fat-tree at the same rank')
+    dotGroupOpts.add_argument("--dot",
+                              action="store",
+                              default=None,
+                              dest="dot",
+                              metavar="FILE",
+                              help="Write the DOT graph in FILE.")
+    dotGroupOpts.add_argument("--dot-detail",
+                              action="store",
+                              type=parse_dot_detail,
+                              default=('full', None),
+                              dest="dot_detail",
+                              metavar="DETAIL",
+                              help="The level of detail of the DOT graph: full (every node), hcas (the HCAs of every leaf switch are one node) or"
+                              " subtrees:DEPTH (the sub-trees of DEPTH levels of switches and the matching groups of the upper levels are one node),"
+                              " with the number of links on every edge. Only the k-ary-n-trees can be collapsed. (Default: full)")
+
+#----------------------------------------------------------------------
+def write_dot_output(topology, path, detail):
+    """
+    Writes the DOT graph of the topology in the file "path", or exits with an error
+    """
+    try:
+        with open(path, 'w', buffering=OUTPUT_BUFFER_SIZE) as dot_file:
+            write_dot(topology, dot_file, *detail)
+    except ValueError as e:
+        error_and_exit(str(e))
+    except (IOError, OSError) as e:
+        error_and_exit("Cannot write the DOT graph in {}: {}".format(path, e.strerror))
+    LOG.info("The DOT graph was written in {}\n".format(path))
+
+#----------------------------------------------------------------------
 def _command_Line_Options():
     """
     Define the accepted command line arguments in this function
@@ -140,29 +3624,19 @@ def _command_Line_Options():
     argument parsing examples
     http://docs.python.org/2/library/argparse.html
     """
+    import argparse
 
-    parser = argparse.ArgumentParser(description=PROGRAM_NAME + " will build a k-ary-n-tree of a given k/n. The output is in the format used by ibnetdiscover utility,"
-                                     " meaning that you can use the topologies generated by this script directly in ibsim. The output is printed in STDOUT, so if you"
-                                     " want to save the generated topology in a file for further analysis or use with different tools, you need to redirect the output"
-                                     " of the script in a file.")
+    parser = argparse.ArgumentParser(epilog="Use '%(prog)s sweep -h' to see how to build many topologies at once, '%(prog)s xgft -h' to build extended generalized fat trees, '%(prog)s validate -h' to validate topology files, and '%(prog)s convert -h' to expand binary topology files.",
+                                     description=PROGRAM_NAME + " will build a k-ary-n-tree of a given k/n. The output is in the format used by ibnetdiscover utility,"
+                                     " meaning that you can use the topologies generated by this script directly in ibsim. The output is printed in STDOUT, unless"
+                                     " an output file is given with the --output option.")
 
     parser.add_argument("-v", "--version",
                         action="version", default=argparse.SUPPRESS,
                         version=VERSION,
                         help="show program's version number and exit")
 
-    loggingGroupOpts = parser.add_argument_group('Logging Options', 'List of optional logging options')
-    loggingGroupOpts.add_argument("-q", "--quiet",
-                                  action="store_true",
-                                  default=False,
-                                  dest="isQuiet",
-                                  help="Disable logging in the console.")
-    loggingGroupOpts.add_argument("-l", "--loglevel",
-                                  action="store",
-                                  default="INFO",
-                                  dest="loglevel",
-                                  metavar="LOG_LEVEL",
-                                  help="LOG_LEVEL might be set to: CRITICAL, ERROR, WARNING, INFO, DEBUG. (Default: INFO)")
+    _add_logging_options(parser)
 
     parser.add_argument("-k", "--ftree-half-ports-of-each-switch",
                         action="store",
@@ -190,10 +3664,339 @@ def _command_Line_Options():
                         default=1,
                         dest="oversub",
                         help="Choose the oversubscription rate.")
+    _add_max_switch_ports_option(parser)
+    parser.add_argument("--hcas",
+                        action="store",
+                        type=int,
+                        default=None,
+                        dest="hcas",
+                        metavar="N",
+                        help="Build a partially populated tree with N HCAs. The switches that are left with no HCAs below them are removed. (Default: as many HCAs as the tree has room for)")
+    parser.add_argument("--placement",
+                        action="store",
+                        choices=HCA_PLACEMENTS,
+                        default='packed',
+                        dest="placement",
+                        help="How the --hcas HCAs are placed on the leaf switches: 'packed' fills the leaves one after the other, 'spread' deals the HCAs to the leaves one at a time. (Default: packed)")
+    parser.add_argument("-s", "--stream",
+                        action="store_true",
+                        default=False,
+                        dest="stream",
+                        help="Generate and print the topology one node at a time, instead of building the whole fabric in memory first. The memory use stays flat regardless of the size of the fabric.")
+    parser.add_argument("-O", "--output",
+                        action="store",
+                        default=None,
+                        dest="output",
+                        metavar="FILE",
+                        help="Write the topology in FILE instead of STDOUT.")
+    parser.add_argument("-T", "--no-timestamp",
+                        action="store_true",
+                        default=False,
+                        dest="no_timestamp",
+                        help="Leave the generation time out of the header, so that the output is reproducible.")
+    _add_binary_option(parser)
+    parser.add_argument("-j", "--jobs",
+                        action="store",
+                        type=int,
+                        default=1,
+                        dest="jobs",
+                        metavar="JOBS",
+                        help="Write the --output file with JOBS processes, each of them writing its share of the nodes in place. 0 starts one process per available core. (Default: 1)")
+
+    profileGroupOpts = parser.add_argument_group('Profiling Options', 'Find out which phase of the generation takes the time')
+    profileGroupOpts.add_argument("-p", "--profile",
+                                  action="store_true",
+                                  default=False,
+                                  dest="profile",
+                                  help="Log the elapsed time, the peak memory and the node/link counts of every phase (node initialization, switch wiring, HCA wiring, trimming and output). The peak memory of every phase is traced with tracemalloc, which slows the phases down.")
+    profileGroupOpts.add_argument("--profile-json",
+                                  action="store",
+                                  default=None,
+                                  dest="profile_json",
+                                  metavar="FILE",
+                                  help="Also write the profile of every phase in FILE as JSON. Implies --profile.")
+
+    cacheGroupOpts = parser.add_argument_group('Cache Options', 'Serve repeated topologies from an on-disk cache')
+    cacheGroupOpts.add_argument("-c", "--cache",
+                                action="store_true",
+                                default=False,
+                                dest="cache",
+                                help="Use the topology cache. Topologies that were generated before with the same parameters are copied from the cache instead of being built again.")
+    cacheGroupOpts.add_argument("--cache-dir",
+                                action="store",
+                                default=None,
+                                dest="cache_dir",
+                                metavar="DIR",
+                                help="The directory of the topology cache. Implies --cache. (Default: $XDG_CACHE_HOME/FatTreeBuilder or ~/.cache/FatTreeBuilder)")
+    cacheGroupOpts.add_argument("--cache-size",
+                                action="store",
+                                type=int,
+                                default=DEFAULT_CACHE_SIZE,
+                                dest="cache_size",
+                                metavar="MB",
+                                help="The max size of the topology cache. The least recently used topologies are evicted when it grows bigger. (Default: {} MB)".format(DEFAULT_CACHE_SIZE))
+
+    parser.add_argument("-V", "--validate",
+                        action="store_true",
+                        default=False,
+                        dest="validate",
+                        help="Check that the generated fabric is a valid k-ary-n-tree (port symmetry, the links of every level, no dangling or doubly used ports,"
+                        " the placement of the HCAs) and log its diameter, bisection width and up-path diversity. The exit status is 1 if it is not valid.")
+
+    failureGroupOpts = parser.add_argument_group('Failure Injection Options', 'Write variants of the fabric with random link or switch failures, instead of the fabric itself')
+    failureGroupOpts.add_argument("-F", "--failures",
+                                  action="store",
+                                  type=parse_failure_spec,
+                                  default=None,
+                                  dest="failures",
+                                  metavar="SPEC",
+                                  help="Fail a random set of links or switches in every variant. SPEC is links:COUNT, links:PERCENT%%, switches:COUNT or switches:PERCENT%%."
+                                  " The nodes that are left without any link are removed.")
+    failureGroupOpts.add_argument("--variants",
+                                  action="store",
+                                  type=int,
+                                  default=1,
+                                  dest="variants",
+                                  metavar="N",
+                                  help="The number of failure variants. If more than 1, variant V is written in FILE-failures-VVVV.topo, where FILE.topo is the --output file. (Default: 1)")
+    failureGroupOpts.add_argument("--seed",
+                                  action="store",
+                                  type=int,
+                                  default=0,
+                                  dest="seed",
+                                  metavar="SEED",
+                                  help="The random seed of the failures. The same seed gives the same variants. (Default: 0)")
 
+    routingGroupOpts = parser.add_argument_group('Routing Options', 'Compute the up*/down* (D-mod-K) routing tables of the fat-tree')
+    routingGroupOpts.add_argument("--lft",
+                                  action="store",
+                                  default=None,
+                                  dest="lft",
+                                  metavar="FILE",
+                                  help="Write the linear forwarding tables of all the switches in FILE, in the format of the opensm-lfts.dump file of OpenSM. The LIDs are assigned in node order, starting from 1.")
+    routingGroupOpts.add_argument("--guid2lid",
+                                  action="store",
+                                  default=None,
+                                  dest="guid2lid",
+                                  metavar="FILE",
+                                  help="Write the LIDs of the --lft tables in FILE, in the format of the guid2lid file of OpenSM.")
+    trafficGroupOpts = parser.add_argument_group('Traffic Analysis Options', 'Find out how loaded the links get under synthetic traffic, with the routing of --lft')
+    trafficGroupOpts.add_argument("-t", "--traffic",
+                                  action="append",
+                                  type=parse_traffic_pattern,
+                                  default=[],
+                                  dest="traffic",
+                                  metavar="PATTERN",
+                                  help="Route the traffic PATTERN and log the max and mean load of the links of every level. PATTERN is one of all-to-all, shift[:DISTANCE],"
+                                  " random[:SEED] or bisection[:SEED]. Can be given more than once.")
+    trafficGroupOpts.add_argument("--traffic-json",
+                                  action="store",
+                                  default=None,
+                                  dest="traffic_json",
+                                  metavar="FILE",
+                                  help="Also write the load distribution of every link level of the --traffic patterns in FILE as JSON.")
+    _add_dot_options(parser)
 
     opts = parser.parse_args()
 
+    if(opts.isQuiet):
+        opts.loglevel = "NOTSET"
+    if not opts.max_sw_ports:
+        opts.max_sw_ports = None
+
+    return opts
+
+#----------------------------------------------------------------------
+def _sweep_Command_Line_Options(argv):
+    """
+    Define the accepted command line arguments of the sweep command
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog=PROGRAM_NAME + " sweep",
+                                     description="Build a k-ary-n-tree for every combination of the given k, n and oversubscription values,"
+                                     " both with and without fully connected root switches, in parallel. The combinations that need too many ports"
+                                     " per switch are skipped without building anything. Every topology is written in DEST_DIR/k-XX-n-YY-o-ZZ[-Full].topo"
+                                     " and a summary of all the files is written in DEST_DIR/manifest.json.")
+
+    _add_logging_options(parser)
+
+    parser.add_argument("-k", "--ftree-half-ports-of-each-switch",
+                        action="store",
+                        type=parse_int_list,
+                        default="2-19",
+                        dest="ks",
+                        metavar="K_LIST",
+                        help="The k values, like 2-19 or 2,4,8. (Default: 2-19)")
+    parser.add_argument("-n", "--ftree-levels",
+                        action="store",
+                        type=parse_int_list,
+                        default="2-4",
+                        dest="ns",
+                        metavar="N_LIST",
+                        help="The n values. (Default: 2-4)")
+    parser.add_argument("-o", "--oversubscription",
+                        action="store",
+                        type=parse_int_list,
+                        default="1,2,4",
+                        dest="oversubs",
+                        metavar="OVERSUB_LIST",
+                        help="The oversubscription rates. (Default: 1,2,4)")
+    parser.add_argument("-d", "--dest-dir",
+                        action="store",
+                        default="built-topologies",
+                        dest="dest_dir",
+                        metavar="DEST_DIR",
+                        help="The directory to write the topologies in. (Default: built-topologies)")
+    parser.add_argument("-j", "--jobs",
+                        action="store",
+                        type=int,
+                        default=0,
+                        dest="jobs",
+                        metavar="JOBS",
+                        help="The number of topologies to build in parallel. 0 starts one process per available core. (Default: 0)")
+    _add_max_switch_ports_option(parser)
+    parser.add_argument("-V", "--validate",
+                        action="store_true",
+                        default=False,
+                        dest="validate",
+                        help="Validate every topology (see the --validate option of " + PROGRAM_NAME + ") and store the errors and the metrics in the manifest.")
+
+    opts = parser.parse_args(argv)
+
+    if(opts.isQuiet):
+        opts.loglevel = "NOTSET"
+    if not opts.max_sw_ports:
+        opts.max_sw_ports = None
+
+    return opts
+
+#----------------------------------------------------------------------
+def _xgft_Command_Line_Options(argv):
+    """
+    Define the accepted command line arguments of the xgft command
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog=PROGRAM_NAME + " xgft",
+                                     description="Build an extended generalized fat tree XGFT(h; m1..mh; w1..wh), where every node of level i has m_i"
+                                     " children and w_(i+1) parents (the HCAs are level 0). The height h is the number of m and w values. The output is in"
+                                     " the same ibnetdiscover format as the k-ary-n-trees. For example, XGFT(3; 4,4,4; 1,4,4) is the 4-ary-3-tree.")
+
+    _add_logging_options(parser)
+
+    parser.add_argument("-m", "--children",
+                        action="store",
+                        type=parse_level_list,
+                        required=True,
+                        dest="m",
+                        metavar="M_LIST",
+                        help="The number of children of the nodes of every level, m1,m2,..,mh. m1 is the number of HCAs per leaf switch.")
+    parser.add_argument("-w", "--parents",
+                        action="store",
+                        type=parse_level_list,
+                        required=True,
+                        dest="w",
+                        metavar="W_LIST",
+                        help="The number of parents of the nodes of every level, w1,w2,..,wh. w1 is the number of ports of every HCA.")
+    _add_max_switch_ports_option(parser)
+    parser.add_argument("-O", "--output",
+                        action="store",
+                        default=None,
+                        dest="output",
+                        metavar="FILE",
+                        help="Write the topology in FILE instead of STDOUT.")
+    parser.add_argument("-T", "--no-timestamp",
+                        action="store_true",
+                        default=False,
+                        dest="no_timestamp",
+                        help="Leave the generation time out of the header, so that the output is reproducible.")
+    _add_binary_option(parser)
+    parser.add_argument("-V", "--validate",
+                        action="store_true",
+                        default=False,
+                        dest="validate",
+                        help="Check that the generated fabric is a valid XGFT and log its diameter and up-path diversity. The exit status is 1 if it is not valid.")
+    _add_dot_options(parser)
+
+    opts = parser.parse_args(argv)
+
+    if(opts.isQuiet):
+        opts.loglevel = "NOTSET"
+    if not opts.max_sw_ports:
+        opts.max_sw_ports = None
+
+    return opts
+
+#----------------------------------------------------------------------
+def _validate_Command_Line_Options(argv):
+    """
+    Define the accepted command line arguments of the validate command
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog=PROGRAM_NAME + " validate",
+                                     description="Validate ibnetdiscover topology files. The links of every file are checked for dangling, doubly used"
+                                     " and asymmetric ports. The files written by " + PROGRAM_NAME + " are also checked against the definition of the"
+                                     " k-ary-n-tree in their header, and their diameter, bisection width and up-path diversity are reported."
+                                     " The exit status is 1 if any file is not valid.")
+
+    _add_logging_options(parser)
+
+    parser.add_argument("files",
+                        nargs='+',
+                        metavar="FILE",
+                        help="The topology files to validate, in the ibnetdiscover or in the binary format.")
+    parser.add_argument("--json",
+                        action="store",
+                        default=None,
+                        dest="json",
+                        metavar="JSON_FILE",
+                        help="Also write the validation report of every file in JSON_FILE.")
+
+    opts = parser.parse_args(argv)
+
+    if(opts.isQuiet):
+        opts.loglevel = "NOTSET"
+
+    return opts
+
+#----------------------------------------------------------------------
+def _convert_Command_Line_Options(argv):
+    """
+    Define the accepted command line arguments of the convert command
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog=PROGRAM_NAME + " convert",
+                                     description="Expand a topology of the binary format (see --binary) to the ibnetdiscover format, for example for ibsim.")
+
+    _add_logging_options(parser)
+
+    parser.add_argument("file",
+                        metavar="FILE",
+                        help="The binary topology file.")
+    parser.add_argument("-O", "--output",
+                        action="store",
+                        default=None,
+                        dest="output",
+                        metavar="FILE",
+                        help="Write the topology in FILE instead of STDOUT.")
+    parser.add_argument("-T", "--no-timestamp",
+                        action="store_true",
+                        default=False,
+                        dest="no_timestamp",
+                        help="Leave the conversion time out of the header, so that the output is reproducible.")
+    parser.add_argument("-j", "--jobs",
+                        action="store",
+                        type=int,
+                        default=1,
+                        dest="jobs",
+                        metavar="JOBS",
+                        help="Write the --output file with JOBS processes (see '" + PROGRAM_NAME + " --jobs'). 0 starts one process per available core. (Default: 1)")
+
+    opts = parser.parse_args(argv)
+
     if(opts.isQuiet):
         opts.loglevel = "NOTSET"
 
@@ -207,6 +4010,110 @@ if __name__ == '__main__':
     """
     Write the main program here
     """
+    command, arguments = _split_command(sys.argv[1:])
+
+    if command == 'sweep':
+        options = _sweep_Command_Line_Options(arguments)
+        _configureLogging(options.loglevel)
+        LOG.info("{} v{} is running...\n".format(PROGRAM_NAME, VERSION))
+
+        if options.jobs < 0:
+            error_and_exit("The number of processes cannot be negative")
+
+        manifest = sweep(options.ks, options.ns, options.oversubs, options.dest_dir, options.jobs or None, options.max_sw_ports, validate=options.validate)
+        LOG.info("All {} topologies built. Find the topology files in the directory {}".format(len(manifest), options.dest_dir))
+        invalid = [entry['file'] for entry in manifest if not entry.get('valid', True)]
+        if invalid:
+            LOG.error("{} topologies are not valid: {}".format(len(invalid), ', '.join(sorted(invalid))))
+            sys.exit(1)
+        sys.exit(0)
+
+    if command == 'xgft':
+        options = _xgft_Command_Line_Options(arguments)
+        _configureLogging(options.loglevel)
+        LOG.info("{} v{} is running...\n".format(PROGRAM_NAME, VERSION))
+
+        try:
+            topology = build_xgft(options.m, options.w, options.max_sw_ports)
+        except ValueError as e:
+            error_and_exit(str(e))
+
+        output = open_output(options.output)
+        write_ibnetdiscover(topology, output, '' if options.no_timestamp else None)
+        if output is not sys.stdout:
+            output.close()
+            LOG.info("The topology was written in {}\n".format(options.output))
+        if options.binary:
+            write_binary_output(topology, options.binary)
+        if options.dot:
+            write_dot_output(topology, options.dot, options.dot_detail)
+
+        valid = True
+        if options.validate:
+            report = validate_topology(topology)
+            log_validation_report(topology.tree.description(), report)
+            valid = report.valid
+
+        LOG.info("Total number of nodes: {}\n"
+                 "Total number of Switches: {}\n"
+                 "Total number of HCAs: {}\n".format(topology.tree.number_of_nodes, topology.tree.number_of_sw, topology.tree.number_of_hca))
+        sys.exit(0 if valid else 1)
+
+    if command == 'validate':
+        options = _validate_Command_Line_Options(arguments)
+        _configureLogging(options.loglevel)
+        LOG.info("{} v{} is running...\n".format(PROGRAM_NAME, VERSION))
+
+        reports = {}
+        for path in options.files:
+            try:
+                if is_topology_binary(path):
+                    topology = load_topology_binary(path, copy=True)
+                else:
+                    topology = parse_ibnetdiscover(path)
+            except (IOError, OSError, ValueError) as e:
+                error_and_exit("Cannot load {}: {}".format(path, e))
+            report = validate_topology(topology)
+            log_validation_report(path, report)
+            reports[path] = report.as_dict()
+
+        if options.json:
+            import json
+
+            with open(options.json, 'w') as report_file:
+                json.dump({'version': VERSION, 'files': reports}, report_file, indent=2, sort_keys=True)
+                report_file.write('\n')
+        sys.exit(0 if all(report['valid'] for report in reports.values()) else 1)
+
+    if command == 'convert':
+        options = _convert_Command_Line_Options(arguments)
+        _configureLogging(options.loglevel)
+        LOG.info("{} v{} is running...\n".format(PROGRAM_NAME, VERSION))
+
+        if options.jobs != 1 and options.output is None:
+            error_and_exit("Use --output to give the file name of the parallel output")
+        if options.jobs < 0:
+            error_and_exit("The number of output processes cannot be negative")
+        try:
+            topology = load_topology_binary(options.file)
+        except (IOError, OSError, ValueError) as e:
+            error_and_exit("Cannot load {}: {}".format(options.file, e))
+
+        timestamp = '' if options.no_timestamp else None
+        if options.jobs != 1:
+            try:
+                write_ibnetdiscover_parallel(topology, options.output, options.jobs or None, timestamp)
+            except (IOError, OSError) as e:
+                error_and_exit("Cannot write the topology in {}: {}".format(options.output, e))
+        else:
+            output = open_output(options.output)
+            write_ibnetdiscover(topology, output, timestamp)
+            if output is not sys.stdout:
+                output.close()
+        if options.output is not None:
+            LOG.info("The topology was written in {}\n".format(options.output))
+        sys.exit(0)
+
     # Parse the command line options
     options = _command_Line_Options()
     # Configure logging
@@ -221,269 +4128,166 @@ if __name__ == '__main__':
     #LOG.info("INFO message are printed")
     #LOG.debug("DEBUG messages are printed")
 
-    # The output of ibnetdiscover looks like this:
-    # vendid=0x0
-    # devid=0x0
-    # sysimgguid=0x200000
-    # switchguid=0x200000(200000)
-    # Switch  4 "S-0000000000200000"          # "Switch0" base port 0 lid 1 lmc 0
-    # [1]     "S-0000000000200004"[3]         # "Switch4" lid 7 4xSDR
-    # [2]     "S-0000000000200005"[3]         # "Switch5" lid 9 4xSDR
-    # [3]     "H-0000000000100000"[1](100001)                 # "Hca0" lid 2 4xSDR
-    # [4]     "H-0000000000100002"[1](100003)                 # "Hca1" lid 5 4xSDR
-    #
-    # vendid=0x0
-    # devid=0x0
-    # sysimgguid=0x10000e
-    # caguid=0x10000e
-    # Ca      1 "H-000000000010000e"          # "Hca7"
-    # [1](10000f)     "S-0000000000200003"[4]         # lid 20 lmc 0 "Switch3" lid 6 4xSDR
-    #
-    # Based on this output, here I make template lines with placeholders for different purposes:
-    # The place holders must be replced with:
-    #    node_type_long = Switch or Hca
-    #    node_type_short = S or H (for switch or hca respectively)
-    #    total_port = total number of ports for this node
-    #    node_guid = the GUID of this node
-    #    node_name = the name of this node
-    node_line = '{node_type_long}\t{total_ports} "{node_type_short}-{node_guid}"\t\t# "{node_name}"'
-    #    local_port = An integer showing which local port is connected to a remote
-    #    rem_node_type_short = S or H
-    #    rem_node_guid = The guid of the remote node
-    #    rem_port = the port of the remote node that we connect with
-    #    rem_node_name = the name of the remote node
-    #    link_speed = something like 4xSDR, 4xDDR, 4xQDR, 4xFDR, 4xEDR, 4xHDR indicating the link speed
-    #    local_port_guid = If the local port is an HCA port, then we need to define the local port guid
-    #    rem_port_guid = If the remote port is an HCA port, then we need to define the remote port guid
-    port_lines = {}
-    port_lines['switch'] = {}
-    # line to use if local is a switch, remote is a switch
-    port_lines['switch']['switch'] = '[{local_port}]\t"{rem_node_type_short}-{rem_node_guid}"[{rem_port}]\t\t# "{rem_node_name}" lid 0 {link_speed}'
-    # line to use if local is a switch, remote is an hca
-    port_lines['switch']['hca'] = '[{local_port}]\t"{rem_node_type_short}-{rem_node_guid}"[{rem_port}]({rem_port_guid}) \t\t# "{rem_node_name}" lid 0 {link_speed}'
-    port_lines['hca'] = {}
-    # line to use if local is an hca, remote is a switch
-    port_lines['hca']['switch'] = '[{local_port}]({local_port_guid}) \t"{rem_node_type_short}-{rem_node_guid}"[{rem_port}]\t\t# lid 0 lmc 0 "{rem_node_name}" lid 0 {link_speed}'
-    # line to use if local is an hca, remote is an hca
-    port_lines['hca']['hca'] = '[{local_port}]({local_port_guid}) \t"{rem_node_type_short}-{rem_node_guid}"[{rem_port}]({rem_port_guid}) \t\t# lid 0 lmc 0 "{rem_node_name}" lid 0 {link_speed}'
-
-    hca_guid_base = 0x1000000 # We want to define a GUID for each HCA and each port. The node GUID of the first Hca will be hca_guid_base
-    port_guid_base = hca_guid_base + 0x1000000
-    sw_guid_base = port_guid_base + 0x1000000
-    default_link_speed = '4xEDR'
-    max_sw_ports = 48 # Max ports per switch in the generated topology. If the user chooses some insanely huge topology
-                      # that requires very many ports per sw, do not build the topology. At the moment, the OmniPath architecture
-                      # offers switches with up to 48 ports, Oracle IB EDR Switches offer up to 38 4x ports and Mellanox switches
-                      # offer up to 36 ports.
-
-    k = options.k # k (k-ary-n-Tree) is half the number of ports for each switch
-    n = options.n # n (k-ary-n-Tree) is the number of levels in the tree
-
-    fully_connected_roots = options.fully_connected_roots # In a k-ary-n-tree, the root switches will have only half of their ports connected.
-                                                          # If fully_connected_roots = True, then another k-ary-n-tree will be connected to the
-                                                          # empty ports of the root switches, effectively doubling the number of nodes in the
-                                                          # network.
-
-    oversub = options.oversub
-
-    # Find how many ports per switch are needed in the leaf level:
-    #     k ports goes up, and k * oversub ports go down to the hosts.
-    # If more than max_sw_ports, then exit.
-    ports_per_sw = k + (k * oversub)
-    if ports_per_sw > max_sw_ports:
-        error_and_exit("{} ports are needed per switch, but the"
-                       " max allowed ports per switch are {}".format(
-                           ports_per_sw, max_sw_ports))
-
-    sw_per_row = k**(n-1)
-
-    if fully_connected_roots:
-        number_of_sw  = sw_per_row * ((n * 2) - 1)
-        number_of_hca = k**n * 2 * oversub
-    else:
-        number_of_sw  = sw_per_row * n
-        number_of_hca = k**n * oversub
+    timestamp = '' if options.no_timestamp else None
+    use_cache = options.cache or options.cache_dir is not None
+    profiler = PhaseProfiler() if options.profile or options.profile_json else NULL_PROFILER
 
-    topology = OrderedDict()
+    if options.hcas is not None or options.placement != 'packed':
+        if options.stream or use_cache:
+            error_and_exit("--hcas and --placement cannot be combined with --stream or --cache")
+        if options.lft or options.guid2lid or options.traffic:
+            error_and_exit("The routing tables and the traffic analysis need a fully populated tree with packed HCAs")
 
-    # Initialize all switches
-    for sw_no in xrange(number_of_sw):
-        sw = "Switch{}".format(sw_no)
-        topology[sw] = {}
+    if (options.binary or options.dot) and (options.stream or use_cache):
+        error_and_exit("The binary output and the DOT graph cannot be combined with --stream or --cache")
 
-        topology[sw]['node_type'] = 'switch'
-        topology[sw]['ports'] = {}
-        topology[sw]['guids'] = {}
+    if options.jobs != 1:
+        if options.stream or use_cache or options.failures is not None:
+            error_and_exit("The parallel output cannot be combined with --stream, --cache or --failures")
+        if options.output is None:
+            error_and_exit("Use --output to give the file name of the parallel output")
+        if options.jobs < 0:
+            error_and_exit("The number of output processes cannot be negative")
 
-        topology[sw]['guids']['node'] = sw_guid_base + sw_no
-        for port in xrange(1, ports_per_sw + 1):
-            topology[sw]['ports'][port] = None
-        topology[sw]['total_ports'] = len(topology[sw]['ports'])
+    if options.failures is not None:
+        if options.stream or use_cache:
+            error_and_exit("The failure variants cannot be combined with --stream or --cache")
+        if options.variants < 1:
+            error_and_exit("The number of failure variants must be at least 1")
+        if options.variants > 1 and options.output is None:
+            error_and_exit("Use --output to give the file name of the failure variants")
 
-    # Initialize all Hca's
-    for hca_no in xrange(number_of_hca):
-        hca = "Hca{}".format(hca_no)
-        topology[hca] = {}
-        topology[hca]['node_type'] = 'hca'
-        topology[hca]['guids'] = {}
-        topology[hca]['ports'] = {}
-
-        #topology[hca]['guids']['node'] = hca_guid_base + hca_no * 2
-        topology[hca]['guids']['node'] = hca_guid_base + hca_no
-        topology[hca]['ports'][1] = None
-        topology[hca]['total_ports'] = len(topology[hca]['ports'])
-        #topology[hca]['guids'][1] = topology[hca]['guids']['node'] + 1
-        topology[hca]['guids'][1] = port_guid_base + hca_no
+    try:
+        if options.stream or use_cache:
+            # The stream mode generates and prints the topology one node at a time,
+            # without building the whole fabric in memory. With the cache, the
+            # topology is only built on a cache miss.
+            tree = KAryNTree(options.k, options.n, options.oversub, options.fully_connected_roots, options.max_sw_ports)
+        else:
+            topology = build_fat_tree(options.k, options.n, options.oversub, options.fully_connected_roots, options.max_sw_ports, profiler,
+                                      options.hcas, options.placement)
+            tree = topology.tree
+        if options.lft or options.guid2lid:
+            # Check the routing tables before any output is opened
+            check_lid_space(tree)
+        if options.lft:
+            check_port_space(tree)
+    except ValueError as e:
+        error_and_exit(str(e))
 
-    # First connect the switches between them, to form the fat tree.
-    for sw_no in xrange(number_of_sw):
-        sw = "Switch{}".format(sw_no)
-        level = sw_no // sw_per_row
+    if options.binary:
+        with profiler.phase('binary_output', topology.counts):
+            write_binary_output(topology, options.binary)
+    if options.dot:
+        with profiler.phase('dot_output', topology.counts):
+            write_dot_output(topology, options.dot, options.dot_detail)
 
-        remote_port_offset = k
-        remote_sw_offset = 0
+    if options.failures is not None:
+        # Write the failure variants instead of the topology
+        if options.variants == 1:
+            open_variant = lambda variant: open_output(options.output)
+        else:
+            open_variant = lambda variant: open_output(failure_variant_path(options.output, variant))
+        with profiler.phase('failure_variants', topology.counts):
+            summaries = write_failure_variants(topology, options.failures[0], options.failures[1], options.variants, open_variant,
+                                               options.seed, timestamp)
+        for summary in summaries:
+            LOG.info("Failure variant {variant}: {failed_switches} failed switches, {failed_links} failed links, {pruned_nodes} pruned nodes".format(**summary))
+        if options.output is not None:
+            LOG.info("The failure variants were written in {}\n".format(
+                options.output if options.variants == 1 else "{}-failures-*{}".format(*os.path.splitext(options.output))))
+    elif options.jobs != 1:
+        with profiler.phase('parallel_output', topology.counts):
+            try:
+                write_ibnetdiscover_parallel(topology, options.output, options.jobs or None, timestamp)
+            except (IOError, OSError) as e:
+                error_and_exit("Cannot write the topology in {}: {}".format(options.output, e))
+        LOG.info("The topology was written in {}\n".format(options.output))
+    else:
+        output = open_output(options.output)
+        if use_cache:
+            try:
+                cache = TopologyCache(options.cache_dir, options.cache_size)
+            except (IOError, OSError) as e:
+                error_and_exit("Cannot use the topology cache: {}".format(e))
+            write_cached_ibnetdiscover(cache, tree, output, timestamp, options.stream, profiler=profiler)
+        elif options.stream:
+            with profiler.phase('stream_output', tree.counts):
+                stream_ibnetdiscover(tree, output, timestamp)
+        else:
+            with profiler.phase('output', topology.counts):
+                write_ibnetdiscover(topology, output, timestamp)
 
-        # If currently processed level is on the root switches, do nothing.
-        # We start processing the connectivity from the leaf switches and we go upwards,
-        # meaning that when we reach the root switches, the connectivity is already established.
-        if (level == (n - 1)):
-            continue
-        # If the roots are fully connected, the level variable will take values
-        # greater than n. This is an indication that we have to build a second
-        # subtree.
-        elif (level > (n - 1)):
-            level -= n
-            # If we are processing the level before the root switches on the second subtree
-            # We need to have an offset in the remote switch IDs and the ports of the root switches,
-            # because half of the ports are already occupied by the first subtree.
-            if (level == (n - 2)):
-                remote_port_offset = 0
-                remote_sw_offset = n * sw_per_row
-
-        # The first k ports connect to the second k ports of the
-        # switches in the upwards direction.
-        # level = 0 indicates we are on the leaf switches.
-        # level > 0 indicates we are going upwards towards the root switches.
-
-        start_sw_upper_row = (level * sw_per_row) + sw_per_row
-        sw_index_this_row = sw_no - (level * sw_per_row)
-        sw_per_port_step_upper_row = k**level
-        pattern_multiplier = (sw_index_this_row // sw_per_port_step_upper_row // k) * sw_per_port_step_upper_row
-
-        for port in xrange(1, k + 1):
-            remote_sw_no = \
-                start_sw_upper_row + \
-                (port - 1) * sw_per_port_step_upper_row + \
-                pattern_multiplier * k + \
-                sw_index_this_row % sw_per_port_step_upper_row - \
-                remote_sw_offset
-
-
-            remote_sw = "Switch{}".format(remote_sw_no)
-
-            remote_port = remote_port_offset + 1
-            while topology[remote_sw]['ports'][remote_port] is not None:
-                remote_port += 1
-
-            topology[sw]['ports'][port] = {remote_sw: remote_port}
-            topology[remote_sw]['ports'][remote_port] = {sw: port}
+        if output is not sys.stdout:
+            output.close()
+            LOG.info("The topology was written in {}\n".format(options.output))
 
+    try:
+        if options.lft:
+            with profiler.phase('lft'):
+                with open(options.lft, 'wb') as lft_file:
+                    write_lft_dump(tree, lft_file)
+            LOG.info("The routing tables were written in {}\n".format(options.lft))
+        if options.guid2lid:
+            with open(options.guid2lid, 'w') as guid2lid_file:
+                write_guid2lid(tree, guid2lid_file)
+            LOG.info("The LIDs were written in {}\n".format(options.guid2lid))
+    except ValueError as e:
+        error_and_exit(str(e))
+    except (IOError, OSError) as e:
+        error_and_exit("Cannot write the routing tables: {}".format(e))
 
-    # Then connect the HCAs to the leaf switches.
-    for hca_no in xrange(number_of_hca):
-        hca = "Hca{}".format(hca_no)
-        sw_no = hca_no // (k * oversub)
-        if (sw_no > sw_per_row - 1):
-            sw_no += (n - 1) * sw_per_row
-        sw = "Switch{}".format(sw_no)
-        port = hca_no % (k * oversub) + (k + 1)
-        if sw_no > sw_per_row:
-            # For fully connected roots
-            sw_no = n * sw_per_row + (sw_no - n * sw_per_row)
-
-        topology[hca]['ports'][1] = {sw: port}
-        topology[sw]['ports'][port] = {hca: 1}
-
-    # Delete nodes that are not connected at all.
-    # (This will never really delete anything with the current implementation
-    # but keep it here for the future.)
-    for node_name in topology.keys():
-        empty = 1
-        for port in xrange(1, topology[node_name]['total_ports'] + 1):
-            if (topology[node_name]['ports'][port]):
-                empty = 0
-                break
+    valid = True
+    if options.validate:
+        if options.stream or use_cache:
+            # The stream and cache modes never build the fabric in memory, so build it just to validate it
+            topology = build_fat_tree(options.k, options.n, options.oversub, options.fully_connected_roots, options.max_sw_ports)
+        with profiler.phase('validate'):
+            report = validate_topology(topology)
+        log_validation_report(PROGRAM_NAME + " topology", report)
+        valid = report.valid
 
-        if (empty):
-            del topology[node_name]
-
-
-    # Print the topology
-    print('#')
-    print('# Topology file: generated with FatTreeBuilder.py on {}'.format(time.ctime()))
-    print('# https://github.com/cyberang3l/InfiniBand-Topology-Builder/')
-    print('#')
-    print('# Topology description')
-    print('# -------------------------------')
-    print('# k = {}, n = {}, oversubscription = {}{fully_populated}'.format(k, n, oversub, fully_populated=', Fully populated' if fully_connected_roots else ''))
-    print('# Total number of nodes: {}'.format(number_of_hca + number_of_sw))
-    print('# Total number of Switches: {}'.format(number_of_sw))
-    print('# Total number of HCAs: {}'.format(number_of_hca))
-    print('#')
-    print('')
-
-    for local_node_name in topology.keys():
-        node_type = topology[local_node_name]['node_type']
-        node_type_long = "Ca" if node_type == 'hca' else "Switch"
-        node_type_short = "H" if node_type == 'hca' else "S"
-        node_guid = int_to_hex_str(topology[local_node_name]['guids']['node'], 16)
-
-
-        print('vendid=0x0')
-        print('devid=0x0')
-        print('sysimgguid={node_guid_with_0x}'.format(node_guid_with_0x = int_to_hex_str(topology[local_node_name]['guids']['node'], prefix_with_0x=True)))
-        if node_type == 'switch':
-            print('switchguid={node_guid_with_0x}({node_guid})'.format(node_guid_with_0x = int_to_hex_str(topology[local_node_name]['guids']['node'],
-                                                                                                          prefix_with_0x=True),
-                                                                       node_guid = int_to_hex_str(topology[local_node_name]['guids']['node'])))
-        elif node_type == 'hca':
-            print('caguid={node_guid_with_0x}'.format(node_guid_with_0x = int_to_hex_str(topology[local_node_name]['guids']['node'], prefix_with_0x=True)))
-
-        print(node_line.format(node_type_long = node_type_long,
-                               total_ports = topology[local_node_name]['total_ports'],
-                               node_type_short = node_type_short,
-                               node_guid = node_guid,
-                               node_name = local_node_name))
-        for port in xrange(1, topology[local_node_name]['total_ports'] + 1):
-            node_port_guid = int_to_hex_str(topology[local_node_name]['guids'][port]) if node_type == 'hca' else None
-            if topology[local_node_name]['ports'][port]:
-                rem_node_name = topology[local_node_name]['ports'][port].keys().pop()
-                rem_node_port = topology[local_node_name]['ports'][port].values().pop()
-                rem_node_type = topology[rem_node_name]['node_type']
-                rem_node_type_long = "Ca" if rem_node_type == 'hca' else "Switch"
-                rem_node_type_short = "H" if rem_node_type == 'hca' else "S"
-                rem_node_guid = int_to_hex_str(topology[rem_node_name]['guids']['node'], 16)
-                rem_node_port_guid = int_to_hex_str(topology[rem_node_name]['guids'][rem_node_port]) if rem_node_type == 'hca' else None
-
-                print(port_lines[node_type][rem_node_type].format(local_port = port,
-                                                                  rem_node_type_short = rem_node_type_short,
-                                                                  rem_node_guid = rem_node_guid,
-                                                                  rem_port = rem_node_port,
-                                                                  rem_node_name = rem_node_name,
-                                                                  link_speed = default_link_speed,
-                                                                  rem_port_guid = rem_node_port_guid,
-                                                                  local_port_guid = node_port_guid))
-
-            if (port == topology[local_node_name]['total_ports']):
-                print('')
+    traffic_reports = []
+    for pattern, argument in options.traffic:
+        name = pattern if argument is None else "{}:{}".format(pattern, argument)
+        with profiler.phase('traffic'):
+            loads = analyze_traffic(tree, pattern, argument)
+        log_traffic_summary(name, loads)
+        traffic_reports.append({'pattern': name, 'flows': loads.flows, 'links': loads.summary()})
+
+    if options.traffic_json:
+        import json
+
+        try:
+            with open(options.traffic_json, 'w') as report_file:
+                json.dump({'version': VERSION, 'k': options.k, 'n': options.n, 'oversub': options.oversub,
+                           'fully_connected_roots': options.fully_connected_roots, 'traffic': traffic_reports},
+                          report_file, indent=2, sort_keys=True)
+                report_file.write('\n')
+        except (IOError, OSError) as e:
+            error_and_exit("Cannot write the traffic report in {}: {}".format(options.traffic_json, e.strerror))
+
+    if options.profile_json:
+        import json
+
+        report = profiler.report(k=options.k, n=options.n, oversub=options.oversub,
+                                 fully_connected_roots=options.fully_connected_roots,
+                                 stream=options.stream, cache=use_cache)
+        try:
+            with open(options.profile_json, 'w') as report_file:
+                json.dump(report, report_file, indent=2, sort_keys=True)
+                report_file.write('\n')
+        except (IOError, OSError) as e:
+            error_and_exit("Cannot write the profile report in {}: {}".format(options.profile_json, e.strerror))
 
     # Print the informational message in the STDERR with LOG, so that it doesn't get in the output file when STDOUT is redirected in a file.
     LOG.info("Total number of nodes: {}\n"
              "Total number of Switches: {}\n"
-             "Total number of HCAs: {}\n".format(number_of_hca + number_of_sw, number_of_sw, number_of_hca))
+             "Total number of HCAs: {}\n".format(tree.switches_in_use() + tree.number_of_hca, tree.switches_in_use(), tree.number_of_hca))
 
-    LOG.info("If you want to generate a dot file from the generated topology, please use the script InfiniBand-Graphviz-ualization.\n"
-             "You can get a copy at: https://github.com/cyberang3l/InfiniBand-Graphviz-ualization.")
+    if not options.dot:
+        LOG.info("If you want to generate a dot file from the generated topology, use --dot FILE (with --dot-detail to collapse large trees),\n"
+                 "or the script InfiniBand-Graphviz-ualization. You can get a copy at: https://github.com/cyberang3l/InfiniBand-Graphviz-ualization.")
 
-    # Uncomment the following to see how the topology looks like in the dictionary
-    #print_(topology)
+    if not valid:
+        sys.exit(1)
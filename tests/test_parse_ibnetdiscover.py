@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Round trip tests of the ibnetdiscover parser of FatTreeBuilder.py
+#
+# Run with:
+#    python -m pytest -q
+#
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import FatTreeBuilder
+from FatTreeBuilder import Topology
+
+# A dump in the layout of a real ibnetdiscover run: vendor/device lines,
+# lids and LMCs in the comments, a router (Rt) between the two switches, a
+# switch port connected to an HCA that is not in the file, and node names
+# with spaces and semicolons.
+REAL_DUMP = """#
+# Topology file: generated on Tue Mar  5 10:12:45 2024
+#
+# Initiated from node 0002c90300a1b2c0 port 0002c90300a1b2c1
+
+vendid=0x2c9
+devid=0xcb84
+sysimgguid=0x7cfe900300bd3a40
+switchguid=0x7cfe900300bd3a40(7cfe900300bd3a40)
+Switch	36 "S-7cfe900300bd3a40"		# "MF0;leaf1:MSB7700/U1" enhanced port 0 lid 1 lmc 0
+[1]	"H-0002c90300a1b2c0"[1](2c90300a1b2c1) 		# "node01 HCA-1" lid 3 4xEDR
+[2]	"H-0002c90300a1b2d0"[1](2c90300a1b2d1) 		# "node02 HCA-1" lid 4 4xEDR
+[3]	"H-0002c90300ffff00"[1](2c90300ffff01) 		# "node99 HCA-1" lid 9 4xEDR
+[35]	"R-0008f10500201a00"[1]		# "ib-router-1" lid 7 4xEDR
+[36]	"S-7cfe900300bd3b40"[36]		# "MF0;spine1:MSB7700/U1" lid 2 4xEDR
+
+vendid=0x2c9
+devid=0xcb84
+sysimgguid=0x7cfe900300bd3b40
+switchguid=0x7cfe900300bd3b40(7cfe900300bd3b40)
+Switch	36 "S-7cfe900300bd3b40"		# "MF0;spine1:MSB7700/U1" enhanced port 0 lid 2 lmc 0
+[35]	"R-0008f10500201a00"[2]		# "ib-router-1" lid 7 4xEDR
+[36]	"S-7cfe900300bd3a40"[36]		# "MF0;leaf1:MSB7700/U1" lid 1 4xEDR
+
+vendid=0x8f1
+devid=0x5a5a
+sysimgguid=0x8f10500201a00
+Rt	2 "R-0008f10500201a00"		# "ib-router-1"
+[1](8f10500201a01) 	"S-7cfe900300bd3a40"[35]		# lid 7 lmc 0 "MF0;leaf1:MSB7700/U1" lid 1 4xEDR
+[2](8f10500201a02) 	"S-7cfe900300bd3b40"[35]		# lid 7 lmc 0 "MF0;spine1:MSB7700/U1" lid 2 4xEDR
+
+vendid=0x2c9
+devid=0x1017
+sysimgguid=0x2c90300a1b2c3
+caguid=0x2c90300a1b2c0
+Ca	1 "H-0002c90300a1b2c0"		# "node01 HCA-1"
+[1](2c90300a1b2c1) 	"S-7cfe900300bd3a40"[1]		# lid 3 lmc 0 "MF0;leaf1:MSB7700/U1" lid 1 4xEDR
+
+vendid=0x2c9
+devid=0x1017
+sysimgguid=0x2c90300a1b2d3
+caguid=0x2c90300a1b2d0
+Ca	1 "H-0002c90300a1b2d0"		# "node02 HCA-1"
+[1](2c90300a1b2d1) 	"S-7cfe900300bd3a40"[2]		# lid 4 lmc 0 "MF0;leaf1:MSB7700/U1" lid 1 4xEDR
+"""
+
+LEAF, SPINE, NODE01, NODE02 = range(4)
+
+
+class ParseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.topo')
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def write_text(self, text):
+        with open(self.path, 'w') as topology_file:
+            topology_file.write(text)
+
+    def round_trip(self, topology):
+        with open(self.path, 'w') as topology_file:
+            FatTreeBuilder.write_ibnetdiscover(topology, topology_file, timestamp='')
+        return FatTreeBuilder.parse_ibnetdiscover(self.path)
+
+    def assertSameTopology(self, built, parsed):
+        for attribute in ('node_type', 'node_guid', 'port_offset', 'port_guid', 'remote_node', 'remote_port'):
+            self.assertEqual(getattr(built, attribute), getattr(parsed, attribute), attribute)
+        self.assertEqual([built.node_name(node) for node in range(built.number_of_nodes)], parsed.names)
+
+
+class TestBuilderRoundTrip(ParseTestCase):
+
+    def test_fat_tree(self):
+        built = FatTreeBuilder.build_fat_tree(2, 3)
+        parsed = self.round_trip(built)
+        self.assertSameTopology(built, parsed)
+        self.assertIsInstance(parsed.tree, FatTreeBuilder.KAryNTree)
+        self.assertEqual(parsed.tree.description(), built.tree.description())
+
+    def test_oversubscribed_fully_connected_roots(self):
+        built = FatTreeBuilder.build_fat_tree(3, 3, oversub=2, fully_connected_roots=True)
+        parsed = self.round_trip(built)
+        self.assertSameTopology(built, parsed)
+        self.assertEqual(parsed.tree.description(), built.tree.description())
+
+    def test_partially_populated(self):
+        built = FatTreeBuilder.build_fat_tree(4, 3, hcas=21, placement='spread')
+        parsed = self.round_trip(built)
+        self.assertSameTopology(built, parsed)
+        self.assertEqual((parsed.tree.number_of_hca, parsed.tree.placement), (21, 'spread'))
+
+    def test_trimmed_switches(self):
+        # 13 HCAs fill 4 of the 16 leaves, so half of the switches are trimmed
+        built = FatTreeBuilder.build_fat_tree(4, 3, hcas=13)
+        self.assertLess(built.tree.switches_in_use(), built.tree.number_of_sw)
+        parsed = self.round_trip(built)
+        self.assertSameTopology(built, parsed)
+        self.assertEqual(built.active, parsed.active)
+        self.assertEqual(parsed.tree.description(), built.tree.description())
+        self.assertTrue(FatTreeBuilder.validate_topology(parsed).valid)
+
+    def test_trimmed_switches_miswired(self):
+        built = FatTreeBuilder.build_fat_tree(4, 3, hcas=13)
+        # Swap the uplinks 1 and 2 of Switch0
+        first = built.port_offset[0]
+        uplink_1 = (built.remote_node[first], built.remote_port[first])
+        uplink_2 = (built.remote_node[first + 1], built.remote_port[first + 1])
+        built.connect(0, 1, *uplink_2)
+        built.connect(0, 2, *uplink_1)
+        parsed = self.round_trip(built)
+        self.assertIsNotNone(parsed.tree)
+        self.assertEqual(FatTreeBuilder.validate_topology(parsed).errors, {'structure': 2})
+
+    def test_description_mismatch(self):
+        # A failure variant keeps the description of the intact fabric
+        built = FatTreeBuilder.build_fat_tree(2, 3)
+        with open(self.path, 'w') as topology_file:
+            FatTreeBuilder.write_failure_variants(built, 'switches', 1, 1, lambda variant: topology_file, timestamp='')
+        with self.assertLogs(FatTreeBuilder.LOG, 'WARNING') as logs:
+            parsed = FatTreeBuilder.parse_ibnetdiscover(self.path)
+        self.assertIsNone(parsed.tree)
+        self.assertIn("the structure of the tree cannot be validated", logs.output[0])
+        self.assertIsNone(FatTreeBuilder.validate_topology(parsed).tree)
+
+    def test_xgft(self):
+        built = FatTreeBuilder.build_xgft([2, 3, 2], [1, 2, 2])
+        parsed = self.round_trip(built)
+        self.assertSameTopology(built, parsed)
+        self.assertIsInstance(parsed.tree, FatTreeBuilder.XGFT)
+
+
+class TestRealDump(ParseTestCase):
+
+    def setUp(self):
+        ParseTestCase.setUp(self)
+        self.write_text(REAL_DUMP)
+        with self.assertLogs(FatTreeBuilder.LOG, 'WARNING') as logs:
+            self.topology = FatTreeBuilder.parse_ibnetdiscover(self.path)
+        self.warnings = logs.output
+
+    def test_nodes(self):
+        topology = self.topology
+        # The router is skipped
+        self.assertEqual(list(topology.node_type), [Topology.SWITCH, Topology.SWITCH, Topology.HCA, Topology.HCA])
+        self.assertEqual(list(topology.node_guid), [0x7cfe900300bd3a40, 0x7cfe900300bd3b40, 0x0002c90300a1b2c0, 0x0002c90300a1b2d0])
+        self.assertEqual(topology.names, ['MF0;leaf1:MSB7700/U1', 'MF0;spine1:MSB7700/U1', 'node01 HCA-1', 'node02 HCA-1'])
+        self.assertEqual([topology.total_ports(node) for node in range(topology.number_of_nodes)], [36, 36, 1, 1])
+        self.assertIsNone(topology.tree)
+
+    def test_links(self):
+        topology = self.topology
+        port = lambda node, port: topology.port_offset[node] + port - 1
+        links = [(LEAF, 1, NODE01, 1), (LEAF, 2, NODE02, 1), (LEAF, 36, SPINE, 36),
+                 (SPINE, 36, LEAF, 36), (NODE01, 1, LEAF, 1), (NODE02, 1, LEAF, 2)]
+        for node, node_port, remote_node, remote_port in links:
+            self.assertEqual((topology.remote_node[port(node, node_port)], topology.remote_port[port(node, node_port)]),
+                             (remote_node, remote_port))
+        self.assertEqual(topology.port_guid[port(NODE01, 1)], 0x2c90300a1b2c1)
+        self.assertEqual(topology.port_guid[port(LEAF, 1)], 0)
+
+    def test_unresolved_ports(self):
+        topology = self.topology
+        # The ports towards the missing HCA and the router are left unconnected
+        port = lambda node, port: topology.port_offset[node] + port - 1
+        for node, node_port in ((LEAF, 3), (LEAF, 35), (SPINE, 35)):
+            self.assertEqual(topology.remote_node[port(node, node_port)], -1)
+        connected = sum(1 for remote_node in topology.remote_node if remote_node >= 0)
+        self.assertEqual(connected, 6)
+        self.assertEqual(len(self.warnings), 1)
+        self.assertIn("3 ports of", self.warnings[0])
+
+    def test_validate(self):
+        report = FatTreeBuilder.validate_topology(self.topology)
+        self.assertTrue(report.valid)
+
+
+class TestInvalidFiles(ParseTestCase):
+
+    def test_empty_file(self):
+        with self.assertRaises(ValueError):
+            FatTreeBuilder.parse_ibnetdiscover(self.path)
+
+    def test_no_nodes(self):
+        self.write_text("#\n# Topology file: generated on Tue Mar  5 10:12:45 2024\n#\n")
+        with self.assertRaises(ValueError):
+            FatTreeBuilder.parse_ibnetdiscover(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()